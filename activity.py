@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+'''Classify singleuser servers by the last activity their hub has seen.
+
+A server is active if it was used in the last IDLE seconds, stale if it has
+not been used for STALE seconds, and idle in between. Activity comes from
+the hub API or from a copy of the hub's sqlite database, as used by the
+archive tools.'''
+
+import datetime
+import json
+import sqlite3
+import string
+import time
+import urllib.request
+
+ACTIVE = 'active'
+IDLE = 'idle'
+STALE = 'stale'
+
+SAFE_CHARS = set(string.ascii_lowercase + string.digits)
+
+def escape_username(name):
+	'''Escape a user name the way kubespawner does for pod names.'''
+	escaped = ''
+	for c in name:
+		if c in SAFE_CHARS: escaped += c
+		else: escaped += '-' + ''.join(['{:02x}'.format(b) for b in c.encode('utf8')])
+	return escaped.lower()
+
+def parse_timestamp(ts):
+	'''Parse a hub timestamp, which is UTC, into a naive datetime.'''
+	if not ts: return None
+	ts = ts.rstrip('Z').replace('T', ' ')
+	for fmt in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']:
+		try:
+			return datetime.datetime.strptime(ts, fmt)
+		except ValueError:
+			continue
+	return None
+
+class hub_api:
+	'''Read last activity from, and stop servers through, the hub API.'''
+
+	def __init__(self, url, token):
+		self.url = url.rstrip('/')
+		self.token = token
+
+	def _request(self, path, method='GET'):
+		req = urllib.request.Request(self.url + path, method=method,
+			headers={'Authorization': 'token ' + self.token})
+		with urllib.request.urlopen(req, timeout=30) as r:
+			body = r.read()
+		return json.loads(body.decode()) if body else None
+
+	def users(self):
+		'''Return (name, pod name or None, last activity) of users with a
+		   server.'''
+		users = []
+		for user in self._request('/users'):
+			if not user.get('server'): continue
+			users.append((user['name'], None,
+				parse_timestamp(user.get('last_activity'))))
+		return users
+
+	def stop(self, name):
+		'''Stop a user's server.'''
+		self._request('/users/{}/server'.format(name), method='DELETE')
+
+class hub_db:
+	'''Read last activity from a copy of the hub's sqlite database. A
+	   copy cannot stop servers, so it cannot be used to cull.'''
+
+	def __init__(self, path):
+		self.path = path
+
+	def users(self):
+		conn = sqlite3.connect(self.path)
+		try:
+			rows = conn.execute(
+				'select name, state, last_activity from users').fetchall()
+		finally:
+			conn.close()
+		users = []
+		for name, state, last_activity in rows:
+			pod_name = None
+			if state:
+				pod_name = json.loads(state).get('pod_name')
+			users.append((name, pod_name, parse_timestamp(last_activity)))
+		return users
+
+class activity:
+	'''Last activity of the users of several hubs, refreshed at most every
+	   INTERVAL seconds.'''
+
+	def __init__(self, hubs, idle=1800, stale=12*3600, interval=60):
+		self.hubs = hubs
+		self.idle = datetime.timedelta(seconds=idle)
+		self.stale = datetime.timedelta(seconds=stale)
+		self.interval = interval
+		self.last_refresh = 0
+		self.by_pod = {}
+		self.by_escaped = {}
+
+	def refresh(self):
+		'''Reload every hub's users if INTERVAL has passed.'''
+		if time.time() - self.last_refresh < self.interval: return
+		by_pod = {}
+		by_escaped = {}
+		for ns, hub in self.hubs.items():
+			try:
+				users = hub.users()
+			except Exception as e:
+				# Keep what we knew rather than counting everyone as active
+				print('activity: {}: {}'.format(ns, e))
+				for old, new in [(self.by_pod, by_pod), (self.by_escaped, by_escaped)]:
+					new.update([(k, v) for k, v in old.items() if k[0] == ns])
+				continue
+			for name, pod_name, last_activity in users:
+				if pod_name:
+					by_pod[(ns, pod_name)] = (name, last_activity)
+				by_escaped[(ns, escape_username(name))] = (name, last_activity)
+		self.by_pod = by_pod
+		self.by_escaped = by_escaped
+		self.last_refresh = time.time()
+
+	def user_of(self, pod):
+		'''Return (user name, last activity) for a singleuser pod, or None.'''
+		ns, name = pod.metadata.namespace, pod.metadata.name
+		if (ns, name) in self.by_pod: return self.by_pod[(ns, name)]
+		# jupyter-<escaped user name>, optionally followed by -<user id>
+		escaped = name[len('jupyter-'):]
+		if (ns, escaped) in self.by_escaped: return self.by_escaped[(ns, escaped)]
+		escaped = escaped.rsplit('-', 1)[0]
+		return self.by_escaped.get((ns, escaped))
+
+	def state(self, pod, now=None):
+		'''Return ACTIVE, IDLE or STALE for a singleuser pod. Pods we know
+		   nothing about count as active.'''
+		if now is None: now = datetime.datetime.utcnow()
+		user = self.user_of(pod)
+		if user is None or user[1] is None: return ACTIVE
+		age = now - user[1]
+		if age < self.idle: return ACTIVE
+		if age < self.stale: return IDLE
+		return STALE
+
+	def cull(self, pods):
+		'''Stop the servers of stale PODS. Return the pods stopped.'''
+		culled = []
+		for pod in pods:
+			if self.state(pod) != STALE: continue
+			ns = pod.metadata.namespace
+			name = self.user_of(pod)[0]
+			try:
+				self.hubs[ns].stop(name)
+			except Exception as e:
+				print('cull {}/{}: {}'.format(ns, name, e))
+				continue
+			print('culled {}/{}'.format(ns, name))
+			culled.append(pod)
+		return culled
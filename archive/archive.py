@@ -1,21 +1,25 @@
 #!/usr/bin/python3
 
-# Requires libsqlite3-mod-impexp for json_extract function.
-
+import argparse
 import fileinput
 import json
 import os
 import socket
 import smtplib
-import sqlite3
 import subprocess as sp
+import sys
+import threading
 import time
 
-from gcloud import storage
-import gcloud.exceptions
+from concurrent.futures import ThreadPoolExecutor
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+# google_api is shared with the backup tools at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from google_api import api_client, parse_timestamp
+from gcs_stream import stream_tar, resumable_upload, CODECS
+from operations import operation_tracker
+from dedup import blob_store, pack, course_digests, UnreadableTree, MIN_BLOB_SIZE
+from hub_users import hub_users, sqlite_tmpl
 
 # gcloud instance where this script is being run
 instance = socket.gethostname()
@@ -40,9 +44,19 @@ tmpl_body = '''We have archived your course files to Google Cloud. The JupyterHu
 {}
 
 If you have any questions, contact ds-instr@berkeley.edu.''' 
+# Archives made with --dedup need a tool to put them back together
+tmpl_dedup_body = '''We have archived your course files to Google Cloud. The JupyterHub server may become inaccessible before the next academic term begins. The link below is to a manifest of your files. To download them as one tarball, run archive/rebuild-tarball.py from https://github.com/data-8/jupyterhub-k8s with the name of the manifest, after logging in with "gcloud auth application-default login" as your Berkeley account.
 
-# sqlite db path template
-sqlite_tmpl = '/home/ryan/jupyterhub-{}.sqlite'
+{}
+
+If you have any questions, contact ds-instr@berkeley.edu.'''
+
+# Archive disks attached at once. GCE allows 128 disks on most machine
+# types, but only 16 on shared-core ones.
+ATTACH_LIMIT = 64
+# Users in each pipeline stage at once
+GCE_WORKERS = 16
+TAR_WORKERS = os.cpu_count() or 4
 
 def smtp_connect(smtp_user, smtp_pass):
 	server = smtplib.SMTP(SMTP_HOST, 587)
@@ -51,83 +65,63 @@ def smtp_connect(smtp_user, smtp_pass):
 	server.login(smtp_user, smtp_pass)
 	return server
 
+class lazy_smtp:
+	'''Connects to the SMTP server the first time an email is sent, so
+	   that runs which send none do not wait for a connection.'''
+
+	def __init__(self, smtp_user, smtp_pass):
+		self.smtp_user = smtp_user
+		self.smtp_pass = smtp_pass
+		self.server = None
+
+	def sendmail(self, from_addr, to_addrs, msg):
+		if self.server is None:
+			self.server = smtp_connect(self.smtp_user, self.smtp_pass)
+		return self.server.sendmail(from_addr, to_addrs, msg)
+
+	def quit(self):
+		if self.server is not None:
+			self.server.quit()
+			self.server = None
+
 def send_email(smtp_server, smtp_from, recipient, subject, body):
 	TO = recipient if type(recipient) is list else [recipient]
 	message = """From: %s\nTo: %s\nSubject: %s\n\n%s
 	""" % (smtp_from, ", ".join(TO), subject, body)
 	smtp_server.sendmail(smtp_from, TO, message)
 
-def get_user_from_claim(ns, claim):
-	'''Return the user's login given the claim name. We infer the pod name
-	   from the claim, then ask the hub for the user name.
-
-       for each namespace,
-       kubectl --namespace=<namespace> cp \
-		   hub-deployment-...:/srv/jupyterhub/jupyterhub.sqlite \
-		   ~/jupyterhub-<namespace>.sqlite
-	'''
-	conn = sqlite3.connect(sqlite_tmpl.format(ns))
-	c = conn.cursor()
-	pod_name = claim.replace('claim', 'jupyter', 1)
-	sql = 'select name from users where json_extract(state,"$.pod_name")=?'
-	c.execute(sql, (pod_name,))
-	return c.fetchone()[0]
-
 def email_from_user(user):
 	return user + '@' + hosted_domain
 
+# .tar.gz, or .tar.zst when streaming with zstd
+tar_suffix = '.tar.gz'
+
 def tar_file_tmpl(user, namespace):
-	return '{}-{}.tar.gz'.format(namespace, user)
+	return '{}-{}{}'.format(namespace, user, tar_suffix)
+
+def manifest_file_tmpl(user, namespace):
+	return '{}-{}.manifest.json'.format(namespace, user)
 
 def archive_exists(bucket, user, namespace):
+	# The manifest of a deduplicated archive is uploaded last
+	if args.dedup:
+		return bucket.get_blob(manifest_file_tmpl(user, namespace))
 	return bucket.get_blob(tar_file_tmpl(user, namespace))
 
-def operation_exists(compute, project, zone, operation):
-	'''Check whether an operation still exists.'''
-	fltr='name eq {}'.format(operation)
-	request = service.zoneOperations().list(project=project, zone=zone,
-		filter=fltr)
-	response = request.execute()
-	return 'items' in response
-
-# https://github.com/GoogleCloudPlatform/python-docs-samples/blob/master/compute/api/create_instance.py
-def wait_for_operation(compute, project, zone, operation):
-	'''Wait for a gcloud operation to complete and return its result.
-       Raise an exception for any error unless it is for when try to create
-	   a resource that already exists.'''
-	result = {}
-	while True:
-		time.sleep(1)
-		if not operation_exists(compute, project, zone, operation):
-			break
-
-		request = compute.zoneOperations().get(project=project,
-			zone=zone, operation=operation)
-
-		try:
-			response = request.execute()
-		except gcloud.exceptions.ServiceUnavailable as e:
-			print('Service unavailable. Retrying in 3s.')
-			time.sleep(3)
-			continue
-
-		if response['status'] == 'DONE': break
-
-	if 'error' in result:
-		code = result['error']['errors'][0]['code']
-		if code not in ['RESOURCE_ALREADY_EXISTS']:
-			raise(result['error']['errors'][0]['message'])
-
-	return result
+def wait_for_operation(operation):
+	'''Wait for a zone or global operation to complete and return it.
+	   Raise an exception for any error unless it is for when try to create
+	   a resource that already exists. Every pending operation is polled
+	   together by the tracker.'''
+	return operations.wait(operation, ignore=['RESOURCE_ALREADY_EXISTS'])
 
 def create_snapshot(service, project, zone, disk, snapshot):
 	'''If necessary, create a snapshot of a disk from the snapshot name,
        and return the snapshot's URL.'''
-	print('  create_snapshot')
 	request = service.disks().createSnapshot(project=project, zone=zone,
 		disk=disk, body={'name':snapshot})
 	response = request.execute()
-	result = wait_for_operation(service, project, zone, response['name'])
+	result = wait_for_operation(response)
 
 	# Get the snapshot ID
 	request = service.snapshots().get(project=project, snapshot=snapshot)
@@ -145,22 +139,20 @@ def snapshot_exists(service, project, snapshot):
 
 def delete_snapshot(service, project, snapshot):
 	'''Delete a snapshot.'''
-	print('  delete_snapshot')
 	request = service.snapshots().delete(project=project, snapshot=snapshot)
 	response = request.execute()
-	result = wait_for_operation(service, project, zone, response['name'])
+	result = wait_for_operation(response)
 	
 def create_disk(service, project, zone, disk_name, snapshot_link):
 	'''If necessary, create an archive disk from the snapshot ID, 
 	   and return the link to the disk.'''
-	print('  create_disk')
 	body = {
 		'name': disk_name,
 		'sourceSnapshot': snapshot_link,
 	}
 	request = service.disks().insert(project=project, zone=zone, body=body)
 	response = request.execute()
-	result = wait_for_operation(service, project, zone, response['name'])
+	result = wait_for_operation(response)
 
 	# Get the disk's url
 	request = service.disks().get(project=project, zone=zone, disk=disk_name)
@@ -178,14 +170,12 @@ def disk_exists(service, project, zone, disk):
 	
 def delete_disk(service, project, zone, disk):
 	'''Delete a disk from the disk name.'''
-	print('  delete_disk')
 	request = service.disks().delete(project=project, zone=zone, disk=disk)
 	response = request.execute()
-	result = wait_for_operation(service, project, zone, response['name'])
+	result = wait_for_operation(response)
 	
 def attach_disk(service, project, zone, instance, disk_link, device_name):
 	'''Attach the disk associated with the snapshot.'''
-	print('  attach_disk')
 	body = {
 		'source': disk_link,
 		'deviceName': device_name,
@@ -193,15 +183,14 @@ def attach_disk(service, project, zone, instance, disk_link, device_name):
 	request = service.instances().attachDisk(project=project, zone=zone,
 		instance=instance, body=body)
 	response = request.execute()
-	result = wait_for_operation(service, project, zone, response['name'])
+	result = wait_for_operation(response)
 
 def detach_disk(service, project, zone, instance, device_name):
 	'''Detach the disk associated with the snapshot.'''
-	print('  detach_disk')
 	request = service.instances().detachDisk(project=project, zone=zone,
 		instance=instance, deviceName=device_name)
 	response = request.execute()
-	result = wait_for_operation(service, project, zone, response['name'])
+	result = wait_for_operation(response)
 
 def device_is_attached(service, project, zone, instance, device_name):
 	'''Check whether a disk's device is attached to the specified instance.'''
@@ -211,7 +200,6 @@ def device_is_attached(service, project, zone, instance, device_name):
 	return device_name in map(lambda x: x['deviceName'], response['disks'])
 
 def mount_disk(mount_dir, block_device):
-	print('  mount_disk')
 	if not os.path.exists(mount_dir):
 		cmd = ['sudo', 'mkdir', mount_dir]
 		p = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
@@ -222,7 +210,6 @@ def mount_disk(mount_dir, block_device):
 	p.check_returncode()
 
 def create_tar(path, source_dir):
-	print('  create_tar')
 	cmd = ['sudo', 'tar', 'czf', path, '-C', '/mnt/disks',
 		'--exclude=lost+found', source_dir]
 	p = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
@@ -234,83 +221,336 @@ def unmount(mount_dir):
 	p.check_returncode()
 
 def gen_url(user, ns):
-	tar_file_name = tar_file_tmpl(user, ns)
+	if args.dedup:
+		tar_file_name = manifest_file_tmpl(user, ns)
+	else:
+		tar_file_name = tar_file_tmpl(user, ns)
 	return 'https://storage.cloud.google.com/{}/{}'.format(
 		bucket_name, tar_file_name)
 
-def make_archive(ns, user, pd):
-	'''Archive user pvc to gcloud archive storage.
-	    - namespace: e.g. datahub, stat28, prob140
-	    - claim: of the form claim-<user-name>-NNN
-	    - pd: google persistend disk, e.g. gke-prod-long-uuid-looking-thing
-	'''
-
-	# name the things
+def archive_names(ns, user, pd):
+	'''Name the things used to archive a user's disk.'''
 	ns_user = ns + '-' + user.replace('.', '---').replace('_', '---').replace('~', '---')
-	archive_name = ns_user
-	snapshot = 'snapshot-' + ns_user + '-eof'
 	disk_name = 'archive-disk-' + ns_user + '-eof'
-	device_name = disk_name
-	mount_dir = '/mnt/disks/' + disk_name
-	block_device = '/dev/disk/by-id/google-' + disk_name
 	tar_file_name = tar_file_tmpl(user, ns)
-	tar_file_path = os.path.join(tarball_dir, tar_file_name)
-	url = 'https://storage.cloud.google.com/{}/{}'.format(
-		bucket_name, tar_file_name)
-
-	# Create a snapshot of the disk
-	if snapshot_exists(service, project, snapshot):
-		delete_snapshot(service, project, snapshot)
-	snapshot_link = create_snapshot(service, project, zone, pd, snapshot)
-
-	if device_is_attached(service, project, zone, instance, device_name):
-		detach_disk(service, project, zone, instance, device_name)
-
-	# Create an archive disk from the snapshot
-	if disk_exists(service, project, zone, disk_name):
-		delete_disk(service, project, zone, disk_name)
-	disk_link = create_disk(service, project, zone, disk_name, snapshot_link)
-
-	# Attach archive disk
-	attach_disk(service, project, zone, instance, disk_link, device_name)
-
-	# Mount the disk
-	if os.path.ismount(mount_dir):
-		unmount(mount_dir)
-	mount_disk(mount_dir, block_device)
+	return {
+		'ns': ns,
+		'user': user,
+		'pd': pd,
+		'snapshot': 'snapshot-' + ns_user + '-eof',
+		'disk_name': disk_name,
+		'device_name': disk_name,
+		'mount_dir': '/mnt/disks/' + disk_name,
+		'block_device': '/dev/disk/by-id/google-' + disk_name,
+		'tar_file_name': tar_file_name,
+		'tar_file_path': os.path.join(tarball_dir, tar_file_name),
+		'rest_file_name': '{}-{}.rest{}'.format(ns, user, tar_suffix),
+		'manifest_name': manifest_file_tmpl(user, ns),
+	}
 
-	# Create the tar file
-	create_tar(path=tar_file_path, source_dir=disk_name)
+def progress(job, msg):
+	print('{}/{}: {}'.format(job['ns'], job['user'], msg))
+
+def thread_bucket():
+	'''gcloud storage connections are not thread safe, so each thread
+	   uploads through its own client.'''
+	if not hasattr(local, 'bucket'):
+		local.bucket = storage.Client().bucket(bucket_name)
+	return local.bucket
+
+def wait_for_device(block_device, timeout=60):
+	'''Wait for udev to create the device link of a newly attached disk.'''
+	deadline = time.time() + timeout
+	while not os.path.exists(block_device):
+		if time.time() > deadline:
+			raise Exception('{} did not appear'.format(block_device))
+		time.sleep(1)
 
-	# Upload the tarball to Google archival storage
-	print('  upload')
-	blob = bucket.blob(tar_file_name)
-	blob.upload_from_filename(filename=tar_file_path)
+def reusable_snapshots(service, project, zone, since=None):
+	'''Return the newest snapshot of each disk that already holds the
+	   disk's final contents, keyed by disk name: ready, taken after the
+	   disk was last detached, of a disk attached nowhere, and if SINCE is
+	   given, taken no earlier than SINCE.'''
+	settled = {}
+	request = service.disks().list(project=project, zone=zone,
+		fields='nextPageToken,items(name,users,lastDetachTimestamp)')
+	while request is not None:
+		response = request.execute()
+		for disk in response.get('items', []):
+			if disk.get('users'): continue
+			settled[disk['name']] = parse_timestamp(disk.get('lastDetachTimestamp'))
+		request = service.disks().list_next(request, response)
+
+	newest = {}
+	request = service.snapshots().list(project=project,
+		fields='nextPageToken,items(name,selfLink,sourceDisk,creationTimestamp,status)')
+	while request is not None:
+		response = request.execute()
+		for snapshot in response.get('items', []):
+			if snapshot.get('status') != 'READY' or 'sourceDisk' not in snapshot:
+				continue
+			disk = snapshot['sourceDisk'].split('/')[-1]
+			created = parse_timestamp(snapshot.get('creationTimestamp'))
+			if disk not in settled or created is None: continue
+			if settled[disk] is not None and created < settled[disk]: continue
+			if since is not None and created < since: continue
+			if disk not in newest or created > newest[disk][0]:
+				newest[disk] = (created, snapshot)
+		request = service.snapshots().list_next(request, response)
+	return dict([(disk, s) for disk, (created, s) in newest.items()])
+
+def prepare_disk(job):
+	'''Snapshot the user's disk, unless an existing snapshot can be
+	   reused, and create an archive disk from it.'''
+	if job.get('source_snapshot'):
+		progress(job, 'reuse snapshot ' + job['source_snapshot']['name'])
+		snapshot_link = job['source_snapshot']['selfLink']
+	else:
+		progress(job, 'snapshot')
+		if snapshot_exists(service, project, job['snapshot']):
+			delete_snapshot(service, project, job['snapshot'])
+		snapshot_link = create_snapshot(service, project, zone, job['pd'], job['snapshot'])
+
+	if device_is_attached(service, project, zone, instance, job['device_name']):
+		detach_disk(service, project, zone, instance, job['device_name'])
+
+	progress(job, 'create disk')
+	if disk_exists(service, project, zone, job['disk_name']):
+		delete_disk(service, project, zone, job['disk_name'])
+	job['disk_link'] = create_disk(service, project, zone, job['disk_name'], snapshot_link)
+
+def attach(job):
+	'''Attach the archive disk once the instance has room for it.'''
+	attach_slots.acquire()
+	job['slot'] = True
+	progress(job, 'attach')
+	attach_disk(service, project, zone, instance, job['disk_link'], job['device_name'])
+	job['attached'] = True
+	wait_for_device(job['block_device'])
+
+def tar_and_upload(job):
+	'''Tar the archive disk and upload it with read access for the user.'''
+	if os.path.ismount(job['mount_dir']):
+		unmount(job['mount_dir'])
+	mount_disk(job['mount_dir'], job['block_device'])
+	job['mounted'] = True
+
+	if args.dedup:
+		try:
+			return dedup_upload(job)
+		except UnreadableTree as e:
+			progress(job, '{}; archiving without deduplication'.format(e))
+
+	blob = thread_bucket().blob(job['tar_file_name'])
+	if args.spool:
+		progress(job, 'tar')
+		create_tar(path=job['tar_file_path'], source_dir=job['disk_name'])
+		unmount(job['mount_dir'])
+		job['mounted'] = False
+
+		# Upload the tarball to Google archival storage
+		progress(job, 'upload')
+		blob.upload_from_filename(filename=job['tar_file_path'])
+	else:
+		progress(job, 'stream')
+		upload = resumable_upload(client.http(), bucket_name,
+			job['tar_file_name'], CODECS[args.codec][1])
+		size = stream_tar('/mnt/disks', job['disk_name'], upload,
+			codec=args.codec, threads=args.compress_threads)
+		progress(job, 'uploaded {:.1f} MB'.format(size / 1e6))
+		unmount(job['mount_dir'])
+		job['mounted'] = False
 
 	# Allow students to access their own bucket
-	email = email_from_user(user)
 	acl = blob.acl
-	acl.user(email).grant_read()
+	acl.user(email_from_user(job['user'])).grant_read()
 	acl.save()
 
-	# Unmount disk
-	unmount(mount_dir)
+def dedup_upload(job):
+	'''Upload the user's large files as shared blobs, the rest as a
+	   tarball and then the manifest, with read access for the user.'''
+	progress(job, 'deduplicate')
+	upload = resumable_upload(client.http(), bucket_name,
+		job['rest_file_name'], CODECS[args.codec][1])
+	manifest = pack('/mnt/disks', job['disk_name'], blobs, upload,
+		(job['ns'], job['user']), min_size=args.dedup_min_size, codec=args.codec,
+		threads=args.compress_threads)
+	manifest['tarball'] = job['rest_file_name']
+	progress(job, 'uploaded {:.1f} MB, {:.1f} MB of {:.1f} MB in blobs'.format(
+		manifest['tarball_size'] / 1e6, manifest['uploaded_blob_size'] / 1e6,
+		manifest['blob_size'] / 1e6))
+	unmount(job['mount_dir'])
+	job['mounted'] = False
+
+	# Allow students to access their own tarball and manifest
+	bucket = thread_bucket()
+	for name in [job['rest_file_name'], job['manifest_name']]:
+		blob = bucket.blob(name)
+		if name == job['manifest_name']:
+			blob.upload_from_string(json.dumps(manifest),
+				content_type='application/json')
+		acl = blob.acl
+		acl.user(email_from_user(job['user'])).grant_read()
+		acl.save()
+
+def teardown(job):
+	'''Detach and delete the archive disk, delete the snapshot and the
+	   tarball. Also cleans up after jobs that failed part way, so every
+	   step checks whether there is anything to undo.'''
+	if job.get('mounted'):
+		unmount(job['mount_dir'])
+		job['mounted'] = False
+	if job.get('attached'):
+		detach_disk(service, project, zone, instance, job['device_name'])
+		job['attached'] = False
+	if job.get('slot'):
+		attach_slots.release()
+		job['slot'] = False
+	if job.get('disk_link') or 'error' in job:
+		if disk_exists(service, project, zone, job['disk_name']):
+			delete_disk(service, project, zone, job['disk_name'])
+	if snapshot_exists(service, project, job['snapshot']):
+		delete_snapshot(service, project, job['snapshot'])
+	if os.path.exists(job['tar_file_path']):
+		os.remove(job['tar_file_path'])
+	if 'error' not in job:
+		progress(job, 'done')
+
+def failed(job):
+	'''Report a job that failed, then clean up after it.'''
+	stage, e = job['error']
+	print(json.dumps({ 'user': job['user'], 'namespace': job['ns'],
+		'msg': '{} failed: {}'.format(stage, e) }))
+	teardown(job)
+
+class pipeline:
+	'''Move jobs through STAGES, a list of (function, workers). Every stage
+	   has its own pool of worker threads, so that different jobs are in
+	   different stages at once. At most IN_FLIGHT jobs are between the
+	   first and the last stage; submit blocks until there is room. A job
+	   whose stage raises is passed to FAILED instead of the next stage.'''
+
+	def __init__(self, stages, failed, in_flight):
+		self.stages = [(fn, ThreadPoolExecutor(max_workers=workers))
+			for fn, workers in stages]
+		self.failed = failed
+		self.room = threading.BoundedSemaphore(in_flight)
+		self.pending = 0
+		self.cond = threading.Condition()
+
+	def submit(self, job):
+		self.room.acquire()
+		with self.cond:
+			self.pending += 1
+		self.stages[0][1].submit(self._step, 0, job)
+
+	def _step(self, i, job):
+		fn = self.stages[i][0]
+		try:
+			fn(job)
+		except Exception as e:
+			job['error'] = (fn.__name__, e)
+			try:
+				self.failed(job)
+			except Exception as e:
+				print(json.dumps({ 'user': job['user'], 'namespace': job['ns'],
+					'msg': 'cleanup failed: {}'.format(e) }))
+			return self._done()
+		if i + 1 < len(self.stages):
+			self.stages[i + 1][1].submit(self._step, i + 1, job)
+		else:
+			self._done()
+
+	def _done(self):
+		with self.cond:
+			self.pending -= 1
+			self.cond.notify_all()
+		self.room.release()
+
+	def join(self):
+		'''Wait for every submitted job, then stop the workers.'''
+		with self.cond:
+			while self.pending:
+				self.cond.wait()
+		for _, pool in self.stages:
+			pool.shutdown()
+
+def attached_disk_count(service, project, zone, instance):
+	request = service.instances().get(project=project, zone=zone,
+		instance=instance)
+	return len(request.execute()['disks'])
+
+def timestamp_arg(text):
+	parsed = parse_timestamp(text)
+	if parsed is None:
+		raise argparse.ArgumentTypeError('expected a time like 2017-05-20T17:00:00')
+	return parsed
 
-	# Detach archive disk
-	detach_disk(service, project, zone, instance, device_name)
+# main
+parser = argparse.ArgumentParser(description='Archive user volumes to Google Cloud Storage.')
+parser.add_argument('claims', nargs='*',
+	help='files of "namespace claim pdName" lines; standard input if none')
+parser.add_argument('--attach-limit', type=int, default=ATTACH_LIMIT,
+	help='disks the instance may have attached, including ones already there (default %(default)s)')
+parser.add_argument('--gce-workers', type=int, default=GCE_WORKERS,
+	help='users whose snapshots and disks are created at once (default %(default)s)')
+parser.add_argument('--codec', choices=sorted(CODECS), default='gzip',
+	help='compression; gzip uses pigz when it is installed (default %(default)s)')
+parser.add_argument('--compress-threads', type=int, default=os.cpu_count() or 1,
+	help='cores each compressor may use (default %(default)s)')
+parser.add_argument('--spool', action='store_true',
+	help='write each tarball to {} and upload it from there, instead of streaming'.format(tarball_dir))
+parser.add_argument('--reuse-snapshots', action='store_true',
+	help='build archive disks from existing snapshots taken after the disk was last detached, '
+	'and only snapshot disks without one')
+parser.add_argument('--since', type=timestamp_arg, metavar='YYYY-MM-DDTHH:MM:SS',
+	help='with --reuse-snapshots, only reuse snapshots taken from this time on, '
+	'such as when the hub was shut down')
+parser.add_argument('--dedup', action='store_true',
+	help='store large files once per bucket, shared between users, and upload '
+	'a manifest and a tarball of the rest for each user')
+parser.add_argument('--dedup-min-size', type=int, default=MIN_BLOB_SIZE,
+	help='with --dedup, smallest file in bytes stored as a shared blob (default %(default)s)')
+parser.add_argument('--course-files', action='append', default=[], metavar='DIR',
+	help='with --dedup, share files with the same content as those under DIR, '
+	'such as a checkout of the course materials; may be repeated')
+parser.add_argument('--hub-db', default=sqlite_tmpl,
+	help='copy of each hub database, with {} for the namespace (default %(default)s)')
+parser.add_argument('--tar-workers', type=int, default=TAR_WORKERS,
+	help='users tarred and uploaded at once (default %(default)s)')
+args = parser.parse_args()
+if args.spool and args.codec != 'gzip':
+	parser.error('--spool only writes gzip tarballs')
+if args.spool and args.dedup:
+	parser.error('--spool and --dedup cannot be used together')
+if args.course_files and not args.dedup:
+	parser.error('--course-files only applies with --dedup')
+tar_suffix = CODECS[args.codec][0]
+
+# Find every claim's user, and report the orphans, before archiving starts
+claims = []
+for line in fileinput.input(args.claims):
+	if not line.strip(): continue
+	(namespace, claim, disk) = line.split()
 
-	# Delete archive disk
-	delete_disk(service, project, zone, disk_name)
+	# if claim is not a user's, continue; dsep convention
+	if not claim.startswith('claim-'): continue
+	claims.append((namespace, claim, disk))
 
-	# Delete snapshot
-	delete_snapshot(service, project, snapshot)
+resolved, orphans = hub_users(args.hub_db).resolve(claims)
+for namespace, claim, disk, msg in orphans:
+	je = { 'claim': claim, 'namespace': namespace, 'msg': 'Error: ' + msg }
+	print(json.dumps(je))
+print('{} claims belong to users, {} are orphaned'.format(len(resolved), len(orphans)))
 
-	# Delete tar file
-	os.remove(tar_file_path)
+# gcloud is slow to import, so --help and bad arguments do not wait for it
+from gcloud import storage
+import gcloud.exceptions
 
-# main
-credentials = GoogleCredentials.get_application_default()
-service = discovery.build('compute', 'beta', credentials=credentials)
+client = api_client()
+service = client.build('compute', 'beta')
+operations = operation_tracker(client, service, project)
+local = threading.local()
 
 # http://gcloud-python.readthedocs.io/en/latest/storage-client.html
 gs_client = storage.Client()
@@ -322,36 +562,45 @@ except gcloud.exceptions.Forbidden:
 except gcloud.exceptions.NotFound:
 	bucket = gs_client.create_bucket(bucket_name)
 
+blobs = None
+if args.dedup:
+	course = course_digests(args.course_files, args.dedup_min_size)
+	blobs = blob_store(thread_bucket, client.http, bucket_name, hosted_domain, course)
+	print('{} shared blobs in {}, {} known course files'.format(len(blobs.stored),
+		bucket_name, len(course)))
+
 # Create tarball directory
-if not os.path.isdir(tarball_dir):
+if args.spool and not os.path.isdir(tarball_dir):
 	os.mkdir(tarball_dir)
 
-smtp_server = smtp_connect(smtp_from, smtp_pass)
+# Archive disks stay attached from attach until teardown
+slots = args.attach_limit - attached_disk_count(service, project, zone, instance)
+if slots < 1:
+	print('No room to attach archive disks to {}'.format(instance))
+	sys.exit(1)
+attach_slots = threading.BoundedSemaphore(slots)
 
-# Go through piped data
-for line in fileinput.input():
-	(namespace, claim, disk) = line.split()
+archiver = pipeline([
+	(prepare_disk, args.gce_workers),
+	(attach, args.gce_workers),
+	(tar_and_upload, args.tar_workers),
+	(teardown, args.gce_workers),
+], failed, in_flight=slots + args.gce_workers)
 
-	# if claim is not a user's, continue; dsep convention
-	if not claim.startswith('claim-'): continue
+reusable = {}
+if args.reuse_snapshots:
+	reusable = reusable_snapshots(service, project, zone, args.since)
+	print('{} disks have a snapshot to reuse'.format(len(reusable)))
 
-	try:
-		user = get_user_from_claim(namespace, claim)
-	except Exception as e:
-		msg = 'Error: Could not resolve user from probably orphaned claim.'
-		je = { 'claim': claim, 'namespace': namespace, 'msg': msg }
-		print(json.dumps(je))
-		continue
+smtp_server = lazy_smtp(smtp_from, smtp_pass)
 
+for namespace, claim, disk, user in resolved:
 	# Skip blobs that already exist
 	if not archive_exists(bucket, user, namespace):
 		print('archiving: {}/{}'.format(namespace, user))
-		try:
-			make_archive(namespace, user, disk)
-		except gcloud.exceptions.BadRequest as e:
-			je = { 'user': user, 'namespace': namespace, 'msg': str(e) }
-			print(json.dumps(je))
-			continue
+		job = archive_names(namespace, user, disk)
+		job['source_snapshot'] = reusable.get(disk)
+		archiver.submit(job)
 	else:
 		msg = 'bucket exists'
 		print(json.dumps({ 'user': user, 'namespace': namespace, 'msg': msg }))
@@ -359,11 +608,14 @@ for line in fileinput.input():
 		# only email if their bucket is already up there
 		subject = tmpl_subject.format(namespace + '.berkeley.edu')
 		url = gen_url(user, namespace)
-		body = tmpl_body.format(url)
+		body = (tmpl_dedup_body if args.dedup else tmpl_body).format(url)
 		recipient = email_from_user(user)
 		#recipient = 'rylo@berkeley.edu'
 		send_email(smtp_server, smtp_from, recipient, subject, body)
 		print(json.dumps({'user':user,'namespace':namespace,'msg':'emailsent'}))
 
+archiver.join()
 smtp_server.quit()
+print(client.report())
+print(operations.report())
 # vim:set ts=4 sw=4 noet:
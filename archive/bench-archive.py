@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+'''Compare the spooled and streaming archive paths on a synthetic home directory.
+
+The spooled path is what archive.py --spool does: tar czf into a scratch
+file, then read the whole file back to upload it. The streaming path pipes
+tar through a multi-core compressor straight into the upload. Without
+--bucket, uploads go to a sink that only counts bytes, so the numbers are
+about local disk and CPU; with --bucket, both paths really upload.
+
+	./bench-archive.py --size 500
+	./bench-archive.py --size 2000 --bucket some-scratch-bucket
+'''
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+from gcs_stream import stream_tar, resumable_upload, CODECS, CHUNK_SIZE
+
+def make_home(root, size_mb, seed=0):
+	'''Fill ROOT with about SIZE_MB of what student home directories hold:
+	   notebooks, CSV datasets, python files and some incompressible
+	   binaries such as images.'''
+	rng = random.Random(seed)
+	words = ['def', 'import', 'numpy', 'table', 'plot', 'for', 'return',
+		'print', 'data', 'sample', 'mean', 'x', 'y', 'self', 'None']
+	written = 0
+	n = 0
+	while written < size_mb * 1e6:
+		kind = rng.choice(['notebook', 'notebook', 'csv', 'py', 'py', 'binary'])
+		d = os.path.join(root, 'lab{:02d}'.format(n % 20))
+		if not os.path.isdir(d): os.makedirs(d)
+		if kind == 'notebook':
+			cells = [{'cell_type': 'code', 'source': ' '.join(rng.choice(words)
+				for i in range(200)), 'outputs': [{'data': {'image/png':
+				os.urandom(rng.randint(1000, 20000)).hex()}}]} for c in range(30)]
+			data = json.dumps({'cells': cells}).encode()
+			name = 'nb{}.ipynb'.format(n)
+		elif kind == 'csv':
+			data = '\n'.join(','.join(str(rng.randint(0, 10000)) for i in range(8))
+				for r in range(rng.randint(1000, 50000))).encode()
+			name = 'data{}.csv'.format(n)
+		elif kind == 'py':
+			data = '\n'.join(' '.join(rng.choice(words) for i in range(10))
+				for r in range(rng.randint(10, 500))).encode()
+			name = 'mod{}.py'.format(n)
+		else:
+			data = os.urandom(rng.randint(10000, 2000000))
+			name = 'img{}.png'.format(n)
+		with open(os.path.join(d, name), 'wb') as f:
+			f.write(data)
+		written += len(data)
+		n += 1
+	return written, n
+
+class counting_sink:
+	'''Stands in for an upload: counts bytes and drops them.'''
+
+	def __init__(self):
+		self.size = 0
+
+	def write(self, data):
+		self.size += len(data)
+
+	def close(self):
+		pass
+
+def bench_spool(root, source_dir, scratch, bucket):
+	path = os.path.join(scratch, 'spool.tar.gz')
+	start = time.time()
+	sp.run(['tar', 'czf', path, '-C', root, '--exclude=lost+found', source_dir],
+		check=True)
+	size = os.path.getsize(path)
+	if bucket is not None:
+		bucket.blob('bench-archive/spool.tar.gz').upload_from_filename(path)
+	else:
+		with open(path, 'rb') as f:
+			while f.read(CHUNK_SIZE): pass
+	elapsed = time.time() - start
+	os.remove(path)
+	return elapsed, size, size
+
+def bench_stream(root, source_dir, codec, threads, http, bucket_name):
+	if http is not None:
+		sink = resumable_upload(http, bucket_name,
+			'bench-archive/stream' + CODECS[codec][0], CODECS[codec][1])
+	else:
+		sink = counting_sink()
+	start = time.time()
+	size = stream_tar(root, source_dir, sink, codec=codec, threads=threads, sudo=False)
+	return time.time() - start, size, 0
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark archive tarball paths.')
+	parser.add_argument('--size', type=int, default=500,
+		help='megabytes of synthetic home directory (default %(default)s)')
+	parser.add_argument('--threads', type=int, default=os.cpu_count() or 1,
+		help='compression threads for the streaming path (default %(default)s)')
+	parser.add_argument('--codecs', nargs='+', default=['gzip', 'zstd'],
+		choices=sorted(CODECS))
+	parser.add_argument('--bucket', help='upload to this bucket instead of a counting sink')
+	parser.add_argument('--dir', help='directory for the synthetic home and scratch files')
+	args = parser.parse_args()
+
+	work = tempfile.mkdtemp(dir=args.dir)
+	try:
+		home = os.path.join(work, 'home')
+		written, files = make_home(home, args.size)
+		print('synthetic home: {} files, {:.0f} MB'.format(files, written / 1e6))
+
+		http = bucket = None
+		if args.bucket:
+			sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+			from google_api import api_client
+			from gcloud import storage
+			http = api_client().http()
+			bucket = storage.Client().bucket(args.bucket)
+
+		runs = [('spool gzip', lambda: bench_spool(work, 'home', work, bucket))]
+		for codec in args.codecs:
+			if codec == 'zstd' and not shutil.which('zstd'):
+				print('zstd not found; skipping')
+				continue
+			runs.append(('stream {} x{}'.format(codec, args.threads),
+				lambda codec=codec: bench_stream(work, 'home', codec, args.threads, http, args.bucket)))
+
+		print('{:<20} {:>8} {:>10} {:>8} {:>10} {:>12}'.format(
+			'path', 'seconds', 'MB', 'ratio', 'MB/s in', 'scratch MB'))
+		for name, run in runs:
+			elapsed, size, scratch = run()
+			print('{:<20} {:>8.2f} {:>10.1f} {:>8.2f} {:>10.1f} {:>12.1f}'.format(
+				name, elapsed, size / 1e6, written / size, written / 1e6 / elapsed,
+				scratch / 1e6))
+	finally:
+		shutil.rmtree(work)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+'''Content addressed archives, which store course files once per bucket.
+
+Every home directory holds its own copy of the course notebooks and
+datasets. In this mode a user's archive is a manifest plus a tarball of
+the files only that user has. Each regular file of at least MIN_BLOB_SIZE
+bytes is hashed, and if its content is shared, that is a known course
+file, a blob the bucket has already or a file another user's home
+directory held, the manifest records its path, metadata and SHA-256 while
+its content is stored gzipped as blobs/<sha256>.gz, once for the whole
+bucket. Everything else goes into the user's tarball. rebuild() puts the
+pieces back together as a normal tarball.
+
+Blobs are readable by the whole domain, since any number of users' archives
+may refer to one, which is why content only one user has never becomes a
+blob; manifests and tarballs stay readable by their user only.'''
+
+import contextlib
+import hashlib
+import os
+import stat
+import subprocess as sp
+import tarfile
+import tempfile
+import threading
+import zlib
+
+from gcs_stream import stream_tar, resumable_upload
+
+MIN_BLOB_SIZE = 256 * 1024
+BLOB_PREFIX = 'blobs/'
+MANIFEST_VERSION = 1
+READ_SIZE = 1024 * 1024
+
+class UnreadableTree(Exception):
+	pass
+
+def blob_name(digest):
+	return BLOB_PREFIX + digest + '.gz'
+
+def file_digest(path):
+	'''The SHA-256 of a file's content, in hex.'''
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while True:
+			data = f.read(READ_SIZE)
+			if not data: break
+			h.update(data)
+	return h.hexdigest()
+
+def split_tree(root, source_dir, min_size=MIN_BLOB_SIZE):
+	'''Walk ROOT/SOURCE_DIR and return (large, rest). LARGE lists (path,
+	   lstat) of the regular files of at least MIN_SIZE bytes that this
+	   process can read; REST lists every other path, directories
+	   included, parents before what is in them. Paths are relative to
+	   ROOT. Raise UnreadableTree if a directory cannot be listed, since
+	   tar would have to archive it whole.'''
+	def unreadable(e):
+		raise UnreadableTree('cannot list {}: {}'.format(e.filename, e.strerror))
+
+	large, rest = [], [source_dir]
+	top = os.path.join(root, source_dir)
+	for dirpath, dirnames, filenames in os.walk(top, onerror=unreadable):
+		if dirpath == top and 'lost+found' in dirnames:
+			dirnames.remove('lost+found')
+		rel = os.path.relpath(dirpath, root)
+		for name in dirnames:
+			rest.append(os.path.join(rel, name))
+		for name in filenames:
+			path = os.path.join(rel, name)
+			full = os.path.join(root, path)
+			st = os.lstat(full)
+			if (stat.S_ISREG(st.st_mode) and st.st_size >= min_size
+					and os.access(full, os.R_OK)):
+				large.append((path, st))
+			else:
+				rest.append(path)
+	return large, rest
+
+def course_digests(directories, min_size=MIN_BLOB_SIZE):
+	'''The SHA-256 of every regular file of at least MIN_SIZE bytes under
+	   DIRECTORIES, such as a checkout of the course materials or a
+	   mounted course disk.'''
+	digests = set()
+	for directory in directories:
+		for dirpath, dirnames, filenames in os.walk(directory):
+			for name in filenames:
+				path = os.path.join(dirpath, name)
+				st = os.lstat(path)
+				if stat.S_ISREG(st.st_mode) and st.st_size >= min_size:
+					digests.add(file_digest(path))
+	return digests
+
+class blob_store:
+	'''The blobs in a bucket. is_shared() decides which content becomes a
+	   blob and ensure() uploads it unless the bucket already has it. Safe
+	   to share between threads: two threads that find the same new
+	   content upload it once. BUCKET and HTTP return this thread's gcloud
+	   bucket and authorized connection. COURSE holds the digests of known
+	   course files.'''
+
+	def __init__(self, bucket, http, bucket_name, domain, course=()):
+		self.bucket = bucket
+		self.http = http
+		self.bucket_name = bucket_name
+		self.domain = domain
+		self.course = set(course)
+		self.lock = threading.Lock()
+		self.uploading = {}
+		self.owners = {}
+		self.stored = set()
+		for blob in bucket().list_blobs(prefix=BLOB_PREFIX):
+			self.stored.add(blob.name[len(BLOB_PREFIX):].split('.')[0])
+
+	def is_shared(self, digest, owner):
+		'''Whether content DIGEST, found in OWNER's home directory, is
+		   shared: a course file, a blob already, or content another owner
+		   had. Otherwise remember that OWNER has it, so that the next
+		   owner to have it shares it.'''
+		with self.lock:
+			if digest in self.course or digest in self.stored or digest in self.uploading:
+				return True
+			return self.owners.setdefault(digest, owner) != owner
+
+	def ensure(self, digest, path):
+		'''Make sure the bucket has the blob DIGEST, uploading it from PATH
+		   if nobody has. Return whether this call uploaded it.'''
+		while True:
+			with self.lock:
+				if digest in self.stored: return False
+				done = self.uploading.get(digest)
+				if done is None:
+					done = self.uploading[digest] = threading.Event()
+					break
+			# Someone else is uploading it; check again once they finish
+			done.wait()
+		try:
+			self._upload(digest, path)
+			with self.lock:
+				self.stored.add(digest)
+		finally:
+			with self.lock:
+				del self.uploading[digest]
+			done.set()
+		return True
+
+	def _upload(self, digest, path):
+		name = blob_name(digest)
+		upload = resumable_upload(self.http(), self.bucket_name, name,
+			'application/gzip')
+		compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+		h = hashlib.sha256()
+		with open(path, 'rb') as f:
+			while True:
+				data = f.read(READ_SIZE)
+				if not data: break
+				h.update(data)
+				upload.write(compressor.compress(data))
+		# Leave the upload unfinished, so no blob has the wrong content
+		if h.hexdigest() != digest:
+			raise Exception('{} changed while it was archived'.format(path))
+		upload.write(compressor.flush())
+		upload.close()
+		blob = self.bucket().blob(name)
+		blob.acl.domain(self.domain).grant_read()
+		blob.acl.save()
+
+def pack(root, source_dir, store, sink, owner, min_size=MIN_BLOB_SIZE,
+		codec='gzip', threads=1, sudo=True):
+	'''Archive ROOT/SOURCE_DIR, the home directory of OWNER, into STORE
+	   and SINK: files of at least MIN_SIZE bytes whose content STORE says
+	   is shared become blobs, and everything else is tarred and
+	   compressed with CODEC into SINK. Return the manifest, without the
+	   name of the tarball, which is up to the caller.'''
+	large, rest = split_tree(root, source_dir, min_size)
+	files = []
+	uploaded = 0
+	for path, st in large:
+		full = os.path.join(root, path)
+		try:
+			digest = file_digest(full)
+		except OSError:
+			# tar can read it as root
+			rest.append(path)
+			continue
+		if not store.is_shared(digest, owner):
+			rest.append(path)
+			continue
+		if store.ensure(digest, full):
+			uploaded += st.st_size
+		files.append({'path': path, 'sha256': digest, 'size': st.st_size,
+			'mode': stat.S_IMODE(st.st_mode), 'mtime': int(st.st_mtime),
+			'uid': st.st_uid, 'gid': st.st_gid})
+
+	with tempfile.NamedTemporaryFile() as listing:
+		listing.write(b''.join(os.fsencode(p) + b'\0' for p in rest))
+		listing.flush()
+		size = stream_tar(root, source_dir, sink, codec=codec, threads=threads,
+			sudo=sudo, files_from=listing.name)
+	return {
+		'version': MANIFEST_VERSION,
+		'codec': codec,
+		'blob_prefix': BLOB_PREFIX,
+		'files': files,
+		'tarball_size': size,
+		'blob_size': sum(f['size'] for f in files),
+		'uploaded_blob_size': uploaded,
+	}
+
+@contextlib.contextmanager
+def open_tarball(path, codec):
+	'''Read the tarball at PATH, compressed with CODEC, as a stream.'''
+	if codec == 'gzip':
+		with tarfile.open(path, 'r|gz') as tar:
+			yield tar
+		return
+	with open(path, 'rb') as f:
+		p = sp.Popen(['zstd', '-q', '-d', '-c'], stdin=f, stdout=sp.PIPE)
+		try:
+			with tarfile.open(fileobj=p.stdout, mode='r|') as tar:
+				yield tar
+		finally:
+			p.stdout.close()
+			if p.wait():
+				raise Exception('zstd exited {}'.format(p.returncode))
+
+def rebuild(manifest, tarball, open_blob, out):
+	'''Write the normal gzipped tarball that MANIFEST describes to OUT, a
+	   binary file. TARBALL is the path to the manifest's tarball and
+	   OPEN_BLOB returns a file of a blob's uncompressed content given its
+	   SHA-256.'''
+	if manifest.get('version') != MANIFEST_VERSION:
+		raise Exception('unknown manifest version {}'.format(manifest.get('version')))
+	with tarfile.open(fileobj=out, mode='w:gz') as dst:
+		with open_tarball(tarball, manifest['codec']) as src:
+			for member in src:
+				dst.addfile(member, src.extractfile(member) if member.isreg() else None)
+		for f in manifest['files']:
+			info = tarfile.TarInfo(f['path'])
+			info.size = f['size']
+			info.mode = f['mode']
+			info.mtime = f['mtime']
+			info.uid = f['uid']
+			info.gid = f['gid']
+			with open_blob(f['sha256']) as data:
+				dst.addfile(info, data)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+'''Stream a compressed tarball of a directory into Google Cloud Storage.
+
+tar writes to a compressor that uses several cores, pigz for gzip output or
+zstd, and the compressed stream goes up in chunks through a resumable
+upload. Nothing is written to local disk and nothing is read twice.'''
+
+import json
+import random
+import shutil
+import subprocess as sp
+import tempfile
+import time
+import urllib.parse
+
+# Chunks other than the last must be a multiple of 256 KiB
+CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_URL = 'https://www.googleapis.com/upload/storage/v1/b/{}/o?uploadType=resumable'
+RETRY_STATUSES = set([429, 500, 502, 503, 504])
+MAX_RETRIES = 8
+
+# codec: (object name suffix, content type)
+CODECS = {
+	'gzip': ('.tar.gz', 'application/gzip'),
+	'zstd': ('.tar.zst', 'application/zstd'),
+}
+
+class UploadError(Exception):
+	pass
+
+def compress_command(codec, threads):
+	'''The command compressing standard input with CODEC on THREADS cores.'''
+	if codec == 'zstd':
+		return ['zstd', '-q', '-c', '-T{}'.format(threads)]
+	if shutil.which('pigz'):
+		return ['pigz', '-c', '-p', str(threads)]
+	print('pigz not found; compressing with single-threaded gzip')
+	return ['gzip', '-c']
+
+def tar_command(root, source_dir, sudo=True, files_from=None):
+	'''The command writing a tarball of ROOT/SOURCE_DIR to standard output.
+	   With FILES_FROM, a file of NUL separated paths relative to ROOT,
+	   only those paths are archived, and directories without what is in
+	   them.'''
+	if files_from is not None:
+		cmd = ['tar', 'cf', '-', '-C', root, '--null', '--no-recursion',
+			'-T', files_from]
+	else:
+		cmd = ['tar', 'cf', '-', '-C', root, '--exclude=lost+found', source_dir]
+	return ['sudo'] + cmd if sudo else cmd
+
+class resumable_upload:
+	'''Upload an object of unknown size through a GCS resumable upload
+	   session, CHUNK_SIZE bytes at a time. Data stays buffered until the
+	   server acknowledges it, so transient errors resume from the last
+	   byte the server has rather than starting over.'''
+
+	def __init__(self, http, bucket, name, content_type, chunk_size=CHUNK_SIZE):
+		# httplib2 would follow the 308s that acknowledge each chunk
+		if hasattr(http, 'redirect_codes'):
+			http.redirect_codes = set(http.redirect_codes) - set([308])
+		self.http = http
+		self.chunk_size = chunk_size
+		self.buffer = bytearray()
+		self.offset = 0
+		self.session = self._start(bucket, name, content_type)
+
+	def _send(self, uri, method, body=None, headers=None):
+		'''Send a request, returning (status, response, content). Dropped
+		   connections come back as status None.'''
+		try:
+			resp, content = self.http.request(uri, method, body=body,
+				headers=headers or {})
+		except (OSError, IOError) as e:
+			return None, None, str(e).encode()
+		return resp.status, resp, content
+
+	def _backoff(self, attempt, status, content):
+		if attempt >= MAX_RETRIES:
+			raise UploadError('upload failed with HTTP {}: {}'.format(
+				status, content[:200]))
+		time.sleep(random.uniform(0, min(60, 2 ** attempt)))
+
+	def _start(self, bucket, name, content_type):
+		uri = UPLOAD_URL.format(urllib.parse.quote(bucket, safe=''))
+		body = json.dumps({'name': name, 'contentType': content_type})
+		headers = {'Content-Type': 'application/json; charset=UTF-8',
+			'X-Upload-Content-Type': content_type}
+		attempt = 0
+		while True:
+			status, resp, content = self._send(uri, 'POST', body, headers)
+			if status == 200:
+				return resp['location']
+			if status is not None and status not in RETRY_STATUSES:
+				raise UploadError('could not start upload of {}: HTTP {}: {}'.format(
+					name, status, content[:200]))
+			self._backoff(attempt, status, content)
+			attempt += 1
+
+	def _acknowledge(self, resp):
+		'''Drop the buffered bytes the server says it has, from the Range
+		   header of a 308.'''
+		acked = 0
+		if resp is not None and 'range' in resp:
+			acked = int(resp['range'].split('-')[-1]) + 1
+		if acked > self.offset:
+			del self.buffer[:acked - self.offset]
+			self.offset = acked
+
+	def _put(self, end, final):
+		'''Send buffered bytes up to the absolute offset END. With FINAL,
+		   this is the end of the object. Return the object's metadata once
+		   the upload is complete.'''
+		attempt = 0
+		total = str(end) if final else '*'
+		while True:
+			body = bytes(self.buffer[:end - self.offset])
+			if body:
+				content_range = 'bytes {}-{}/{}'.format(self.offset, end - 1, total)
+			else:
+				content_range = 'bytes */{}'.format(total)
+			status, resp, content = self._send(self.session, 'PUT', body,
+				{'Content-Range': content_range})
+			if status in (200, 201):
+				del self.buffer[:end - self.offset]
+				self.offset = end
+				return json.loads(content.decode())
+			if status == 308:
+				self._acknowledge(resp)
+				if not final and self.offset >= end:
+					return None
+				attempt = 0
+				continue
+			if status is not None and status not in RETRY_STATUSES:
+				raise UploadError('upload failed with HTTP {}: {}'.format(
+					status, content[:200]))
+			self._backoff(attempt, status, content)
+			attempt += 1
+			# Ask how much of the chunk arrived before sending the rest
+			status, resp, content = self._send(self.session, 'PUT', b'',
+				{'Content-Range': 'bytes */{}'.format(total)})
+			if status in (200, 201):
+				return json.loads(content.decode())
+			if status == 308:
+				self._acknowledge(resp)
+
+	def write(self, data):
+		self.buffer += data
+		while len(self.buffer) >= self.chunk_size:
+			self._put(self.offset + self.chunk_size, final=False)
+
+	def close(self):
+		'''Send what is left and finish the object. Return its metadata.'''
+		return self._put(self.offset + len(self.buffer), final=True)
+
+def stream_tar(root, source_dir, sink, codec='gzip', threads=1, sudo=True,
+		read_size=CHUNK_SIZE, files_from=None):
+	'''Tar ROOT/SOURCE_DIR, or the paths listed in FILES_FROM, compress it
+	   with CODEC on THREADS cores and write it to SINK, such as a
+	   resumable_upload. SINK is only closed if tar and the compressor both
+	   succeed, so a failed run never leaves a truncated object behind.
+	   Return the number of compressed bytes.'''
+	errors = tempfile.TemporaryFile()
+	tar = sp.Popen(tar_command(root, source_dir, sudo, files_from),
+		stdout=sp.PIPE, stderr=errors)
+	compress = sp.Popen(compress_command(codec, threads), stdin=tar.stdout,
+		stdout=sp.PIPE, stderr=errors)
+	# Let tar see a broken pipe if the compressor dies
+	tar.stdout.close()
+	size = 0
+	try:
+		while True:
+			data = compress.stdout.read(read_size)
+			if not data: break
+			sink.write(data)
+			size += len(data)
+		compress.wait()
+		tar.wait()
+		if tar.returncode or compress.returncode:
+			errors.seek(0)
+			raise Exception('tar exited {}, {} exited {}: {}'.format(
+				tar.returncode, compress.args[0], compress.returncode,
+				errors.read().decode(errors='replace').strip()[-500:]))
+		sink.close()
+	finally:
+		for p in [tar, compress]:
+			if p.poll() is None: p.kill()
+		errors.close()
+	return size
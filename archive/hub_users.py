@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+'''Map persistent volume claims to hub users.
+
+Each namespace's hub database is read once, and the pod name in every
+user's spawner state goes into a dict, so that looking up a claim costs
+nothing however many there are. The state is parsed in python, so sqlite
+needs no JSON extension.
+
+	for each namespace,
+	kubectl --namespace=<namespace> cp \\
+		hub-deployment-...:/srv/jupyterhub/jupyterhub.sqlite \\
+		~/jupyterhub-<namespace>.sqlite
+'''
+
+import contextlib
+import json
+import os
+import sqlite3
+import urllib.parse
+
+# sqlite db path template
+sqlite_tmpl = '/home/ryan/jupyterhub-{}.sqlite'
+
+def pod_from_claim(claim):
+	'''We infer the pod name from the claim: claim-<user>-NNN is mounted
+	   by jupyter-<user>-NNN.'''
+	return claim.replace('claim', 'jupyter', 1)
+
+def db_stamp(path):
+	'''What changes when the database at PATH is copied again.'''
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class hub_users:
+	'''The users of each namespace's hub, loaded from DB_TMPL the first
+	   time the namespace is asked about, and again if the database file
+	   has been replaced since, e.g. by a fresh kubectl cp.'''
+
+	def __init__(self, db_tmpl=sqlite_tmpl):
+		self.db_tmpl = db_tmpl
+		self.names = {}
+		self.pods = {}
+		self.errors = {}
+		self.stamps = {}
+
+	def load(self, ns):
+		path = self.db_tmpl.format(ns)
+		stamp = db_stamp(path)
+		if ns in self.stamps and self.stamps[ns] == stamp:
+			if ns in self.errors: raise self.errors[ns]
+			return
+		self.names.pop(ns, None)
+		self.pods.pop(ns, None)
+		self.errors.pop(ns, None)
+		self.stamps[ns] = stamp
+		names, pods = [], {}
+		# Read only, so that a missing database is an error, not a new file
+		uri = 'file:{}?mode=ro'.format(urllib.parse.quote(path))
+		try:
+			with contextlib.closing(sqlite3.connect(uri, uri=True)) as conn:
+				rows = conn.execute('select name, state from users').fetchall()
+		except sqlite3.Error as e:
+			self.errors[ns] = e
+			raise
+		for name, state in rows:
+			names.append(name)
+			try:
+				pod_name = json.loads(state or '{}').get('pod_name')
+			except (ValueError, AttributeError):
+				continue
+			if pod_name: pods[pod_name] = name
+		self.names[ns] = names
+		self.pods[ns] = pods
+
+	def users(self, ns):
+		'''Every user of the namespace's hub.'''
+		self.load(ns)
+		return self.names[ns]
+
+	def user_from_claim(self, ns, claim):
+		'''The user whose pod mounts CLAIM, or None.'''
+		self.load(ns)
+		return self.pods[ns].get(pod_from_claim(claim))
+
+	def resolve(self, claims):
+		'''Split CLAIMS, a list of (namespace, claim, pd), into
+		   (resolved, orphans). RESOLVED lists (namespace, claim, pd, user);
+		   ORPHANS lists (namespace, claim, pd, reason) for claims with no
+		   user, or whose namespace's database cannot be read.'''
+		resolved, orphans = [], []
+		for ns, claim, pd in claims:
+			try:
+				user = self.user_from_claim(ns, claim)
+			except sqlite3.Error as e:
+				orphans.append((ns, claim, pd, 'Could not read hub database: {}'.format(e)))
+				continue
+			if user is None:
+				orphans.append((ns, claim, pd,
+					'Could not resolve user from probably orphaned claim.'))
+			else:
+				resolved.append((ns, claim, pd, user))
+		return resolved, orphans
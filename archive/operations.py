@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+'''Wait for many Compute Engine operations at once.
+
+Rather than every waiting thread polling its own operation, one thread
+fetches every pending zone and global operation in batch requests, and
+wakes each waiter once its operation is done. Polls are frequent after an
+operation is added or one finishes, and back off while nothing changes, so
+the number of requests follows the operations in flight rather than the
+seconds spent waiting on each.'''
+
+import threading
+import time
+
+# Seconds between polls: right after a change, and at most
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 10.0
+BACKOFF = 1.5
+# Operations fetched per batch request
+BATCH_SIZE = 100
+
+class OperationError(Exception):
+	'''An operation finished with errors. OPERATION is the final
+	   operation and ERRORS its list of errors.'''
+
+	def __init__(self, operation, errors):
+		self.operation = operation
+		self.errors = errors
+		Exception.__init__(self, '{} {} failed: {}'.format(
+			operation.get('operationType', 'operation'),
+			operation.get('targetLink', operation.get('name', '')).split('/')[-1],
+			'; '.join('{}: {}'.format(e.get('code'), e.get('message'))
+				for e in errors)))
+
+def operation_zone(operation):
+	'''The zone of a zone operation, or None for a global one.'''
+	return operation['zone'].split('/')[-1] if operation.get('zone') else None
+
+class operation_tracker:
+	'''Waits for the operations of SERVICE, a compute service built by
+	   CLIENT, an api_client, in PROJECT. Safe to share between threads.'''
+
+	def __init__(self, client, service, project, min_interval=MIN_INTERVAL,
+			max_interval=MAX_INTERVAL, batch_size=BATCH_SIZE, timeout=3600):
+		self.client = client
+		self.service = service
+		self.project = project
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.timeout = timeout
+		budget = client.budgets.get('compute')
+		# A batch may not take more tokens than the budget ever holds
+		self.batch_size = min(batch_size, budget.burst) if budget else batch_size
+		self.budget = budget
+		self.cond = threading.Condition()
+		self.pending = {}
+		self.next_poll = 0
+		self.interval = min_interval
+		self.thread = None
+		self.stats = {'operations': 0, 'polls': 0, 'batches': 0, 'errors': 0}
+
+	def wait(self, operation, ignore=()):
+		'''Wait for OPERATION, as returned by the request that started it,
+		   and return it once it is done. Raise OperationError if it failed
+		   with errors whose codes are not all in IGNORE, and TimeoutError
+		   if it is still running after the tracker's timeout.'''
+		if operation.get('status') != 'DONE':
+			done = threading.Event()
+			entry = {'operation': operation, 'done': done}
+			with self.cond:
+				soon = time.time() + self.min_interval
+				if not self.pending or soon < self.next_poll:
+					self.next_poll = soon
+				self.pending[operation['name']] = entry
+				self.stats['operations'] += 1
+				self.interval = self.min_interval
+				if self.thread is None:
+					self.thread = threading.Thread(target=self._poll_forever,
+						name='operation-tracker', daemon=True)
+					self.thread.start()
+				self.cond.notify()
+			if not done.wait(self.timeout):
+				with self.cond:
+					self.pending.pop(operation['name'], None)
+				raise TimeoutError('operation {} timed out'.format(operation['name']))
+			operation = entry['operation']
+
+		errors = operation.get('error', {}).get('errors', [])
+		if any(e.get('code') not in ignore for e in errors):
+			raise OperationError(operation, errors)
+		return operation
+
+	def _poll_forever(self):
+		while True:
+			with self.cond:
+				while not self.pending or time.time() < self.next_poll:
+					if not self.pending:
+						self.cond.wait()
+					else:
+						self.cond.wait(self.next_poll - time.time())
+				operations = [e['operation'] for e in self.pending.values()]
+			try:
+				finished = self._poll(operations)
+			except Exception as e:
+				print('Could not poll operations: {}'.format(e))
+				finished = []
+			with self.cond:
+				for operation in finished:
+					entry = self.pending.pop(operation['name'], None)
+					if entry is None: continue
+					entry['operation'] = operation
+					entry['done'].set()
+				if finished:
+					self.interval = self.min_interval
+				else:
+					self.interval = min(self.max_interval, self.interval * BACKOFF)
+				self.next_poll = time.time() + self.interval
+
+	def _poll(self, operations):
+		'''Fetch OPERATIONS and return the ones that are done. Operations
+		   that could not be fetched are tried again on the next poll.'''
+		finished = []
+		def callback(request_id, response, exception):
+			if exception is not None:
+				with self.cond:
+					self.stats['errors'] += 1
+				print('Could not fetch operation {}: {}'.format(request_id, exception))
+			elif response.get('status') == 'DONE':
+				finished.append(response)
+
+		with self.cond:
+			self.stats['polls'] += 1
+		http = self.client.http()
+		for start in range(0, len(operations), self.batch_size):
+			chunk = operations[start:start + self.batch_size]
+			batch = self.service.new_batch_http_request(callback=callback)
+			for operation in chunk:
+				zone = operation_zone(operation)
+				if zone is None:
+					request = self.service.globalOperations().get(
+						project=self.project, operation=operation['name'])
+				else:
+					request = self.service.zoneOperations().get(
+						project=self.project, zone=zone, operation=operation['name'])
+				batch.add(request, request_id=operation['name'])
+			if self.budget is not None:
+				self.budget.take(len(chunk))
+			try:
+				batch.execute(http=http)
+			except Exception as e:
+				with self.cond:
+					self.stats['errors'] += 1
+				print('Could not poll {} operations: {}'.format(len(chunk), e))
+			with self.cond:
+				self.stats['batches'] += 1
+		return finished
+
+	def report(self):
+		'''One line of counters.'''
+		with self.cond:
+			return ('operations: {operations} waited on, {polls} polls, '
+				'{batches} batch requests, {errors} errors').format(**self.stats)
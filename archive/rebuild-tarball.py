@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+'''Rebuild a normal tarball from an archive made with archive.py --dedup.
+
+Such an archive is a manifest, a tarball of the files only its user had and
+shared blobs holding everything else. This downloads the three, checks each
+blob against its SHA-256 and writes a gzipped tarball of the whole home
+directory, like the ones archive.py makes without --dedup.
+
+	gcloud auth application-default login
+	./rebuild-tarball.py datahub-someone.manifest.json
+	./rebuild-tarball.py -o home.tar.gz ./datahub-someone.manifest.json
+'''
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from dedup import rebuild, blob_name, READ_SIZE
+
+DEFAULT_BUCKET = 'berkeley-dsep-2017-spring'
+DEFAULT_PROJECT = 'data-8'
+MANIFEST_SUFFIX = '.manifest.json'
+
+class blob_cache:
+	'''Downloads blobs into DIRECTORY, once each, and checks their content.'''
+
+	def __init__(self, bucket, directory):
+		self.bucket = bucket
+		self.directory = directory
+
+	def open(self, digest):
+		path = os.path.join(self.directory, digest)
+		if not os.path.exists(path):
+			with tempfile.TemporaryFile(dir=self.directory) as compressed:
+				self.bucket.blob(blob_name(digest)).download_to_file(compressed)
+				compressed.seek(0)
+				h = hashlib.sha256()
+				with gzip.GzipFile(fileobj=compressed) as src, open(path + '.tmp', 'wb') as dst:
+					while True:
+						data = src.read(READ_SIZE)
+						if not data: break
+						h.update(data)
+						dst.write(data)
+			if h.hexdigest() != digest:
+				os.remove(path + '.tmp')
+				raise Exception('blob {} is corrupt'.format(digest))
+			os.rename(path + '.tmp', path)
+		return open(path, 'rb')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Rebuild a tarball from a deduplicated archive.')
+	parser.add_argument('manifest',
+		help='manifest object in the bucket, or a downloaded manifest file')
+	parser.add_argument('-o', '--output',
+		help='tarball to write (default: the manifest name ending in .tar.gz)')
+	parser.add_argument('--bucket', default=DEFAULT_BUCKET,
+		help='bucket holding the archive (default %(default)s)')
+	parser.add_argument('--project', default=DEFAULT_PROJECT,
+		help='project billed for the downloads (default %(default)s)')
+	args = parser.parse_args()
+
+	from gcloud import storage
+	bucket = storage.Client(project=args.project).bucket(args.bucket)
+
+	if os.path.exists(args.manifest):
+		with open(args.manifest) as f:
+			manifest = json.load(f)
+	else:
+		manifest = json.loads(bucket.blob(args.manifest).download_as_string().decode())
+	name = os.path.basename(args.manifest)
+	if name.endswith(MANIFEST_SUFFIX):
+		name = name[:-len(MANIFEST_SUFFIX)]
+	output = args.output or name + '.tar.gz'
+
+	work = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+	try:
+		tarball = os.path.join(work, 'tarball')
+		with open(tarball, 'wb') as f:
+			bucket.blob(manifest['tarball']).download_to_file(f)
+		blobs = blob_cache(bucket, work)
+		with open(output + '.tmp', 'wb') as out:
+			rebuild(manifest, tarball, blobs.open, out)
+		os.rename(output + '.tmp', output)
+	finally:
+		shutil.rmtree(work)
+	print('wrote {}: {} files from shared blobs'.format(output, len(manifest['files'])))
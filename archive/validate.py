@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
-import sqlite3
 from gcloud import storage
 from gcloud.exceptions import NotFound
 
-sqlite_tmpl = '/home/ryan/jupyterhub-{}.sqlite'
+from hub_users import hub_users
+
 ns = 'stat28'
 ns = 'prob140'
 ns = 'datahub'
@@ -13,11 +13,7 @@ bucket_name = 'berkeley-dsep-2017-spring'
 gs_client = storage.Client()
 bucket = gs_client.get_bucket(bucket_name)
 
-conn = sqlite3.connect(sqlite_tmpl.format(ns))
-c = conn.cursor()
-
-c.execute('select name from users')
-users = list(map(lambda x: x[0], c.fetchall()))
+users = hub_users().users(ns)
 
 for user in users:
 	blob = bucket.blob('{}-{}.tar.gz'.format(ns, user))
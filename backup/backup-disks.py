@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 """ Primary Backup Logic"""
+import os
 import json
 import sys
 import time
@@ -8,65 +9,196 @@ import datetime
 import logging
 import argparse
 import subprocess
+import re
 
 from datetime import date
+
+# google_api is shared with the archive tools at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
 from settings import settings
-from googleapiclient import discovery
-from kubernetes_client import k8s_control
-from googleapiclient.errors import HttpError
-from oauth2client.client import GoogleCredentials
+from google_api import api_client, http_error
+from snapshot_engine import snapshot_engine, DEFAULT_CONCURRENCY
+from inventory import inventory, DEFAULT_INVENTORY_PATH
+from incremental import changed_disks
+from retention import snapshot_name, is_backup_snapshot, parse_policy, expired_snapshots, \
+	CREATED_BY_LABEL, DEFAULT_POLICY
+from restore import plan_restore, restore_engine, parse_point_in_time
+from fake_api import fake_compute, fake_k8s, fake_cluster
+from scheduler import backup_scheduler, DEFAULT_STATE_DIR
+from batch import bulk_create_disks, bulk_delete_snapshots, log_failures, DEFAULT_BATCH_SIZE
 from json.decoder import JSONDecodeError as JsonError
 
 SNAPSHOT_DATESTRING_LEN = 10
 DEFAULT_LOG_UPDATE_TIME = 10
+# Inventory entries younger than this are used without asking the APIs
+INVENTORY_FRESH = 10 * 60
+# Inventories are listed in full at least this often to notice deletions
+INVENTORY_MAX_AGE = 24 * 60 * 60
+# Share of disk creations that fail in --fake-api runs
+FAKE_FAILURE_RATE = 0.02
 
 logging.basicConfig(
 	format='%(asctime)s %(levelname)s %(message)s')
 backup_logger = logging.getLogger("backup")
 logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 
-def list_disks(compute, project, zone):
-	""" Lists all persistent disks used by project """
-	backup_logger.debug("Finding all disks for specified project")
-	all_disks = []
+# Partial responses: only the fields this script reads
+DISK_FIELDS = "nextPageToken,items(id,name,creationTimestamp,users,lastAttachTimestamp,lastDetachTimestamp)"
+SNAPSHOT_FIELDS = "nextPageToken,items(id,name,selfLink,creationTimestamp,sourceDisk,sourceDiskId,status,labels)"
+# Just enough to find the newest snapshot of each disk
+SNAPSHOT_TIME_FIELDS = "nextPageToken,items(sourceDiskId,creationTimestamp,status)"
+# Disk names per list request when listing disks or snapshots by disk name
+NAME_FILTER_CHUNK = 100
+
+def iter_disks(compute, project, zone, filter_expr=None, fields=DISK_FIELDS):
+	""" Yields the persistent disks used by project one page at a time,
+	optionally narrowed by the API filter FILTER_EXPR """
+	HttpError = http_error()
+	backup_logger.debug("Finding disks for specified project with filter %s", filter_expr)
+	request = compute.disks().list(project=project, zone=zone, filter=filter_expr, fields=fields)
 	try:
-		result = compute.disks().list(project=project, zone=zone).execute()
-		all_disks.extend(result['items'])
-
-		while 'nextPageToken' in result:
-			result = compute.disks().list(project=project, zone=zone, \
-				pageToken=result['nextPageToken']).execute()
-			all_disks.extend(result['items'])
+		while request is not None:
+			result = request.execute()
+			for disk in result.get('items', []):
+				yield disk
+			request = compute.disks().list_next(request, result)
 	except HttpError:
 		backup_logger.error("Error with HTTP request made to list_disks")
 		sys.exit(1)
 
-	return all_disks
 
-
-def list_snapshots(compute, project):
-	""" Lists all snapshots created for this project """
-	backup_logger.debug("Finding all snapshots for specified project")
-	all_snapshots = []
+def iter_snapshots(compute, project, filter_expr=None, fields=SNAPSHOT_FIELDS):
+	""" Yields the snapshots of this project one page at a time,
+	optionally narrowed by the API filter FILTER_EXPR """
+	HttpError = http_error()
+	backup_logger.debug("Finding snapshots for specified project with filter %s", filter_expr)
+	request = compute.snapshots().list(project=project, filter=filter_expr, fields=fields)
 	try:
-		result = compute.snapshots().list(project=project).execute()
-		all_snapshots.extend(result['items'])
-
-		while 'nextPageToken' in result:
-			result = compute.snapshots().list(project=project, \
-				pageToken=result['nextPageToken']).execute()
-			all_snapshots.extend(result['items'])
+		while request is not None:
+			result = request.execute()
+			for snapshot in result.get('items', []):
+				yield snapshot
+			request = compute.snapshots().list_next(request, result)
 	except HttpError:
 		backup_logger.error("Error with HTTP request made to list_snapshots")
 		sys.exit(1)
 
-	return all_snapshots
+
+def list_disks(compute, project, zone, filter_expr=None):
+	""" Lists all persistent disks used by project """
+	return list(iter_disks(compute, project, zone, filter_expr))
+
+
+def list_snapshots(compute, project, filter_expr=None):
+	""" Lists all snapshots created for this project """
+	return list(iter_snapshots(compute, project, filter_expr))
+
+
+def created_on_filter(days, negate=False):
+	""" Takes in DAYS, a list of dates, and returns an API filter matching
+	resources created on one of those days, or with NEGATE, on any other day.
+	Compute filters compare strings as regular expressions, so a range of
+	dates is written as an alternation """
+	dates = "|".join(sorted(set(str(day) for day in days)))
+	return "creationTimestamp %s '(%s)T.*'" % ("ne" if negate else "eq", dates)
+
+
+def retention_filter(retention_period):
+	""" Returns an API filter excluding snapshots created within the last
+	RETENTION_PERIOD days, by the same calendar-day rule as
+	filter_snapshots_by_time """
+	today = date.today()
+	return created_on_filter([today - datetime.timedelta(days=n)
+		for n in range(-1, retention_period + 1)], negate=True)
+
+
+def created_since_filter(start):
+	""" Returns an API filter matching resources created from the datetime
+	START until now. A day either side allows for timestamps carrying a
+	different UTC offset than the local clock """
+	first = start.date() - datetime.timedelta(days=1)
+	last = datetime.date.today() + datetime.timedelta(days=1)
+	return created_on_filter([first + datetime.timedelta(days=n)
+		for n in range((last - first).days + 1)])
+
+
+def refresh_inventory(compute, project, zone, inv):
+	""" Brings the disks and snapshots of the inventory INV up to date. Kinds
+	refreshed in the last INVENTORY_FRESH seconds are left alone, and others
+	only list what was created since their last refresh unless a full
+	listing is due """
+	listers = {
+		"disks": (inv.store_disks, lambda f: iter_disks(compute, project, zone, f)),
+		"snapshots": (inv.store_snapshots, lambda f: iter_snapshots(compute, project, f)),
+	}
+	for kind, (store, lister) in listers.items():
+		if inv.is_fresh(kind, INVENTORY_FRESH):
+			backup_logger.debug("Using inventory of %s as is", kind)
+		elif inv.needs_full_refresh(kind, INVENTORY_MAX_AGE):
+			backup_logger.debug("Listing all %s into the inventory", kind)
+			store(lister(None), full=True)
+		else:
+			_, last_refresh = inv.refreshed(kind)
+			backup_logger.debug("Listing %s created since the last inventory refresh", kind)
+			store(lister(created_since_filter(datetime.datetime.fromtimestamp(last_refresh))))
+
+
+def get_disk_names(k8s, inv, namespace):
+	""" Returns the GCE disk names behind the PVs of NAMESPACE, from the
+	inventory INV if it is fresh enough """
+	if inv is not None and inv.is_fresh("pvs:" + namespace, INVENTORY_FRESH):
+		return inv.pd_names(namespace)
+	mappings = k8s.get_volume_mappings([namespace])
+	if inv is not None:
+		inv.store_pvs(namespace, [(pv, claim, pd) for _, claim, pv, pd in mappings])
+	return [pd for _, _, _, pd in mappings]
+
+
+def snapshot_from_result(result):
+	""" Describes a snapshot from the result of the operation that created
+	it, with the fields --create-disk and the inventory use. Its creation
+	time is when the operation started, as incremental backups expect """
+	started = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=result['duration'])
+	return {
+		"name" : result['snapshot'],
+		"sourceDisk" : result['disk'],
+		"sourceDiskId" : result['target_id'],
+		"creationTimestamp" : started.astimezone().isoformat(),
+		"selfLink" : "global/snapshots/" + result['snapshot'],
+		"labels" : dict([CREATED_BY_LABEL])
+	}
+
+
+def names_filters(names, field="name", prefix="", chunk=NAME_FILTER_CHUNK):
+	""" Yields API filters matching resources whose FIELD is PREFIX followed
+	by one of NAMES, CHUNK names at a time so that no filter grows past the
+	length the API accepts. PREFIX is a regular expression """
+	names = sorted(set(names))
+	for start in range(0, len(names), chunk):
+		yield "%s eq '%s(%s)'" % (field, prefix,
+			"|".join(re.escape(n) for n in names[start:start + chunk]))
+
+
+def iter_disks_by_name(compute, project, zone, names):
+	""" Yields the disks named in NAMES, listing only those from the API """
+	for filter_expr in names_filters(names):
+		for disk in iter_disks(compute, project, zone, filter_expr):
+			yield disk
+
+
+def iter_snapshots_of_disks(compute, project, names, fields=SNAPSHOT_FIELDS):
+	""" Yields the snapshots whose source disk is named in NAMES """
+	for filter_expr in names_filters(names, "sourceDisk", ".*/disks/"):
+		for snapshot in iter_snapshots(compute, project, filter_expr, fields):
+			yield snapshot
 
 
 def filter_disks_by_name(disks, names):
 	""" Takes in NAMES, a predefined list of disks to snapshot, and filters 
 	disks to only returns those that are in NAMES """
 	backup_logger.debug("Filtering disks to match the given list of PV names")
+	names = set(names)
 	filtered_disks = []
 	for disk in disks:
 		try:
@@ -93,32 +225,9 @@ def filter_snapshots_by_time(snapshots, retention_period):
 	return old_snapshots
 
 
-def filter_snapshots_by_id(snapshots, snapshot_ids):
-	""" Takes in SNAPSHOT_IDS, a list of IDs corresponding to disks 
-	of which snapshots have been made, and filters SNAPSHOTS until
-	only those with corresponding IDs remain """
-	try:
-		snapshots_by_ids = list(filter(lambda snapshot: \
-			snapshot['sourceDiskId'] in snapshot_ids, snapshots))
-	except Exception:
-		backup_logger.error("Failed to filter snapshots by snapshot_ids")
-		sys.exit(1)
-	return snapshots_by_ids
-
-
-def create_snapshot_of_disk(compute, disk_name, project, zone, body):
-	""" Creates a snapshot of the provided disk """
-	backup_logger.debug("Creating snapshot for disk %s", disk_name)
-	try:
-		result = compute.disks().createSnapshot(disk=disk_name, project=project, zone=zone, body=body).execute()
-	except HttpError:
-		backup_logger.error("Error with HTTP Request made to create disk snapshot")
-		sys.exit(1)
-	return result
-
-
 def create_disk_from_snapshot(compute, new_disk_name, snapshot_url, project, zone):
 	""" Creates a new disk with NEW_DISK_NAME from the supplied SNAPSHOT_URL """
+	HttpError = http_error()
 	request_body = {
 		"kind" : "compute#disk",
 		"name" : new_disk_name,
@@ -135,6 +244,7 @@ def create_disk_from_snapshot(compute, new_disk_name, snapshot_url, project, zon
 
 def delete_snapshot(compute, project, snapshot_name):
 	""" Deletes a snapshot given its name """
+	HttpError = http_error()
 	backup_logger.debug("Deleting snapshot %s", snapshot_name)
 	try:
 		result = compute.snapshots().delete(project=project, snapshot=snapshot_name).execute()
@@ -181,13 +291,50 @@ if __name__ == "__main__":
 		"--create-disk", help="Automatically creates disks from recently created snapshots", action="store_true")
 	parser.add_argument(
 		"-d", "--delete", help="Specify the lifespan of a snapshot (in days) before eligible for deletion")
+	parser.add_argument(
+		"--retain", help="Delete the backup snapshots that a tiered policy does not keep, such as %s (the default)" \
+			% DEFAULT_POLICY, nargs="?", const=DEFAULT_POLICY)
 	parser.add_argument(
 		"-r", "--replace", help="Specify the persistent volume name and the new GCE PD disk to insert", nargs=2)
 	parser.add_argument(
         "-v", "--verbose", help="Show verbose output (debug)", action="store_true")
+	parser.add_argument(
+		"-j", "--concurrency", help="Number of snapshots to have in flight at once (default %d)" % DEFAULT_CONCURRENCY,
+		type=int, default=DEFAULT_CONCURRENCY)
+	parser.add_argument(
+		"--batch", help="Group snapshot and disk requests into batches of this size (default %d when given without a value)" \
+			% DEFAULT_BATCH_SIZE, type=int, nargs="?", const=DEFAULT_BATCH_SIZE, default=0)
+	parser.add_argument(
+		"--inventory", help="Keep a local inventory of disks, snapshots and PVs, optionally at this path (default %s)" \
+			% DEFAULT_INVENTORY_PATH, nargs="?", const=DEFAULT_INVENTORY_PATH)
+	parser.add_argument(
+		"-i", "--incremental", help="Only snapshot disks attached or detached since their newest snapshot", action="store_true")
+	parser.add_argument(
+		"--window", help="Spread snapshots over this many minutes, detached disks first, resuming leftovers on the next run",
+		type=float)
+	parser.add_argument(
+		"--rate", help="Limit Compute API requests made while snapshotting to this many per second", type=float)
+	parser.add_argument(
+		"--state", help="Where --window keeps the disks it did not get to (default %s/schedule-NAMESPACE.json)" \
+			% DEFAULT_STATE_DIR)
+	parser.add_argument(
+		"--restore", help="Restore every PV claimed in this namespace from its backup snapshots", metavar="NAMESPACE")
+	parser.add_argument(
+		"--restore-pvs", help="Restore these PVs from their backup snapshots", nargs="+", metavar="PV")
+	parser.add_argument(
+		"--at", help="Restore from the newest snapshots taken no later than this local time, such as 2017-03-04T12:00 (default now)")
+	parser.add_argument(
+		"--fake-api", help="Run against a fake cluster and project with this many volumes, to try out --restore",
+		type=int, metavar="N")
+	parser.add_argument(
+		"--claims", help="Print 'namespace claim pdName' for the PVs claimed in these namespaces, as archive.py expects",
+		nargs="+", metavar="NAMESPACE")
 	parser.add_argument(
 		"-t", "--test", help="Runs script in test mode; no real actions will be taken on your cluster", action="store_true")
 	args = parser.parse_args()
+	if args.fake_api and (args.backup or args.delete or args.retain):
+		parser.error("--fake-api only fakes what --restore, --restore-pvs and --claims need; "
+			"it cannot be used with --backup, --delete or --retain")
 	backup_logger.setLevel(logging.INFO)
 
 	# Instantiate objects, credentials, and clients
@@ -197,46 +344,109 @@ if __name__ == "__main__":
 		backup_logger.setLevel(logging.INFO)
 
 	options = settings()
-	k8s = k8s_control(args.cluster)
-	credentials = GoogleCredentials.get_application_default()
-	compute = discovery.build('compute', 'v1', credentials=credentials)
-
-	# Filter and retrieve necessary items from Google Cloud
-	all_disks = list_disks(compute, options.project_id, options.project_zone)
-	all_snapshots = list_snapshots(compute, options.project_id)
+	client = None
+	if args.fake_api:
+		backup_logger.info("Using a fake API with %d volumes instead of cluster %s", args.fake_api, args.cluster)
+		mappings, fake_disks, fake_snapshots = fake_cluster(args.restore or "fake", args.fake_api)
+		k8s = fake_k8s(mappings)
+		compute = fake_compute(fake_disks, fake_snapshots, failure_rate=FAKE_FAILURE_RATE)
+	else:
+		# The kubernetes client and Compute discovery are slow to load, so
+		# runs that do not need them, like --replace, skip them
+		k8s = None
+		compute = None
+		if args.backup or args.claims or args.restore or args.restore_pvs:
+			from kubernetes_client import k8s_control
+			k8s = k8s_control(args.cluster)
+		if args.backup or args.delete or args.retain or args.restore or args.restore_pvs:
+			client = api_client()
+			if args.rate:
+				client.set_rate('compute', args.rate)
+			compute = client.build('compute', 'v1')
+
+	if args.claims:
+		for namespace, claim, _, pd_name in sorted(k8s.get_volume_mappings(args.claims)):
+			print(namespace, claim, pd_name)
+		sys.exit(0)
+
+	# Items that failed, in runs that carry on past errors
+	failures = 0
+
+	inv = None
+	if args.inventory and not args.fake_api:
+		inv = inventory(args.inventory)
+		if args.backup or args.delete or args.retain or args.restore or args.restore_pvs:
+			refresh_inventory(compute, options.project_id, options.project_zone, inv)
 
 	# If specified, create snapshots of all eligible disks
 	if args.backup:
-		filtered_disks = filter_disks_by_name(all_disks, k8s.get_filtered_disk_names(args.backup))
-		backup_logger.info("Filtered %d disks out of %d total that are eligible for snapshotting",
-							len(filtered_disks), len(all_disks))
-
-		snapshot_ids = []
-		completed_snapshots = 0
-		start_time = time.time()
-		previous_log_time = time.time()
-
-		for disk in filtered_disks:
-			request_body = {
+		eligible_names = get_disk_names(k8s, inv, args.backup)
+		if inv is not None and args.incremental:
+			# Attach and detach times change without a disk being created,
+			# so an incremental run needs them as they are now, for its
+			# own disks only
+			filtered_disks = filter_disks_by_name(iter_disks_by_name(compute,
+				options.project_id, options.project_zone, eligible_names), eligible_names)
+			inv.store_disks(filtered_disks, mark=False)
+		elif inv is not None:
+			filtered_disks = inv.disks_by_names(eligible_names)
+		else:
+			filtered_disks = filter_disks_by_name(iter_disks_by_name(compute,
+				options.project_id, options.project_zone, eligible_names), eligible_names)
+		backup_logger.info("Filtered %d disks out of %d PVs that are eligible for snapshotting",
+							len(filtered_disks), len(eligible_names))
+
+		if args.incremental:
+			if inv is not None:
+				existing_snapshots = inv.snapshots()
+			else:
+				existing_snapshots = iter_snapshots_of_disks(compute, options.project_id,
+					[d['name'] for d in filtered_disks], fields=SNAPSHOT_TIME_FIELDS)
+			filtered_disks, skipped_disks = changed_disks(filtered_disks, existing_snapshots)
+			backup_logger.info("Skipping %d disks untouched since their last snapshot, %d left to snapshot",
+				len(skipped_disks), len(filtered_disks))
+
+		new_snapshots = []
+		failed_snapshots = []
+
+		snapshot_time = datetime.datetime.now()
+
+		def snapshot_body(disk):
+			return {
 				"kind" : "compute#snapshot",
-				"name" : disk['name'],
-				"id"   : disk['id']
+				"name" : snapshot_name(disk['name'], snapshot_time),
+				"labels" : dict([CREATED_BY_LABEL])
 			}
-			curr_iteration_time = time.time()
-			if curr_iteration_time - previous_log_time > DEFAULT_LOG_UPDATE_TIME:
-				previous_log_time = curr_iteration_time
-				backup_logger.info("%f seconds elapsed with %d out of %d disks successfully snapshotted", \
-						curr_iteration_time - start_time, completed_snapshots, len(filtered_disks))
 
-			if not args.test:
-				result = create_snapshot_of_disk(compute, disk['name'], options.project_id, options.project_zone, request_body)
-				completed_snapshots += 1
-				snapshot_ids.append(result['targetId'])
+		if not args.test:
+			engine = snapshot_engine(compute, options.project_id,
+				options.project_zone, args.concurrency, client=client)
+			start_time = time.time()
+			if args.window:
+				state_path = args.state or os.path.join(DEFAULT_STATE_DIR, "schedule-%s.json" % args.backup)
+				scheduler = backup_scheduler(engine, args.window * 60, state_path)
+				# Disks the window did not get to go first next run and are
+				# logged by the scheduler, not counted as failures
+				results, left = scheduler.run(filtered_disks, snapshot_body)
+			else:
+				results = engine.run(filtered_disks, snapshot_body, args.batch)
+			new_snapshots = [snapshot_from_result(r) for r in results if r['ok']]
+			failed_snapshots = [r for r in results if not r['ok']]
+			if inv is not None:
+				inv.store_snapshots(new_snapshots, mark=False)
+			durations = sorted(r['duration'] for r in results)
+			backup_logger.info("Snapshotted %d out of %d disks in %f seconds (%d failed)",
+				len(new_snapshots), len(filtered_disks), time.time() - start_time, len(failed_snapshots))
+			if durations:
+				backup_logger.info("Per-disk snapshot time: median %.1f seconds, max %.1f seconds",
+					durations[len(durations) // 2], durations[-1])
+			for result in failed_snapshots:
+				backup_logger.error("Snapshot of disk %s failed: %s", result['disk'], result['error'])
+			failures += len(failed_snapshots)
 
 		if args.create_disk:
-			backup_logger.info("Refreshing list of snapshots to create new disks")
-			all_snapshots = list_snapshots(compute, options.project_id)
-			filtered_snapshots_by_id = filter_snapshots_by_id(all_snapshots, snapshot_ids)
+			# The snapshot operations already told us what was created
+			filtered_snapshots_by_id = new_snapshots
 			backup_logger.info("Creating disks from %d new snapshots", len(filtered_snapshots_by_id))
 			today = datetime.datetime.now()
 			today_as_str = str(date(today.year, today.month, today.day))
@@ -245,6 +455,17 @@ if __name__ == "__main__":
 			start_time = time.time()
 			previous_log_time = time.time()
 
+			if args.batch and not args.test:
+				disks_to_create = [(snapshot['sourceDisk'].split('/')[-1] + '-' + today_as_str + '-snapshot',
+					snapshot['selfLink']) for snapshot in filtered_snapshots_by_id]
+				results = bulk_create_disks(compute, options.project_id, options.project_zone,
+					disks_to_create, args.batch, client)
+				failed = log_failures(results, "create disk")
+				failures += failed
+				backup_logger.info("Requested %d out of %d disks in %f seconds",
+					len(results) - failed, len(disks_to_create), time.time() - start_time)
+				filtered_snapshots_by_id = []
+
 			for snapshot in filtered_snapshots_by_id:
 				curr_iteration_time = time.time()
 				if curr_iteration_time - previous_log_time > DEFAULT_LOG_UPDATE_TIME:
@@ -258,26 +479,58 @@ if __name__ == "__main__":
 					create_disk_from_snapshot(compute, new_disk_name, snapshot['selfLink'], options.project_id, options.project_zone)
 					completed_disks += 1
 
-	# Delete all snapshots older than the specified number of days
-	if args.delete:
-		snapshots_to_delete = filter_snapshots_by_time(all_snapshots, int(args.delete))
-		backup_logger.info("Filtered %d snapshots out of %d total that are eligible for deletion",
-						len(snapshots_to_delete), len(all_snapshots))
+	# Delete backup snapshots older than the specified number of days, or
+	# those the retention policy does not keep
+	if args.delete or args.retain:
+		if args.retain:
+			try:
+				tiers = parse_policy(args.retain)
+			except ValueError as e:
+				backup_logger.error(str(e))
+				sys.exit(1)
+			if inv is not None:
+				old_snapshots = inv.snapshots()
+			else:
+				old_snapshots = list_snapshots(compute, options.project_id)
+			snapshots_to_delete = expired_snapshots(old_snapshots, tiers)
+		else:
+			if inv is not None:
+				cutoff = date.today() - datetime.timedelta(days=int(args.delete))
+				old_snapshots = inv.snapshots_created_before(str(cutoff))
+			else:
+				old_snapshots = list_snapshots(compute, options.project_id, retention_filter(int(args.delete)))
+			snapshots_to_delete = filter_snapshots_by_time(
+				[s for s in old_snapshots if is_backup_snapshot(s)], int(args.delete))
+		backup_logger.info("Filtered %d snapshots out of %d listed that are eligible for deletion",
+						len(snapshots_to_delete), len(old_snapshots))
 
 		completed_snapshot_deletions = 0
 		start_time = time.time()
 		previous_log_time = time.time() 
 
+		if args.batch and not args.test:
+			results = bulk_delete_snapshots(compute, options.project_id,
+				[snapshot['name'] for snapshot in snapshots_to_delete], args.batch, client)
+			failed = log_failures(results, "delete snapshot")
+			failures += failed
+			if inv is not None:
+				inv.forget_snapshots([name for name, (_, error) in results.items() if error is None])
+			backup_logger.info("Requested deletion of %d out of %d snapshots in %f seconds",
+				len(results) - failed, len(snapshots_to_delete), time.time() - start_time)
+			snapshots_to_delete = []
+
 		for snapshot in snapshots_to_delete:
 			current_iteration_time = time.time()
 			if current_iteration_time - previous_log_time > DEFAULT_LOG_UPDATE_TIME:
 				previous_log_time = current_iteration_time
 				backup_logger.info("%f seconds elapsed with %d out of %d snapshots successfully deleted", \
-						curr_iteration_time - start_time, completed_snapshot_deletions, len(snapshots_to_delete))
+						current_iteration_time - start_time, completed_snapshot_deletions, len(snapshots_to_delete))
 
 			if not args.test:
 				delete_snapshot(compute, options.project_id, snapshot['name'])
 				completed_snapshot_deletions += 1
+				if inv is not None:
+					inv.forget_snapshots([snapshot['name']])
 
 	# Replace a pre-existing PV's underlying GCE disk with a new one
 	if args.replace:
@@ -286,4 +539,49 @@ if __name__ == "__main__":
 		if not args.test:
 			replace_pv_with_snapshot_disk(pv_name, new_disk_name)
 
+	# Restore whole namespaces or lists of PVs from their backup snapshots
+	if args.restore or args.restore_pvs:
+		try:
+			at = parse_point_in_time(args.at) if args.at else datetime.datetime.now(datetime.timezone.utc)
+		except ValueError as e:
+			backup_logger.error(str(e))
+			sys.exit(1)
+		if args.restore:
+			mappings = k8s.get_volume_mappings([args.restore])
+		else:
+			wanted = set(args.restore_pvs)
+			mappings = [m for m in k8s.get_volume_mappings() if m[2] in wanted]
+			for pv_name in sorted(wanted - set(m[2] for m in mappings)):
+				backup_logger.error("PV %s is not bound to a claim on a GCE disk", pv_name)
+				failures += 1
+		backup_logger.info("Restoring %d volumes from backups taken no later than %s", len(mappings), at.isoformat())
+
+		pd_names = [m[3] for m in mappings]
+		if inv is not None:
+			disks = inv.disks_by_names(pd_names)
+			snapshots = inv.snapshots()
+		else:
+			disks = filter_disks_by_name(iter_disks_by_name(compute,
+				options.project_id, options.project_zone, pd_names), pd_names)
+			snapshots = list(iter_snapshots_of_disks(compute, options.project_id, pd_names))
+		items = plan_restore(mappings, disks, snapshots, at)
+
+		engine = snapshot_engine(compute, options.project_id,
+			options.project_zone, args.concurrency, client=client)
+		start_time = time.time()
+		restore_engine(engine, k8s).run(items, args.test)
+		restored = [item for item in items if item['ok']]
+		failed = [item for item in items if item['error'] is not None]
+		failures += len(failed)
+		if not args.test:
+			backup_logger.info("Restored %d out of %d volumes in %f seconds (%d failed)",
+				len(restored), len(items), time.time() - start_time, len(failed))
+
+	if client is not None and client.stats:
+		for line in client.report().splitlines():
+			backup_logger.info("API %s", line)
+
+	if failures:
+		backup_logger.error("Autobackup finished with %d failed items", failures)
+		sys.exit(1)
 	backup_logger.info("Autobackup successful with supplied parameters")
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+"""Bulk Compute API calls grouped into batch HTTP requests"""
+import logging
+import random
+import time
+
+from google_api import is_retryable, http_error
+
+DEFAULT_BATCH_SIZE = 100
+
+backup_logger = logging.getLogger("backup")
+
+def execute_batched(compute, requests, batch_size=DEFAULT_BATCH_SIZE, client=None):
+	""" Takes REQUESTS, a list of (key, HttpRequest) pairs, and sends them
+	BATCH_SIZE at a time as batch requests. Returns a dict mapping each
+	key to a (response, error) pair; an error in one item never stops
+	the others. With CLIENT, the google_api.api_client that built COMPUTE,
+	every item takes from the compute rate budget and items that fail
+	with transient errors are sent again with jittered exponential backoff """
+	HttpError = http_error()
+	results = {}
+	budget = client.budgets.get('compute') if client is not None else None
+	if budget is not None:
+		# A batch may not take more tokens than the budget ever holds
+		batch_size = min(batch_size, budget.burst)
+	max_retries = client.max_retries if client is not None else 0
+	pending = list(requests)
+	attempt = 0
+	while pending:
+		retry = []
+		for start in range(0, len(pending), batch_size):
+			chunk = pending[start:start + batch_size]
+
+			def callback(request_id, response, exception, chunk=chunk):
+				item = chunk[int(request_id)]
+				if exception is not None and attempt < max_retries and is_retryable(exception):
+					retry.append(item)
+				else:
+					results[item[0]] = (response, exception)
+
+			batch = compute.new_batch_http_request(callback=callback)
+			for i, (key, request) in enumerate(chunk):
+				batch.add(request, request_id=str(i))
+			if budget is not None:
+				budget.take(len(chunk))
+			try:
+				batch.execute(http=client.http() if client is not None else None)
+			except HttpError as e:
+				if attempt < max_retries and is_retryable(e):
+					retry.extend([item for item in chunk if item[0] not in results])
+					continue
+				backup_logger.error("Batch request of %d items failed: %s", len(chunk), e)
+				for key, _ in chunk:
+					results.setdefault(key, (None, e))
+		if not retry:
+			break
+		delay = random.uniform(0, min(client.max_delay, client.base_delay * 2 ** attempt))
+		backup_logger.debug("Retrying %d batched items in %.1f seconds", len(retry), delay)
+		time.sleep(delay)
+		attempt += 1
+		pending = retry
+	return results
+
+
+def log_failures(results, action):
+	""" Logs every failed item of RESULTS and returns how many failed """
+	failures = 0
+	for key, (response, error) in sorted(results.items()):
+		if error is not None:
+			failures += 1
+			backup_logger.error("Could not %s %s: %s", action, key, error)
+	return failures
+
+
+def bulk_create_snapshots(compute, project, zone, disks, body_for, batch_size=DEFAULT_BATCH_SIZE,
+		client=None):
+	""" Requests a snapshot of every disk in DISKS, using BODY_FOR(disk) as
+	the body. Returns disk name -> (operation, error) """
+	backup_logger.debug("Creating %d snapshots in batches of %d", len(disks), batch_size)
+	requests = [(disk['name'], compute.disks().createSnapshot(disk=disk['name'],
+		project=project, zone=zone, body=body_for(disk))) for disk in disks]
+	return execute_batched(compute, requests, batch_size, client)
+
+
+def bulk_delete_snapshots(compute, project, snapshot_names, batch_size=DEFAULT_BATCH_SIZE,
+		client=None):
+	""" Requests deletion of every snapshot in SNAPSHOT_NAMES. Returns
+	snapshot name -> (operation, error) """
+	backup_logger.debug("Deleting %d snapshots in batches of %d", len(snapshot_names), batch_size)
+	requests = [(name, compute.snapshots().delete(project=project, snapshot=name))
+		for name in snapshot_names]
+	return execute_batched(compute, requests, batch_size, client)
+
+
+def bulk_create_disks(compute, project, zone, disks_to_create, batch_size=DEFAULT_BATCH_SIZE,
+		client=None):
+	""" Takes DISKS_TO_CREATE, a list of (new disk name, snapshot url) pairs,
+	and requests each disk. Returns new disk name -> (operation, error) """
+	backup_logger.debug("Creating %d disks in batches of %d", len(disks_to_create), batch_size)
+	requests = []
+	for new_disk_name, snapshot_url in disks_to_create:
+		request_body = {
+			"kind" : "compute#disk",
+			"name" : new_disk_name,
+			"sourceSnapshot" : snapshot_url
+		}
+		requests.append((new_disk_name, compute.disks().insert(project=project,
+			zone=zone, body=request_body)))
+	return execute_batched(compute, requests, batch_size, client)
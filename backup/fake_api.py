@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+"""Stand-ins for the Compute and Kubernetes APIs, for restore test runs"""
+import datetime
+import random
+import threading
+import time
+import uuid
+
+class fake_request:
+
+	def __init__(self, respond, latency):
+		self.respond = respond
+		self.latency = latency
+
+
+	def execute(self, http=None):
+		time.sleep(self.latency)
+		return self.respond()
+
+
+class fake_compute:
+
+	"""Answers the Compute API calls backup-disks makes from in-memory
+	disks and snapshots. Each request takes LATENCY seconds, operations
+	finish on their first poll, and a FAILURE_RATE share of disk
+	insertions fail"""
+
+	def __init__(self, disks, snapshots, latency=0.05, failure_rate=0.0):
+		self.disk_list = disks
+		self.snapshot_list = snapshots
+		self.latency = latency
+		self.failure_rate = failure_rate
+		self.operations = {}
+		self.lock = threading.Lock()
+
+
+	def disks(self):
+		return self
+
+
+	def snapshots(self):
+		return _fake_snapshots(self)
+
+
+	def zoneOperations(self):
+		return self
+
+
+	def list(self, project, zone=None, filter=None, fields=None):
+		items = self.disk_list if zone is not None else self.snapshot_list
+		return fake_request(lambda: {"items": list(items)}, self.latency)
+
+
+	def list_next(self, request, result):
+		return None
+
+
+	def insert(self, project, zone, body):
+		def respond():
+			operation = {"name": "operation-" + uuid.uuid4().hex, "status": "DONE",
+				"targetId": str(random.getrandbits(63))}
+			if random.random() < self.failure_rate:
+				operation["error"] = {"errors": [{"code": "FAKE", "message": "fake failure"}]}
+			else:
+				with self.lock:
+					self.disk_list.append({"name": body['name'], "id": operation["targetId"]})
+			with self.lock:
+				self.operations[operation["name"]] = operation
+			return operation
+		return fake_request(respond, self.latency)
+
+
+	def get(self, project, zone, operation):
+		return fake_request(lambda: self.operations[operation], self.latency)
+
+
+class _fake_snapshots:
+
+	def __init__(self, compute):
+		self.compute = compute
+
+
+	def list(self, project, filter=None, fields=None):
+		return self.compute.list(project, filter=filter, fields=fields)
+
+
+	def list_next(self, request, result):
+		return None
+
+
+class fake_k8s:
+
+	"""Answers get_volume_mappings and records patch_pv_disk calls"""
+
+	def __init__(self, mappings, latency=0.05):
+		self.mappings = mappings
+		self.latency = latency
+		self.patched = {}
+
+
+	def get_volume_mappings(self, namespaces=None, label_selector=None):
+		return [m for m in self.mappings if namespaces is None or m[0] in namespaces]
+
+
+	def patch_pv_disk(self, pv_name, pd_name):
+		time.sleep(self.latency)
+		self.patched[pv_name] = pd_name
+
+
+def fake_cluster(namespace, count, days=14):
+	""" Returns (mappings, disks, snapshots) for COUNT volumes in NAMESPACE,
+	each with a daily backup snapshot for the last DAYS days """
+	now = datetime.datetime.now(datetime.timezone.utc)
+	mappings, disks, snapshots = [], [], []
+	for n in range(count):
+		pd_name = "gke-fake-pvc-%04d" % n
+		disk_id = str(1000000 + n)
+		mappings.append((namespace, "claim-%04d" % n, "pvc-%04d" % n, pd_name))
+		disks.append({"name": pd_name, "id": disk_id})
+		for day in range(days):
+			created = now - datetime.timedelta(days=day, minutes=random.randint(0, 60))
+			name = "%s-%s" % (pd_name, created.strftime("%Y%m%d-%H%M%S"))
+			snapshots.append({"name": name, "sourceDisk": pd_name, "sourceDiskId": disk_id,
+				"creationTimestamp": created.isoformat(), "status": "READY",
+				"selfLink": "global/snapshots/" + name, "labels": {"created-by": "backup-disks"}})
+	return mappings, disks, snapshots
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+"""Decides which disks could have changed since their last snapshot"""
+import logging
+
+from google_api import parse_timestamp
+
+backup_logger = logging.getLogger("backup")
+
+def newest_snapshots(snapshots):
+	""" Returns a dict mapping each source disk id to the creation time of
+	its newest usable snapshot in SNAPSHOTS """
+	newest = {}
+	for snapshot in snapshots:
+		if snapshot.get('status', 'READY') != 'READY':
+			continue
+		created = parse_timestamp(snapshot.get('creationTimestamp'))
+		disk_id = snapshot.get('sourceDiskId')
+		if created is None or disk_id is None:
+			continue
+		if disk_id not in newest or created > newest[disk_id]:
+			newest[disk_id] = created
+	return newest
+
+
+def needs_snapshot(disk, newest):
+	""" Whether DISK could have been written to since NEWEST, the creation
+	time of its newest snapshot, or None if it has none. A disk that is
+	attached now, or was attached or detached after that snapshot started,
+	may have changed """
+	if newest is None or disk.get('users'):
+		return True
+	for field in ('lastAttachTimestamp', 'lastDetachTimestamp'):
+		changed = parse_timestamp(disk.get(field))
+		if changed is not None and changed >= newest:
+			return True
+	return False
+
+
+def changed_disks(disks, snapshots):
+	""" Splits DISKS into those that need a new snapshot and those left
+	untouched since their newest snapshot in SNAPSHOTS """
+	newest = newest_snapshots(snapshots)
+	changed, skipped = [], []
+	for disk in disks:
+		if needs_snapshot(disk, newest.get(disk.get('id'))):
+			changed.append(disk)
+		else:
+			skipped.append(disk)
+	backup_logger.debug("%d of %d disks changed since their last snapshot",
+		len(changed), len(disks))
+	return changed, skipped
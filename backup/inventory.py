@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+"""Local SQLite inventory of disks, snapshots and PV mappings"""
+import json
+import logging
+import os
+import sqlite3
+import time
+
+backup_logger = logging.getLogger("backup")
+
+DEFAULT_INVENTORY_PATH = os.path.expanduser("~/.cache/backup-disks/inventory.sqlite")
+
+# Names per query, below SQLite's default limit of 999 parameters
+QUERY_CHUNK = 500
+
+SCHEMA = """
+create table if not exists disks (
+	name text primary key,
+	id text,
+	creation_timestamp text,
+	data text
+);
+create index if not exists disks_id on disks(id);
+
+create table if not exists snapshots (
+	name text primary key,
+	id text,
+	source_disk_id text,
+	source_disk text,
+	creation_timestamp text,
+	self_link text,
+	data text
+);
+create index if not exists snapshots_source_disk_id on snapshots(source_disk_id);
+create index if not exists snapshots_creation_timestamp on snapshots(creation_timestamp);
+
+create table if not exists pvs (
+	namespace text,
+	pv_name text,
+	claim text,
+	pd_name text
+);
+create index if not exists pvs_namespace on pvs(namespace);
+create index if not exists pvs_pd_name on pvs(pd_name);
+
+create table if not exists refreshes (
+	kind text primary key,
+	full_refresh real,
+	last_refresh real
+);
+"""
+
+class inventory:
+
+	"""Keeps disks, snapshots and PV to disk mappings between runs, so
+	that follow-up runs can look things up locally and only ask the APIs
+	for what changed since the last refresh"""
+
+	def __init__(self, path=DEFAULT_INVENTORY_PATH):
+		directory = os.path.dirname(path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.path = path
+		self.conn = sqlite3.connect(path)
+		self.conn.row_factory = sqlite3.Row
+		self.conn.executescript(SCHEMA)
+
+
+	def close(self):
+		self.conn.close()
+
+
+	def refreshed(self, kind):
+		""" Returns (time of last full refresh, time of last refresh) of
+		KIND, either of which is 0 if it never happened """
+		row = self.conn.execute("select full_refresh, last_refresh from refreshes where kind = ?",
+			(kind,)).fetchone()
+		if row is None:
+			return 0, 0
+		return row["full_refresh"] or 0, row["last_refresh"] or 0
+
+
+	def __mark_refreshed(self, kind, full, when):
+		full_refresh, _ = self.refreshed(kind)
+		if full:
+			full_refresh = when
+		self.conn.execute("insert or replace into refreshes values (?, ?, ?)",
+			(kind, full_refresh, when))
+
+
+	def needs_full_refresh(self, kind, max_age):
+		""" Whether KIND was last fully refreshed more than MAX_AGE seconds ago """
+		return time.time() - self.refreshed(kind)[0] > max_age
+
+
+	def is_fresh(self, kind, max_age):
+		""" Whether KIND was refreshed at all in the last MAX_AGE seconds """
+		return time.time() - self.refreshed(kind)[1] <= max_age
+
+
+	def store_disks(self, disks, full=False, mark=True):
+		""" Stores DISKS. With FULL, DISKS is everything there is and
+		disks not in it are forgotten. Without MARK, this is not counted
+		as a refresh, e.g. when storing a few disks listed by name """
+		started = time.time()
+		with self.conn:
+			if full:
+				self.conn.execute("delete from disks")
+			self.conn.executemany("insert or replace into disks values (?, ?, ?, ?)",
+				((d['name'], d.get('id'), d.get('creationTimestamp'), json.dumps(d)) for d in disks))
+			if mark:
+				self.__mark_refreshed("disks", full, started)
+
+
+	def store_snapshots(self, snapshots, full=False, mark=True):
+		""" Stores SNAPSHOTS. With FULL, SNAPSHOTS is everything there is
+		and snapshots not in it are forgotten. Without MARK, this is not
+		counted as a refresh, e.g. when storing operation results """
+		started = time.time()
+		with self.conn:
+			if full:
+				self.conn.execute("delete from snapshots")
+			self.conn.executemany("insert or replace into snapshots values (?, ?, ?, ?, ?, ?, ?)",
+				((s['name'], s.get('id'), s.get('sourceDiskId'), s.get('sourceDisk'),
+					s.get('creationTimestamp'), s.get('selfLink'), json.dumps(s)) for s in snapshots))
+			if mark:
+				self.__mark_refreshed("snapshots", full, started)
+
+
+	def forget_snapshots(self, names):
+		""" Removes snapshots that were deleted """
+		with self.conn:
+			self.conn.executemany("delete from snapshots where name = ?", ((n,) for n in names))
+
+
+	def store_pvs(self, namespace, mappings):
+		""" Replaces the PV mappings of NAMESPACE with MAPPINGS, a list of
+		(pv name, claim, pd name) """
+		with self.conn:
+			self.conn.execute("delete from pvs where namespace = ?", (namespace,))
+			self.conn.executemany("insert into pvs values (?, ?, ?, ?)",
+				((namespace, pv, claim, pd) for pv, claim, pd in mappings))
+			self.__mark_refreshed("pvs:" + namespace, True, time.time())
+
+
+	def disks(self):
+		return [json.loads(row["data"]) for row in self.conn.execute("select data from disks")]
+
+
+	def disks_by_names(self, names):
+		""" Returns the stored disks whose names are in NAMES, looked up
+		by the primary key QUERY_CHUNK names at a time """
+		names = sorted(set(names))
+		disks = []
+		for start in range(0, len(names), QUERY_CHUNK):
+			chunk = names[start:start + QUERY_CHUNK]
+			disks += [json.loads(row["data"]) for row in self.conn.execute(
+				"select data from disks where name in (%s)" % ",".join("?" * len(chunk)), chunk)]
+		return disks
+
+
+	def pd_names(self, namespace):
+		""" Returns the GCE disk names behind the PVs of NAMESPACE """
+		return [row["pd_name"] for row in self.conn.execute(
+			"select pd_name from pvs where namespace = ?", (namespace,))]
+
+
+	def snapshots(self):
+		return [json.loads(row["data"]) for row in self.conn.execute("select data from snapshots")]
+
+
+	def snapshots_created_before(self, date_string):
+		""" Returns snapshots whose creationTimestamp sorts before
+		DATE_STRING, such as 2017-03-04 """
+		return [json.loads(row["data"]) for row in self.conn.execute(
+			"select data from snapshots where creation_timestamp < ?", (date_string,))]
@@ -6,6 +6,8 @@ import sys
 
 from kubernetes import client, config
 
+PAGE_SIZE = 500
+
 backup_logger = logging.getLogger("backup")
 logging.getLogger("kubernetes")
 
@@ -47,29 +49,58 @@ class k8s_control:
 	def get_filtered_disk_names(self, namespace):
 		"""Takes filtered PVs and returns their associated GCE disk names"""
 		backup_logger.debug("Getting all GCE persistent disk names in namespace %s" % namespace)
-		filtered_disk_names = []
-		for disk in self.__get_filtered_pvs(namespace):
-			filtered_disk_names.append(disk.spec.gce_persistent_disk.pd_name)
-		return filtered_disk_names
-
-
-	def __get_filtered_pvs(self, namespace):
-		"""Return a list of Kubernetes persistent volumes belonging to NAMESPACE"""
-		pvs = self.v1.list_persistent_volume().items
-		eligible_pv_names = self.__get_pv_names_in_namespace(namespace)
-		backup_logger.debug("Filtering disks by persistent volume claims")
-
-		filtered_pvs = list(filter(lambda pv: \
-			pv.metadata.name in eligible_pv_names, pvs))
-		return filtered_pvs
-
-
-	def __get_pv_names_in_namespace(self, namespace):
-		"""Return a list of persistent volume claims belonging to the NAMESPACE"""
-		pv_names = []
-		backup_logger.debug("Getting all PV names from in namespace %s" % namespace)
-		pvcs_in_namespace = self.v1.list_namespaced_persistent_volume_claim(namespace=namespace).items
-
-		for pvc in pvcs_in_namespace:
-			pv_names.append(pvc.spec.volume_name)
-		return pv_names
+		return [pd_name for _, _, _, pd_name in self.get_volume_mappings([namespace])]
+
+
+	def get_volume_mappings(self, namespaces=None, label_selector=None):
+		"""Returns (namespace, claim, pv name, GCE disk name) for every GCE
+		backed PV bound to a claim in one of NAMESPACES, or in any namespace.
+		Claims and volumes are each listed once, page by page, and joined
+		through a dict keyed by volume name"""
+		if namespaces is not None and len(namespaces) == 1:
+			pvcs = self.__paginate(self.v1.list_namespaced_persistent_volume_claim,
+				namespace=namespaces[0], label_selector=label_selector)
+		else:
+			pvcs = self.__paginate(self.v1.list_persistent_volume_claim_for_all_namespaces,
+				label_selector=label_selector)
+			if namespaces is not None:
+				namespaces = set(namespaces)
+				pvcs = (pvc for pvc in pvcs if pvc.metadata.namespace in namespaces)
+
+		claims_by_volume = {}
+		for pvc in pvcs:
+			if pvc.spec.volume_name:
+				claims_by_volume[pvc.spec.volume_name] = (pvc.metadata.namespace, pvc.metadata.name)
+		backup_logger.debug("Found %d bound persistent volume claims" % len(claims_by_volume))
+
+		mappings = []
+		for pv in self.__paginate(self.v1.list_persistent_volume):
+			claim = claims_by_volume.get(pv.metadata.name)
+			if claim is None or pv.spec.gce_persistent_disk is None:
+				continue
+			mappings.append((claim[0], claim[1], pv.metadata.name,
+				pv.spec.gce_persistent_disk.pd_name))
+		return mappings
+
+
+	def patch_pv_disk(self, pv_name, pd_name):
+		"""Points the PV named PV_NAME at the GCE disk PD_NAME. Raises the
+		client's ApiException on failure so bulk callers can carry on"""
+		backup_logger.debug("Patching PV %s to use GCE disk %s" % (pv_name, pd_name))
+		body = {"spec": {"gcePersistentDisk": {"pdName": pd_name}}}
+		return self.v1.patch_persistent_volume(pv_name, body)
+
+
+	def __paginate(self, list_func, **kwargs):
+		"""Yields the items of a list call, PAGE_SIZE at a time"""
+		kwargs = dict((k, v) for k, v in kwargs.items() if v is not None)
+		_continue = None
+		while True:
+			if _continue:
+				kwargs["_continue"] = _continue
+			result = list_func(limit=PAGE_SIZE, **kwargs)
+			for item in result.items:
+				yield item
+			_continue = result.metadata._continue
+			if not _continue:
+				break
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+"""Bulk restore: new disks from backup snapshots, and PVs pointed at them"""
+import datetime
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google_api import parse_timestamp
+from retention import snapshot_name, is_backup_snapshot
+from snapshot_engine import progress_log
+
+backup_logger = logging.getLogger("backup")
+
+TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+def parse_point_in_time(text):
+	""" Parses a local time such as 2017-03-04 or 2017-03-04T12:00 into an
+	aware datetime. A bare date means the end of that day """
+	for fmt in TIME_FORMATS:
+		try:
+			parsed = datetime.datetime.strptime(text, fmt)
+		except ValueError:
+			continue
+		if fmt == "%Y-%m-%d":
+			parsed += datetime.timedelta(days=1, microseconds=-1)
+		return parsed.astimezone()
+	raise ValueError("Cannot read %r as a point in time, such as 2017-03-04T12:00" % text)
+
+
+def snapshots_by_disk(snapshots, at):
+	""" Returns a dict mapping each source disk id to its newest ready
+	backup snapshot created no later than AT """
+	chosen = {}
+	for snapshot in snapshots:
+		if not is_backup_snapshot(snapshot) or snapshot.get('status', 'READY') != 'READY':
+			continue
+		created = parse_timestamp(snapshot.get('creationTimestamp'))
+		disk_id = snapshot.get('sourceDiskId')
+		if created is None or created > at:
+			continue
+		if disk_id not in chosen or created > chosen[disk_id][0]:
+			chosen[disk_id] = (created, snapshot)
+	return dict((disk_id, snapshot) for disk_id, (_, snapshot) in chosen.items())
+
+
+def plan_restore(mappings, disks, snapshots, at, restore_time=None):
+	""" Takes MAPPINGS, (namespace, claim, pv name, pd name) of the volumes
+	to restore, the DISKS and SNAPSHOTS of the project, and returns one
+	item per volume naming the snapshot to restore and the disk to create.
+	Volumes without a usable snapshot carry an error instead """
+	if restore_time is None:
+		restore_time = datetime.datetime.now()
+	disk_ids = dict((d['name'], d.get('id')) for d in disks)
+	chosen = snapshots_by_disk(snapshots, at)
+	items = []
+	for namespace, claim, pv_name, pd_name in mappings:
+		item = {"namespace": namespace, "claim": claim, "pv": pv_name, "old_disk": pd_name,
+			"snapshot": None, "new_disk": None, "ok": False, "error": None, "stage": "planned"}
+		snapshot = chosen.get(disk_ids.get(pd_name))
+		if pd_name not in disk_ids:
+			item["error"] = "disk %s not found" % pd_name
+		elif snapshot is None:
+			item["error"] = "no backup snapshot of %s before %s" % (pd_name, at.isoformat())
+		else:
+			item["snapshot"] = snapshot
+			item["new_disk"] = snapshot_name(pd_name, restore_time)
+		items.append(item)
+	return items
+
+
+class restore_engine:
+
+	"""Restores many volumes in parallel through ENGINE, a snapshot_engine
+	whose operation polling it shares, and K8S,
+	a k8s_control used to patch the PVs"""
+
+	def __init__(self, engine, k8s):
+		self.engine = engine
+		self.k8s = k8s
+
+
+	def restore_volume(self, item):
+		""" Creates the new disk of ITEM from its snapshot, waits for it
+		and patches the PV. Records the outcome in ITEM and returns it """
+		start = time.time()
+		compute = self.engine.compute
+		body = {
+			"kind" : "compute#disk",
+			"name" : item["new_disk"],
+			"sourceSnapshot" : item["snapshot"]['selfLink']
+		}
+		try:
+			item["stage"] = "creating disk"
+			operation = self.engine.execute(compute.disks().insert(project=self.engine.project,
+				zone=self.engine.zone, body=body))
+			operation = self.engine.wait_for_operation(operation)
+			if 'error' in operation:
+				raise RuntimeError("; ".join(e.get('message', e.get('code', ''))
+					for e in operation['error'].get('errors', [])))
+			item["stage"] = "patching PV"
+			self.k8s.patch_pv_disk(item["pv"], item["new_disk"])
+			item["stage"] = "done"
+			item["ok"] = True
+		except Exception as e:
+			# HttpError, TimeoutError, operation errors and ApiException alike
+			item["error"] = str(e)
+		item["duration"] = time.time() - start
+		return item
+
+
+	def run(self, items, test=False):
+		""" Restores every planned item in ITEMS in parallel, logging each
+		volume as it finishes. With TEST, only logs what would be done """
+		todo = [item for item in items if item["error"] is None]
+		for item in items:
+			if item["error"] is not None:
+				backup_logger.error("Cannot restore PV %s (%s/%s): %s", item["pv"],
+					item["namespace"], item["claim"], item["error"])
+		if test:
+			for item in todo:
+				backup_logger.info("Would restore PV %s (%s/%s) from snapshot %s to new disk %s",
+					item["pv"], item["namespace"], item["claim"], item["snapshot"]['name'], item["new_disk"])
+			return items
+
+		progress = progress_log(len(todo), "volumes restored")
+		done = 0
+		with ThreadPoolExecutor(max_workers=self.engine.concurrency) as pool:
+			futures = [pool.submit(self.restore_volume, item) for item in todo]
+			for future in as_completed(futures):
+				item = future.result()
+				done += 1
+				if item["ok"]:
+					backup_logger.info("[%d/%d] Restored PV %s (%s/%s) to disk %s from %s in %.1f seconds",
+						done, len(todo), item["pv"], item["namespace"], item["claim"],
+						item["new_disk"], item["snapshot"]['name'], item["duration"])
+				else:
+					backup_logger.error("[%d/%d] Failed to restore PV %s (%s/%s) while %s: %s",
+						done, len(todo), item["pv"], item["namespace"], item["claim"],
+						item["stage"], item["error"])
+				progress.update(done)
+		return items
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+"""Tiered snapshot retention: which backup snapshots to keep and which to delete"""
+import datetime
+import hashlib
+import logging
+
+from google_api import parse_timestamp
+
+backup_logger = logging.getLogger("backup")
+
+# Snapshots this tool creates carry this label, so pruning leaves others alone
+CREATED_BY_LABEL = ("created-by", "backup-disks")
+
+# (month, day) each term starts on, in order through the year
+TERM_STARTS = [((1, 1), "spring"), ((5, 20), "summer"), ((8, 15), "fall")]
+
+DEFAULT_POLICY = "daily=7,weekly=8,term=6"
+
+# Snapshot names are at most 63 characters
+MAX_NAME_LEN = 63
+
+def snapshot_name(disk_name, when):
+	""" Returns a unique name for a snapshot of DISK_NAME taken at the
+	datetime WHEN. Long disk names are shortened, with a hash of the full
+	name so that disks sharing a prefix do not collide """
+	suffix = when.strftime("%Y%m%d-%H%M%S")
+	if len(disk_name) + len(suffix) + 1 > MAX_NAME_LEN:
+		digest = hashlib.sha1(disk_name.encode()).hexdigest()[:8]
+		disk_name = disk_name[:MAX_NAME_LEN - len(suffix) - len(digest) - 2].rstrip("-") + "-" + digest
+	return disk_name + "-" + suffix
+
+
+def is_backup_snapshot(snapshot):
+	""" Whether SNAPSHOT was made by this tool: labelled as such, or from
+	before labels, named exactly after its source disk """
+	key, value = CREATED_BY_LABEL
+	if snapshot.get('labels', {}).get(key) == value:
+		return True
+	source_disk = snapshot.get('sourceDisk')
+	return source_disk is not None and snapshot['name'] == source_disk.split('/')[-1]
+
+
+def term_index(day):
+	""" Numbers terms consecutively across years """
+	index = 0
+	for n, (start, _) in enumerate(TERM_STARTS):
+		if (day.month, day.day) >= start:
+			index = n
+	return day.year * len(TERM_STARTS) + index
+
+
+TIERS = {
+	"daily": lambda day: day.toordinal(),
+	"weekly": lambda day: day.toordinal() // 7,
+	"monthly": lambda day: day.year * 12 + day.month,
+	"term": term_index,
+}
+
+def parse_policy(policy):
+	""" Parses a policy such as "daily=7,weekly=8,term=6" into a list of
+	(tier, bucket function, number of buckets) """
+	tiers = []
+	for part in policy.split(","):
+		try:
+			name, count = part.strip().split("=")
+			tiers.append((name, TIERS[name], int(count)))
+		except (KeyError, ValueError):
+			raise ValueError("Invalid retention tier %r; expected one of %s followed by =N" \
+				% (part, ", ".join(sorted(TIERS))))
+	return tiers
+
+
+def expired_snapshots(snapshots, tiers, now=None):
+	""" Returns the snapshots in SNAPSHOTS that no tier keeps. A tier keeps
+	the newest snapshot of each source disk in each of its last N buckets,
+	counting the bucket of NOW. The newest snapshot of every disk, snapshots
+	not yet ready and snapshots not made by this tool are always kept.
+	Everything is decided in one pass over the snapshots, sorted by disk
+	and newest first """
+	if now is None:
+		now = datetime.datetime.now(datetime.timezone.utc)
+	today = now.astimezone().date()
+	current = [(name, bucket, count, bucket(today)) for name, bucket, count in tiers]
+
+	dated = []
+	for snapshot in snapshots:
+		if not is_backup_snapshot(snapshot) or snapshot.get('status', 'READY') != 'READY':
+			continue
+		created = parse_timestamp(snapshot.get('creationTimestamp'))
+		if created is None or snapshot.get('sourceDiskId') is None:
+			continue
+		dated.append((snapshot['sourceDiskId'], created, snapshot))
+	dated.sort(key=lambda d: (d[0], d[1]), reverse=True)
+
+	doomed = []
+	disk_id = None
+	for source_disk_id, created, snapshot in dated:
+		if source_disk_id != disk_id:
+			# Newest snapshot of the next disk
+			disk_id = source_disk_id
+			kept = set((name, bucket(created.astimezone().date())) for name, bucket, _, _ in current)
+			continue
+		day = created.astimezone().date()
+		keep = False
+		for name, bucket, count, now_bucket in current:
+			b = bucket(day)
+			if now_bucket - b < count and (name, b) not in kept:
+				kept.add((name, b))
+				keep = True
+		if not keep:
+			doomed.append(snapshot)
+	backup_logger.debug("Retention keeps %d and deletes %d of %d backup snapshots",
+		len(dated) - len(doomed), len(doomed), len(dated))
+	return doomed
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+"""Spreads snapshots over a time window, detached disks first"""
+import json
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from snapshot_engine import progress_log
+
+backup_logger = logging.getLogger("backup")
+
+DEFAULT_STATE_DIR = os.path.expanduser("~/.cache/backup-disks")
+
+def disk_priority(disk):
+	""" Sort key putting detached disks before attached ones, which are
+	being used and whose snapshots compete with the student's I/O. Among
+	attached disks, those attached longest ago go first """
+	attached = bool(disk.get('users'))
+	return (attached, disk.get('lastAttachTimestamp', '') if attached else '', disk['name'])
+
+
+class backup_scheduler:
+
+	"""Snapshots disks through ENGINE at an even pace over WINDOW seconds.
+	Disks not started when the window ends, and disks whose snapshot
+	failed, are written to STATE_PATH and go first on the next run"""
+
+	def __init__(self, engine, window, state_path):
+		self.engine = engine
+		self.window = window
+		self.state_path = state_path
+
+
+	def load_pending(self):
+		""" Returns the disk names left over from the previous run """
+		try:
+			with open(self.state_path) as f:
+				return json.load(f).get("pending", [])
+		except FileNotFoundError:
+			return []
+		except ValueError:
+			backup_logger.error("Ignoring unreadable schedule state %s", self.state_path)
+			return []
+
+
+	def save_pending(self, names):
+		""" Records NAMES for the next run, or clears the state if there
+		are none """
+		if not names:
+			if os.path.exists(self.state_path):
+				os.remove(self.state_path)
+			return
+		directory = os.path.dirname(self.state_path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		with open(self.state_path + ".tmp", "w") as f:
+			json.dump({"pending": sorted(names), "saved": time.time()}, f)
+		os.rename(self.state_path + ".tmp", self.state_path)
+
+
+	def order(self, disks):
+		""" Returns DISKS in the order to snapshot them: leftovers from an
+		unfinished window first, then by disk_priority """
+		pending = set(self.load_pending())
+		if pending:
+			backup_logger.info("Resuming %d disks left over from the previous window",
+				len(pending & set(d['name'] for d in disks)))
+		return sorted(disks, key=lambda d: (d['name'] not in pending, disk_priority(d)))
+
+
+	def run(self, disks, body_for):
+		""" Snapshots DISKS, using BODY_FOR(disk) as the request body, and
+		returns (results, names of the disks not started in the window) """
+		ordered = self.order(disks)
+		start_time = time.time()
+		deadline = start_time + self.window
+		interval = self.window / len(ordered) if ordered else 0
+
+		def snapshot(disk):
+			# Queued behind busy workers past the end of the window
+			if time.time() >= deadline:
+				return None
+			return self.engine.snapshot_disk(disk, body_for(disk))
+
+		results = []
+		left = []
+		progress = progress_log(len(ordered), "disks snapshotted")
+		with ThreadPoolExecutor(max_workers=self.engine.concurrency) as pool:
+			futures = {}
+			for n, disk in enumerate(ordered):
+				delay = start_time + n * interval - time.time()
+				if delay > 0:
+					time.sleep(delay)
+				futures[pool.submit(snapshot, disk)] = disk
+			for future in as_completed(futures):
+				result = future.result()
+				if result is None:
+					left.append(futures[future]['name'])
+					continue
+				results.append(result)
+				if not result["ok"]:
+					backup_logger.error("Failed to snapshot disk %s after %.1f seconds: %s",
+						result["disk"], result["duration"], result["error"])
+				progress.update(len(results))
+
+		failed = [r["disk"] for r in results if not r["ok"]]
+		self.save_pending(left + failed)
+		if left:
+			backup_logger.info("Window ended with %d disks not started; they go first next run", len(left))
+		return results, left
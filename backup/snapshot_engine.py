@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+"""Parallel snapshot creation, following each zone operation to completion"""
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from batch import bulk_create_snapshots
+from google_api import http_error
+
+backup_logger = logging.getLogger("backup")
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_LOG_UPDATE_TIME = 10
+MAX_POLL_INTERVAL = 10
+
+class progress_log:
+
+	"""Logs how many of TOTAL items are DONE_WHAT, such as "disks
+	snapshotted", at most every INTERVAL seconds"""
+
+	def __init__(self, total, done_what, interval=DEFAULT_LOG_UPDATE_TIME):
+		self.total = total
+		self.done_what = done_what
+		self.interval = interval
+		self.start_time = self.previous_log_time = time.time()
+
+
+	def update(self, done):
+		current_time = time.time()
+		if current_time - self.previous_log_time > self.interval:
+			self.previous_log_time = current_time
+			backup_logger.info("%f seconds elapsed with %d out of %d %s", \
+				current_time - self.start_time, done, self.total, self.done_what)
+
+
+class snapshot_engine:
+
+	"""Submits snapshots of many disks with at most CONCURRENCY requests
+	in flight, waits for every zone operation to finish, and records the
+	outcome and duration of each disk. CLIENT is the google_api.api_client
+	that built COMPUTE, which batches take their rate budget from"""
+
+	def __init__(self, compute, project, zone,
+			concurrency=DEFAULT_CONCURRENCY, timeout=3600, client=None):
+		self.compute = compute
+		self.client = client
+		self.project = project
+		self.zone = zone
+		self.concurrency = concurrency
+		self.timeout = timeout
+
+
+	def execute(self, request):
+		""" Executes REQUEST. Services built by google_api.api_client give
+		each thread its own connection and retry transient errors """
+		return request.execute()
+
+
+	def wait_for_operation(self, operation):
+		""" Polls a zone operation until it is DONE, backing off up to
+		MAX_POLL_INTERVAL seconds, and returns the final operation """
+		interval = 1
+		start = time.time()
+		while operation['status'] != 'DONE':
+			if time.time() - start > self.timeout:
+				raise TimeoutError("Operation %s timed out" % operation['name'])
+			time.sleep(interval)
+			interval = min(interval * 2, MAX_POLL_INTERVAL)
+			operation = self.execute(self.compute.zoneOperations().get(project=self.project,
+				zone=self.zone, operation=operation['name']))
+		return operation
+
+
+	def snapshot_disk(self, disk, body):
+		""" Snapshots DISK and waits for it. Returns a result describing
+		the outcome rather than raising, so one disk cannot stop the rest """
+		HttpError = http_error()
+		start = time.time()
+		try:
+			operation = self.execute(self.compute.disks().createSnapshot(disk=disk['name'],
+				project=self.project, zone=self.zone, body=body))
+		except HttpError as e:
+			return self.follow(disk['name'], body, None, e, start)
+		return self.follow(disk['name'], body, operation, None, start)
+
+
+	def follow(self, disk_name, body, operation, error, start):
+		""" Waits for an operation submitted elsewhere, such as in a batch,
+		and returns the same kind of result as snapshot_disk """
+		HttpError = http_error()
+		result = {"disk": disk_name, "snapshot": body['name'], "ok": False,
+			"error": None, "target_id": None}
+		if error is not None:
+			result["error"] = str(error)
+			result["duration"] = time.time() - start
+			return result
+		try:
+			operation = self.wait_for_operation(operation)
+			if 'error' in operation:
+				result["error"] = "; ".join(e.get('message', e.get('code', ''))
+					for e in operation['error'].get('errors', []))
+			else:
+				result["ok"] = True
+				result["target_id"] = operation.get('targetId')
+		except (HttpError, TimeoutError) as e:
+			result["error"] = str(e)
+		result["duration"] = time.time() - start
+		return result
+
+
+	def run(self, disks, body_for, batch_size=0):
+		""" Snapshots every disk in DISKS in parallel, using BODY_FOR(disk)
+		as the request body, and returns the results in completion order.
+		With BATCH_SIZE, the snapshots are requested in batches first and
+		only the waiting is done in parallel """
+		results = []
+		progress = progress_log(len(disks), "disks snapshotted")
+		with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+			if batch_size:
+				start = time.time()
+				submitted = bulk_create_snapshots(self.compute, self.project, self.zone,
+					disks, body_for, batch_size, self.client)
+				futures = [pool.submit(self.follow, disk['name'], body_for(disk),
+					submitted[disk['name']][0], submitted[disk['name']][1], start) for disk in disks]
+			else:
+				futures = [pool.submit(self.snapshot_disk, disk, body_for(disk)) for disk in disks]
+			for future in as_completed(futures):
+				result = future.result()
+				results.append(result)
+				if result["ok"]:
+					backup_logger.debug("Snapshotted disk %s in %.1f seconds",
+						result["disk"], result["duration"])
+				else:
+					backup_logger.error("Failed to snapshot disk %s after %.1f seconds: %s",
+						result["disk"], result["duration"], result["error"])
+				progress.update(len(results))
+		return results
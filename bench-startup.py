@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+'''Time how long the command line tools take to start.
+
+Each command is run REPEAT times and the fastest and median wall clock times
+are printed. With --imports, the slowest imports of each command, from
+python's -X importtime, are printed as well.
+
+	./bench-startup.py
+	./bench-startup.py -n 20 --imports 'backup/backup-disks.py --help'
+'''
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_COMMANDS = [
+	'backup/backup-disks.py --help',
+	'backup/backup-disks.py --cluster dev --replace pv disk --test',
+	'archive/archive.py --help',
+	'-c "import google_api"',
+]
+
+def run_once(args):
+	'''Return the wall clock time of one run of python with ARGS.'''
+	start = time.time()
+	p = subprocess.run([sys.executable] + args, cwd=HERE,
+		stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	elapsed = time.time() - start
+	if p.returncode != 0:
+		print('  exited {}: {}'.format(p.returncode,
+			p.stderr.decode(errors='replace').strip().splitlines()[-1:]))
+	return elapsed
+
+def slowest_imports(args, count):
+	'''Return the COUNT imports with the largest cumulative time, in
+	   microseconds, when running python with ARGS.'''
+	p = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=HERE,
+		stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	imports = []
+	for line in p.stderr.decode(errors='replace').splitlines():
+		if not line.startswith('import time:'): continue
+		fields = line[len('import time:'):].split('|')
+		try:
+			imports.append((int(fields[1]), fields[2].strip()))
+		except (IndexError, ValueError):
+			continue
+	return sorted(imports, reverse=True)[:count]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Time the startup of the command line tools.')
+	parser.add_argument('commands', nargs='*', default=DEFAULT_COMMANDS,
+		help='arguments to python, relative to the top of the repository')
+	parser.add_argument('-n', '--repeat', type=int, default=10,
+		help='runs of each command')
+	parser.add_argument('--imports', type=int, nargs='?', const=10, default=0,
+		help='show this many of the slowest imports of each command')
+	args = parser.parse_args()
+
+	for command in args.commands:
+		argv = shlex.split(command)
+		times = sorted(run_once(argv) for i in range(args.repeat))
+		print('{:.3f}s min {:.3f}s median  {}'.format(
+			times[0], times[len(times) // 2], command))
+		if args.imports:
+			for usec, name in slowest_imports(argv, args.imports):
+				print('    {:8.3f}s  {}'.format(usec / 1e6, name))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+'''Estimate node pool headroom from pod requests and node allocatable.'''
+
+POOL_LABEL = 'cloud.google.com/gke-nodepool'
+
+# kubernetes quantity suffixes, longest first so "Mi" wins over "M"
+SUFFIXES = [
+	('Ki', 2**10), ('Mi', 2**20), ('Gi', 2**30), ('Ti', 2**40),
+	('Pi', 2**50), ('Ei', 2**60),
+	('m', 1e-3), ('k', 1e3), ('M', 1e6), ('G', 1e9), ('T', 1e12),
+	('P', 1e15), ('E', 1e18),
+]
+
+def parse_quantity(quantity):
+	'''Convert a kubernetes quantity such as "500m" or "2Gi" to a float.'''
+	if quantity is None: return 0.0
+	quantity = str(quantity)
+	for suffix, factor in SUFFIXES:
+		if quantity.endswith(suffix):
+			return float(quantity[:-len(suffix)]) * factor
+	return float(quantity)
+
+def pod_requests(pod):
+	'''Return the (cpu, memory) requested by all containers of a pod.'''
+	cpu = mem = 0.0
+	for container in pod.spec.containers:
+		if not container.resources or not container.resources.requests:
+			continue
+		cpu += parse_quantity(container.resources.requests.get('cpu'))
+		mem += parse_quantity(container.resources.requests.get('memory'))
+	return (cpu, mem)
+
+def node_pool(node):
+	'''Return the name of the GKE node pool a node belongs to.'''
+	return (node.metadata.labels or {}).get(POOL_LABEL)
+
+def allocatable(node):
+	'''Return the (cpu, memory) allocatable on a node.'''
+	a = node.status.allocatable
+	return (parse_quantity(a.get('cpu')), parse_quantity(a.get('memory')))
+
+def fits(free, request):
+	'''Return how many pods of REQUEST fit in FREE (cpu, memory).'''
+	counts = [f // r for f, r in zip(free, request) if r > 0]
+	if not counts: return float('inf')
+	return max(0, int(min(counts)))
+
+def pack(bins, requests, shape):
+	'''First-fit decreasing packing of REQUESTS into BINS, a list of free
+	   [cpu, memory] pairs which is updated in place. Requests which do not
+	   fit open new bins of SHAPE. Return the number of new bins opened and
+	   the requests that fit nowhere, not even on an empty node.'''
+	opened = 0
+	unplaceable = []
+	for cpu, mem in sorted(requests, key=lambda r: (r[1], r[0]), reverse=True):
+		for b in bins:
+			if b[0] >= cpu and b[1] >= mem:
+				b[0] -= cpu
+				b[1] -= mem
+				break
+		else:
+			if shape is None or shape[0] < cpu or shape[1] < mem:
+				unplaceable.append((cpu, mem))
+				continue
+			bins.append([shape[0] - cpu, shape[1] - mem])
+			opened += 1
+	return opened, unplaceable
+
+def pinned_pool(pod):
+	'''Return the node pool a pod is restricted to by its node selector.'''
+	return (pod.spec.node_selector or {}).get(POOL_LABEL)
+
+class pool_capacity:
+	'''Free cpu and memory on each schedulable node of one or more node
+	   pools, computed from node allocatable minus the requests of every
+	   pod bound to the node. SHAPE is the allocatable of a new node, for
+	   pools which have no nodes to learn it from.'''
+
+	def __init__(self, pool, nodes, pods, shape=None):
+		self.pool = pool
+		pools = [pool] if isinstance(pool, str) else pool
+		self.nodes = [n for n in nodes if node_pool(n) in pools]
+		self.shape = None
+		self.free = {}
+		for node in self.nodes:
+			a = allocatable(node)
+			if self.shape is None or a > self.shape: self.shape = a
+			if not node.spec.unschedulable:
+				self.free[node.metadata.name] = list(a)
+		if self.shape is None: self.shape = shape
+		for pod in pods:
+			name = pod.spec.node_name
+			if name not in self.free: continue
+			cpu, mem = pod_requests(pod)
+			self.free[name][0] -= cpu
+			self.free[name][1] -= mem
+
+def place(pools, requests, prices, booting=None):
+	'''Decide which node pools to grow. POOLS maps pool names to their
+	   pool_capacity, PRICES maps them to an hourly price per node and
+	   BOOTING to the nodes asked for which have not registered yet.
+	   REQUESTS are (cpu, memory, pool) where pool is None unless the pod
+	   is pinned to one.
+
+	   Requests go to free space on existing and booting nodes of any
+	   allowed pool first. Pinned requests left over open new nodes in
+	   their pool; the other left over requests open new nodes in the pool
+	   which fits them at the lowest hourly cost. Return new nodes per pool.
+	   Everything is first-fit decreasing, so this is cheap enough to run on
+	   every event.'''
+	if booting is None: booting = {}
+	bins = {}
+	for name, pool in pools.items():
+		bins[name] = [list(free) for free in pool.free.values()]
+		if pool.shape is not None:
+			bins[name] += [list(pool.shape) for i in range(booting.get(name, 0))]
+
+	pinned = {}
+	unpinned = []
+	for cpu, mem, pin in sorted(requests, key=lambda r: (r[1], r[0]), reverse=True):
+		placed = False
+		for name in ([pin] if pin else pools):
+			for b in bins.get(name, []):
+				if b[0] >= cpu and b[1] >= mem:
+					b[0] -= cpu
+					b[1] -= mem
+					placed = True
+					break
+			if placed: break
+		if placed: continue
+		if pin: pinned.setdefault(pin, []).append((cpu, mem))
+		else: unpinned.append((cpu, mem))
+
+	new = dict([(name, 0) for name in pools])
+	new_bins = dict([(name, []) for name in pools])
+	for name, reqs in pinned.items():
+		if name not in pools: continue
+		new[name], unplaceable = pack(new_bins[name], reqs, pools[name].shape)
+		if unplaceable:
+			print('{} pods do not fit on a {} node'.format(len(unplaceable), name))
+
+	if not unpinned: return new
+	best = None
+	for name, pool in pools.items():
+		trial = [list(b) for b in new_bins[name]]
+		opened, unplaceable = pack(trial, unpinned, pool.shape)
+		if unplaceable: continue
+		cost = opened * prices.get(name, 0)
+		if best is None or (cost, opened) < best[:2]:
+			best = (cost, opened, name)
+	if best is None:
+		print('{} pods do not fit on any node pool'.format(len(unpinned)))
+	else:
+		new[best[2]] += best[1]
+	return new
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+'''Give back under-used nodes of a node pool. Nodes are cordoned so that no
+   new singleuser pods land on them, and deleted from the pool's instance
+   group once their last singleuser pod has ended. Running pods are never
+   evicted.'''
+
+import subprocess
+
+from capacity import fits, pod_requests
+
+# Marks nodes cordoned by us, so we never uncordon or delete others
+ANNOTATION = 'scale-pods/consolidating'
+
+def blocks_removal(pod):
+	'''Whether a pod keeps its node from being removed. System and daemon
+	   set pods are recreated elsewhere; everything else is waited for.'''
+	if pod.metadata.namespace == 'kube-system': return False
+	for owner in pod.metadata.owner_references or []:
+		if owner.kind == 'DaemonSet': return False
+	return True
+
+def is_draining(node):
+	'''Whether a node was cordoned by us and is waiting for its pods.'''
+	return (node.metadata.annotations or {}).get(ANNOTATION) == 'draining'
+
+def removable_nodes(pool, pods, is_singleuser, reserve, floor=0, slot=None):
+	'''Return the names of nodes of POOL, a capacity.pool_capacity, which
+	   can be cordoned while the rest of the pool still has room for their
+	   singleuser pods plus RESERVE more, counted in slots of the largest
+	   singleuser pod, or of SLOT (cpu, memory) when there are none. Nodes
+	   running anything else that blocks removal, e.g. a hub, are not
+	   considered. At least FLOOR nodes are kept.
+
+	   Nodes are taken least loaded first against a running total of the
+	   remaining headroom, so this is O(pods + nodes log nodes).'''
+	users = {}
+	blocked = set()
+	requests = []
+	for pod in pods:
+		name = pod.spec.node_name
+		if name not in pool.free: continue
+		if is_singleuser(pod):
+			users[name] = users.get(name, 0) + 1
+			requests.append(pod_requests(pod))
+		elif blocks_removal(pod):
+			blocked.add(name)
+	if requests:
+		largest = max(requests, key=lambda r: (r[1], r[0]))
+	elif slot is not None:
+		largest = slot
+	else:
+		return []
+
+	slots = {name: fits(free, largest) for name, free in pool.free.items()}
+	candidates = sorted([name for name in pool.free if name not in blocked],
+		key=lambda name: (users.get(name, 0), -slots[name]))
+
+	remaining = sum(slots.values())
+	displaced = 0
+	kept = len(pool.free)
+	chosen = []
+	for name in candidates:
+		if kept <= floor: break
+		if remaining - slots[name] < displaced + users.get(name, 0) + reserve:
+			break
+		remaining -= slots[name]
+		displaced += users.get(name, 0)
+		kept -= 1
+		chosen.append(name)
+	return chosen
+
+def empty_nodes(nodes, pods):
+	'''Return the names of draining NODES that no longer run any pod which
+	   blocks removal.'''
+	draining = set([n.metadata.name for n in nodes if is_draining(n)])
+	for pod in pods:
+		if pod.spec.node_name in draining and blocks_removal(pod):
+			draining.discard(pod.spec.node_name)
+	return sorted(draining)
+
+def cordon(v1, name):
+	'''Mark a node unschedulable and remember that we did so.'''
+	print('cordon ' + name)
+	body = {'spec': {'unschedulable': True},
+		'metadata': {'annotations': {ANNOTATION: 'draining'}}}
+	v1.patch_node(name, body)
+
+def uncordon(v1, name):
+	'''Make a node we cordoned schedulable again.'''
+	print('uncordon ' + name)
+	body = {'spec': {'unschedulable': False},
+		'metadata': {'annotations': {ANNOTATION: None}}}
+	v1.patch_node(name, body)
+
+def instance_group(cluster, node_pool):
+	'''Return the zone and name of the managed instance group behind a
+	   node pool.'''
+	cmd = ['gcloud', 'container', 'node-pools', 'describe', node_pool,
+		'--cluster='+cluster, '--format=value(instanceGroupUrls)']
+	p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	p.check_returncode()
+	url = p.stdout.decode().strip().split(';')[0].split('/')
+	return url[url.index('zones') + 1], url[-1]
+
+def delete_nodes(v1, cluster, node_pool, names):
+	'''Delete specific nodes from a node pool. Unlike a resize, which lets
+	   the instance group pick the victims, this removes exactly NAMES and
+	   shrinks the pool by as many. The nodes are marked once the delete
+	   is accepted, so that they are not picked again while their instances
+	   shut down; if it fails they are uncordoned, to be chosen again only
+	   if still under-used. Return whether gcloud succeeded.'''
+	try:
+		zone, group = instance_group(cluster, node_pool)
+		cmd = ['gcloud', '--quiet', 'compute', 'instance-groups', 'managed',
+			'delete-instances', group, '--zone='+zone,
+			'--instances='+','.join(names)]
+		print(' '.join(cmd))
+		p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		p.check_returncode()
+	except subprocess.CalledProcessError as e:
+		print('delete of {} from {} failed: {}'.format(','.join(names), node_pool,
+			(e.stderr or b'').decode(errors='replace').strip()))
+		for name in names:
+			try:
+				uncordon(v1, name)
+			except Exception as e:
+				print('could not uncordon {}: {}'.format(name, e))
+		return False
+	for name in names:
+		body = {'metadata': {'annotations': {ANNOTATION: 'deleting'}}}
+		try:
+			v1.patch_node(name, body)
+		except Exception as e:
+			# The node may already be gone
+			print('could not mark {} deleting: {}'.format(name, e))
+	return True
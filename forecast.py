@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+'''Forecast singleuser pod counts from their weekly and daily seasonality.
+
+History is a CSV of "timestamp,pods" lines which scale-pods appends to, or
+a JSON datadog pointlist of [milliseconds, value] pairs such as the
+jupyterhub.users.running series in docs/cost-estimation.
+
+	python3 forecast.py backtest history.csv --lead 900
+'''
+
+import argparse
+import bisect
+import json
+import math
+import os
+import time
+
+WEEK = 7 * 24 * 3600
+DAY = 24 * 3600
+
+def load(path):
+	'''Return a sorted list of (timestamp, pods) from a CSV or JSON file.'''
+	if not os.path.exists(path): return []
+	history = []
+	if path.endswith('.json'):
+		for ts, value in json.load(open(path)):
+			if value is None: continue
+			# datadog timestamps are in milliseconds
+			if ts > 1e11: ts = ts / 1000.
+			history.append((float(ts), float(value)))
+	else:
+		for line in open(path):
+			fields = line.strip().split(',')
+			if len(fields) != 2: continue
+			try:
+				history.append((float(fields[0]), float(fields[1])))
+			except ValueError:
+				continue
+	history.sort()
+	return history
+
+def record(path, pods, ts=None):
+	'''Append a pod count to the CSV history.'''
+	if ts is None: ts = time.time()
+	with open(path, 'a') as f:
+		f.write('{:.0f},{}\n'.format(ts, pods))
+
+def quantile(values, q):
+	'''Return the Q quantile of sorted VALUES.'''
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+class seasonal_forecast:
+	'''Predict pod counts from the same time of week, or failing that the
+	   same time of day, in the history. Each slot keeps its samples sorted
+	   and predicts their QUANTILE, so a few quiet weeks do not hide the
+	   usual peak.'''
+
+	def __init__(self, slot=900, q=0.9, min_samples=2):
+		self.slot = slot
+		self.q = q
+		self.min_samples = min_samples
+		self.weekly = {}
+		self.daily = {}
+
+	def add(self, ts, pods):
+		'''Add one observation.'''
+		bisect.insort(self.weekly.setdefault(int(ts % WEEK) // self.slot, []), pods)
+		bisect.insort(self.daily.setdefault(int(ts % DAY) // self.slot, []), pods)
+
+	def fit(self, history):
+		'''Add every (timestamp, pods) of HISTORY.'''
+		for ts, pods in history:
+			self.add(ts, pods)
+		return self
+
+	def expected(self, ts):
+		'''Return the expected pod count at TS, or None if nothing is known
+		   about that time of day.'''
+		weekly = self.weekly.get(int(ts % WEEK) // self.slot, [])
+		if len(weekly) >= self.min_samples:
+			return quantile(weekly, self.q)
+		daily = self.daily.get(int(ts % DAY) // self.slot, [])
+		if len(daily) >= self.min_samples:
+			return quantile(daily, self.q)
+		return None
+
+	def predict(self, now, lead, current=0):
+		'''Return the most pods expected at any time from NOW until NOW+LEAD,
+		   and never less than CURRENT. Nodes sized for this at NOW are
+		   ready before the load arrives and are not released before it
+		   has passed.'''
+		peak = current
+		ts = now
+		while ts <= now + lead:
+			expected = self.expected(ts)
+			if expected is not None: peak = max(peak, expected)
+			ts += self.slot
+		return peak
+
+class pod_history:
+	'''A seasonal_forecast fed from, and recording to, a CSV history.'''
+
+	def __init__(self, path, lead, interval=60, **kwargs):
+		self.path = path
+		self.lead = lead
+		self.interval = interval
+		self.model = seasonal_forecast(**kwargs).fit(load(path))
+		self.last = 0
+
+	def observe(self, pods, now=None):
+		'''Record PODS, at most once per INTERVAL seconds, and return the
+		   pods to provision for now given the lead time.'''
+		if now is None: now = time.time()
+		if now - self.last >= self.interval:
+			record(self.path, pods, now)
+			self.model.add(now, pods)
+			self.last = now
+		return self.model.predict(now, self.lead, pods)
+
+def nodes_for(pods, users_per_node, threshold):
+	'''Nodes needed for PODS to be at most THRESHOLD of capacity.'''
+	return int(math.ceil(pods / (threshold * users_per_node)))
+
+def backtest(history, lead, users_per_node, threshold, slot, q):
+	'''Replay HISTORY, forecasting LEAD seconds ahead at every sample with
+	   only the samples seen so far, and compare the nodes that forecast
+	   would have provided with the nodes the actual load needed.'''
+	model = seasonal_forecast(slot=slot, q=q)
+	times = [ts for ts, pods in history]
+	stats = {'samples': 0, 'under': 0, 'over': 0, 'excess_nodes': 0,
+		'reactive_under': 0}
+	for i, (ts, pods) in enumerate(history):
+		j = bisect.bisect_left(times, ts + lead)
+		if j < len(history):
+			needed = nodes_for(history[j][1], users_per_node, threshold)
+			provided = nodes_for(model.predict(ts, lead, pods),
+				users_per_node, threshold)
+			reactive = nodes_for(pods, users_per_node, threshold)
+			stats['samples'] += 1
+			if provided < needed: stats['under'] += 1
+			if provided > needed:
+				stats['over'] += 1
+				stats['excess_nodes'] += provided - needed
+			if reactive < needed: stats['reactive_under'] += 1
+		model.add(ts, pods)
+	return stats
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('command', choices=['backtest'])
+	parser.add_argument('history', help='CSV or JSON pod count history')
+	parser.add_argument('--lead', type=int, default=900,
+		help='Seconds ahead that nodes must be ready')
+	parser.add_argument('--users-per-node', type=int, default=24)
+	parser.add_argument('--threshold', type=float, default=0.9)
+	parser.add_argument('--slot', type=int, default=900,
+		help='Seconds per seasonal slot')
+	parser.add_argument('--quantile', type=float, default=0.9)
+	args = parser.parse_args()
+
+	stats = backtest(load(args.history), args.lead, args.users_per_node,
+		args.threshold, args.slot, args.quantile)
+	n = max(stats['samples'], 1)
+	print('samples:            {}'.format(stats['samples']))
+	print('under-provisioned:  {:.1%}'.format(stats['under'] / n))
+	print('over-provisioned:   {:.1%}'.format(stats['over'] / n))
+	print('mean excess nodes:  {:.2f}'.format(stats['excess_nodes'] / n))
+	print('reactive under:     {:.1%}'.format(stats['reactive_under'] / n))
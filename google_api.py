@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+'''Google API client shared by the backup and archive tools.
+
+Services built by api_client send every request through api_client.execute,
+which waits for the API's rate budget, reuses one authorized connection per
+thread, retries 429, 5xx and rate limit responses with jittered exponential
+backoff, and counts requests, retries and latency per API.
+
+Discovery documents are cached on disk, and the Google libraries are only
+imported once a service is built, so that runs which never call an API
+start quickly.'''
+
+import datetime
+import os
+import random
+import re
+import socket
+import threading
+import time
+
+# Requests a second and burst per API. The Compute API allows 20 requests a
+# second per project by default.
+DEFAULT_RATES = {'compute': (20, 40)}
+
+RETRY_STATUSES = set([429, 500, 502, 503, 504])
+# 403s with these reasons are quota errors rather than permission errors
+RETRY_REASONS = [b'rateLimitExceeded', b'userRateLimitExceeded']
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{}/{}/rest'
+DISCOVERY_CACHE = os.path.expanduser('~/.cache/google-api/discovery')
+# Cached documents are refetched after this long, but still used if that fails
+DISCOVERY_MAX_AGE = 7 * 24 * 3600
+
+TIMESTAMP_RE = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
+
+def parse_timestamp(timestamp):
+	'''Parse an API timestamp such as 2017-03-04T10:11:12.123-08:00 into
+	   an aware datetime, or None. Timestamps without an offset are local
+	   time.'''
+	match = TIMESTAMP_RE.match(timestamp or '')
+	if match is None: return None
+	seconds, fraction, offset = match.groups()
+	parsed = datetime.datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+	if fraction:
+		parsed = parsed.replace(microsecond=int(float(fraction) * 1e6))
+	if offset is None:
+		return parsed.astimezone()
+	if offset == 'Z':
+		return parsed.replace(tzinfo=datetime.timezone.utc)
+	sign = -1 if offset[0] == '-' else 1
+	hours, minutes = int(offset[1:3]), int(offset[-2:])
+	return parsed.replace(tzinfo=datetime.timezone(
+		sign * datetime.timedelta(hours=hours, minutes=minutes)))
+
+class token_bucket:
+	'''Lets through RATE calls a second on average, in bursts of at most
+	   BURST, and makes everyone else wait. Safe to share between threads.'''
+
+	def __init__(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	def take(self, n=1):
+		'''Block until N tokens are available and take them.'''
+		while True:
+			with self.lock:
+				now = time.time()
+				self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= n:
+					self.tokens -= n
+					return
+				wait = (n - self.tokens) / self.rate
+			time.sleep(wait)
+
+class missing_http_error(Exception):
+	'''Stands in for HttpError when googleapiclient is not installed, as
+	   with a fake API. Nothing raises it.'''
+
+def http_error():
+	'''The class of API errors, imported only when a caller needs it.'''
+	try:
+		from googleapiclient.errors import HttpError
+	except ImportError:
+		return missing_http_error
+	return HttpError
+
+def is_retryable(error):
+	'''Whether an error is worth retrying: transient server errors, rate
+	   limits and dropped connections.'''
+	if isinstance(error, http_error()):
+		status = int(error.resp.status)
+		if status in RETRY_STATUSES: return True
+		return status == 403 and any(r in (error.content or b'') for r in RETRY_REASONS)
+	if isinstance(error, socket.error): return True
+	try:
+		import httplib2
+	except ImportError:
+		return False
+	return isinstance(error, httplib2.HttpLib2Error)
+
+def api_name(request):
+	'''The API a request belongs to, from its method id such as
+	   compute.disks.insert.'''
+	return (getattr(request, 'methodId', None) or 'default').split('.')[0]
+
+class api_client:
+	'''Builds Google API services whose requests share rate budgets,
+	   retries and counters. RATES maps API names to (requests a second,
+	   burst); APIs not in it are not throttled.'''
+
+	def __init__(self, credentials=None, rates=DEFAULT_RATES, max_retries=6,
+			base_delay=1.0, max_delay=60.0, cache_dir=DISCOVERY_CACHE):
+		self.credentials = credentials
+		self.cache_dir = cache_dir
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.budgets = dict([(api, token_bucket(rate, burst))
+			for api, (rate, burst) in rates.items()])
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.stats = {}
+
+	def http(self):
+		'''This thread's authorized connection. httplib2 is not thread
+		   safe, so each thread gets one and keeps reusing it.'''
+		if not hasattr(self.local, 'http'):
+			import httplib2
+			if self.credentials is None:
+				from oauth2client.client import GoogleCredentials
+				self.credentials = GoogleCredentials.get_application_default()
+			self.local.http = self.credentials.authorize(httplib2.Http())
+		return self.local.http
+
+	def set_rate(self, api, rate, burst=None):
+		'''Change the rate budget of an API.'''
+		self.budgets[api] = token_bucket(rate, burst or max(rate, 1))
+
+	def discovery_document(self, api, version):
+		'''The discovery document of an API, from the cache unless it is
+		   older than DISCOVERY_MAX_AGE. A stale copy is better than none
+		   when the document cannot be fetched.'''
+		path = os.path.join(self.cache_dir, '{}-{}.json'.format(api, version))
+		try:
+			age = time.time() - os.path.getmtime(path)
+		except OSError:
+			age = None
+		if age is None or age > DISCOVERY_MAX_AGE:
+			try:
+				import httplib2
+				resp, content = httplib2.Http(timeout=30).request(
+					DISCOVERY_URL.format(api, version))
+				if resp.status != 200:
+					raise IOError('HTTP {} fetching the {} {} discovery document'.format(
+						resp.status, api, version))
+				if not os.path.isdir(self.cache_dir):
+					os.makedirs(self.cache_dir)
+				with open(path + '.tmp', 'wb') as f:
+					f.write(content)
+				os.rename(path + '.tmp', path)
+			except Exception as e:
+				if age is None: raise
+				print('Using a {:.0f} day old {} {} discovery document: {}'.format(
+					age / 86400, api, version, e))
+		with open(path) as f:
+			return f.read()
+
+	def build(self, api, version):
+		'''Build a discovery service whose requests go through execute.'''
+		from googleapiclient import discovery
+		from googleapiclient.http import HttpRequest
+		client = self
+		class request(HttpRequest):
+			def execute(self, http=None, num_retries=0):
+				return client.execute(self, http)
+		return discovery.build_from_document(self.discovery_document(api, version),
+			http=self.http(), requestBuilder=request)
+
+	def execute(self, request, http=None):
+		'''Execute an HttpRequest, retrying transient errors with full
+		   jitter exponential backoff. Raise the last error once retries
+		   run out, or any error that is not transient.'''
+		from googleapiclient.http import HttpRequest
+		api = api_name(request)
+		budget = self.budgets.get(api)
+		attempt = 0
+		while True:
+			if budget is not None: budget.take()
+			start = time.time()
+			try:
+				response = HttpRequest.execute(request, http=http or self.http())
+			except Exception as e:
+				self._count_attempt(api, time.time() - start)
+				if attempt >= self.max_retries or not is_retryable(e):
+					self._count_call(api, attempt, failed=True)
+					raise
+				delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+				attempt += 1
+				time.sleep(delay)
+				continue
+			self._count_attempt(api, time.time() - start)
+			self._count_call(api, attempt, failed=False)
+			return response
+
+	def _api_stats(self, api):
+		return self.stats.setdefault(api, {'calls': 0, 'attempts': 0,
+			'retries': 0, 'failures': 0, 'latency': 0.0, 'max_latency': 0.0})
+
+	def _count_attempt(self, api, latency):
+		'''Count one HTTP request, successful or not.'''
+		with self.lock:
+			s = self._api_stats(api)
+			s['attempts'] += 1
+			s['latency'] += latency
+			s['max_latency'] = max(s['max_latency'], latency)
+
+	def _count_call(self, api, retries, failed):
+		'''Count one call of execute, which took RETRIES retries and
+		   FAILED if it raised.'''
+		with self.lock:
+			s = self._api_stats(api)
+			s['calls'] += 1
+			s['retries'] += retries
+			if failed: s['failures'] += 1
+
+	def report(self):
+		'''One line of counters per API. Calls are requests as the caller
+		   made them and attempts the HTTP requests sent for them, retries
+		   included; latency is per attempt.'''
+		lines = []
+		with self.lock:
+			for api, s in sorted(self.stats.items()):
+				mean = s['latency'] / s['attempts'] if s['attempts'] else 0
+				lines.append('{}: {} calls, {} attempts, {} retries, {} failed calls, latency mean {:.3f}s max {:.3f}s'.format(
+					api, s['calls'], s['attempts'], s['retries'], s['failures'], mean, s['max_latency']))
+		return '\n'.join(lines)
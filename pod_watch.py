@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+'''Keep an in-memory view of pods and nodes from kubernetes watches.'''
+
+import threading
+import time
+
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+
+class pod_watch:
+	'''Hold a single all-namespace pod watch and a node watch and keep both
+	   in memory. Callers wait on `changed`, which is set whenever the
+	   "jupyter-" pods of the given namespaces change, and read counts
+	   without going back to the API server.'''
+
+	def __init__(self, context, namespaces, prefix='jupyter-', timeout=300):
+		config.load_kube_config(context=context)
+		self.v1 = client.CoreV1Api()
+		self.namespaces = set(namespaces)
+		self.prefix = prefix
+		self.timeout = timeout
+		self.pods = {}
+		self.nodes = {}
+		self.lock = threading.Lock()
+		self.changed = threading.Event()
+		self.threads = []
+
+	def is_singleuser(self, pod):
+		'''Whether a pod is a singleuser pod in one of our namespaces.'''
+		return pod.metadata.namespace in self.namespaces and \
+			pod.metadata.name.startswith(self.prefix)
+
+	def _apply_pod(self, event_type, pod):
+		'''Apply a pod event. Return True if singleuser pods changed.'''
+		key = (pod.metadata.namespace, pod.metadata.name)
+		if event_type == 'DELETED' or pod.status.phase in ['Succeeded', 'Failed']:
+			removed = self.pods.pop(key, None)
+			return removed is not None and self.is_singleuser(pod)
+		self.pods[key] = pod
+		return self.is_singleuser(pod)
+
+	def _apply_node(self, event_type, node):
+		'''Apply a node event. Node changes always count as a change.'''
+		if event_type == 'DELETED':
+			self.nodes.pop(node.metadata.name, None)
+		else:
+			self.nodes[node.metadata.name] = node
+		return True
+
+	def _sync(self, list_func, store, apply):
+		'''List every object once and reset STORE. Return the resource
+		   version to watch from.'''
+		result = list_func()
+		with self.lock:
+			store.clear()
+			for item in result.items:
+				apply('ADDED', item)
+		self.changed.set()
+		return result.metadata.resource_version
+
+	def _run(self, list_func, store, apply, resource_version=None):
+		'''Consume watch events forever from RESOURCE_VERSION, resyncing
+		   when the watch expires, the API server reports our resource
+		   version as too old or the stream breaks.'''
+		while True:
+			try:
+				if resource_version is None:
+					resource_version = self._sync(list_func, store, apply)
+				w = watch.Watch()
+				for event in w.stream(list_func,
+						resource_version=resource_version,
+						timeout_seconds=self.timeout):
+					if event['type'] == 'ERROR':
+						resource_version = None
+						break
+					item = event['object']
+					resource_version = item.metadata.resource_version
+					with self.lock:
+						changed = apply(event['type'], item)
+					if changed: self.changed.set()
+			except ApiException as e:
+				if e.status != 410:
+					print('watch: ' + str(e))
+					time.sleep(5)
+				resource_version = None
+			except Exception as e:
+				# Dropped connections and read timeouts end streams too;
+				# anything else must not leave us deciding on a stale view
+				print('watch: {}: {}'.format(type(e).__name__, e))
+				time.sleep(5)
+				resource_version = None
+
+	def start(self):
+		'''Sync and start watching pods and nodes in background threads.'''
+		watches = [
+			(self.v1.list_pod_for_all_namespaces, self.pods, self._apply_pod),
+			(self.v1.list_node, self.nodes, self._apply_node),
+		]
+		for list_func, store, apply in watches:
+			resource_version = self._sync(list_func, store, apply)
+			t = threading.Thread(target=self._run,
+				args=(list_func, store, apply, resource_version), daemon=True)
+			t.start()
+			self.threads.append(t)
+
+	def count(self, namespace=None):
+		'''Count singleuser pods, optionally only those in one namespace.'''
+		with self.lock:
+			return len([p for p in self.pods.values()
+				if self.is_singleuser(p) and
+				(namespace is None or p.metadata.namespace == namespace)])
+
+	def snapshot(self):
+		'''Return copies of the lists of pods and nodes.'''
+		with self.lock:
+			return list(self.pods.values()), list(self.nodes.values())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+'''Pull singleuser images onto the nodes that lack them.
+
+Node status already lists the images each kubelet holds, so only missing
+(node, image) pairs are pulled. A pull is a short-lived pod bound to the
+node which runs /bin/true from the image; the kubelet pulls it with its own
+registry credentials, so no ssh or dockercfg update is needed.'''
+
+import collections
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client
+
+PULL_ERRORS = ['ErrImagePull', 'ImagePullBackOff', 'InvalidImageName']
+
+def singleuser_images(pods, namespaces, prefix='hub-deployment'):
+	'''Return the name:tag of the singleuser image of each hub in PODS.'''
+	images = set()
+	for pod in pods:
+		if pod.metadata.namespace not in namespaces: continue
+		if not pod.metadata.name.startswith(prefix): continue
+		for env in pod.spec.containers[0].env or []:
+			if env.name == 'SINGLEUSER_IMAGE' and env.value:
+				images.add(env.value)
+	return sorted(images)
+
+def image_names(image):
+	'''Return the names a node may list IMAGE under.'''
+	names = [image]
+	if ':' not in image.split('/')[-1]:
+		names.append(image + ':latest')
+	if image.count('/') == 0:
+		names.append('docker.io/library/' + names[-1])
+	elif '.' not in image.split('/')[0]:
+		names.append('docker.io/' + names[-1])
+	return names
+
+def is_ready(node):
+	'''Whether a node is Ready and schedulable.'''
+	if node.spec.unschedulable: return False
+	for condition in node.status.conditions or []:
+		if condition.type == 'Ready':
+			return condition.status == 'True'
+	return False
+
+def missing(nodes, images):
+	'''Return (node name, image) for each ready node lacking an image.'''
+	jobs = []
+	for node in nodes:
+		if not is_ready(node): continue
+		present = set()
+		for held in node.status.images or []:
+			present.update(held.names or [])
+		for image in images:
+			if not present.intersection(image_names(image)):
+				jobs.append((node.metadata.name, image))
+	return jobs
+
+class prepuller:
+	'''Queue and run image pulls with adaptive concurrency. The number of
+	   pulls in flight grows by one after each success and halves after
+	   each failure, between 1 and MAX_CONCURRENCY, so the registry and
+	   nodes set the pace rather than a fixed fan-out.'''
+
+	def __init__(self, v1, namespace='kube-system', concurrency=4,
+			max_concurrency=32, timeout=900):
+		self.v1 = v1
+		self.namespace = namespace
+		self.limit = concurrency
+		self.max_concurrency = max_concurrency
+		self.timeout = timeout
+		self.queue = collections.deque()
+		self.in_flight = set()
+		# Node status lags behind pulls, so remember what we pulled
+		self.pulled = set()
+		self.running = 0
+		self.done = 0
+		self.failed = 0
+		self.lock = threading.Condition()
+		self.executor = ThreadPoolExecutor(max_concurrency)
+
+	def ensure(self, nodes, images):
+		'''Queue pulls of IMAGES onto ready NODES that do not hold them and
+		   are not already being pulled to. Return how many were queued.'''
+		queued = 0
+		with self.lock:
+			for job in missing(nodes, images):
+				if job in self.in_flight or job in self.pulled: continue
+				self.in_flight.add(job)
+				self.queue.append(job)
+				queued += 1
+		if queued: print('prepull: {} pulls queued'.format(queued))
+		self._dispatch()
+		return queued
+
+	def wait(self):
+		'''Block until every queued pull has finished.'''
+		with self.lock:
+			while self.in_flight:
+				self.lock.wait()
+
+	def _dispatch(self):
+		with self.lock:
+			while self.queue and self.running < self.limit:
+				job = self.queue.popleft()
+				self.running += 1
+				future = self.executor.submit(self._pull, *job)
+				future.add_done_callback(self._finished)
+
+	def _finished(self, future):
+		node, image, ok, seconds, msg = future.result()
+		with self.lock:
+			self.running -= 1
+			self.in_flight.discard((node, image))
+			if ok:
+				self.pulled.add((node, image))
+				self.done += 1
+				self.limit = min(self.max_concurrency, self.limit + 1)
+			else:
+				self.failed += 1
+				self.limit = max(1, self.limit // 2)
+			print('prepull: {} {} {} in {:.0f}s {} ({} done, {} failed, {} left)'.format(
+				node, image, 'pulled' if ok else 'FAILED', seconds, msg,
+				self.done, self.failed, len(self.in_flight)))
+			self.lock.notify_all()
+		self._dispatch()
+
+	def _pull(self, node, image):
+		'''Pull IMAGE onto NODE. Return the job, whether it worked, how long
+		   it took and any error.'''
+		start = time.time()
+		body = {
+			'apiVersion': 'v1',
+			'kind': 'Pod',
+			'metadata': {'generateName': 'prepull-', 'labels': {'app': 'prepull'}},
+			'spec': {
+				'nodeName': node,
+				'restartPolicy': 'Never',
+				'tolerations': [{'operator': 'Exists'}],
+				'containers': [{
+					'name': 'prepull',
+					'image': image,
+					'imagePullPolicy': 'IfNotPresent',
+					'command': ['/bin/true'],
+				}],
+			},
+		}
+		try:
+			pod = self.v1.create_namespaced_pod(self.namespace, body)
+		except Exception as e:
+			return node, image, False, time.time() - start, str(e)
+
+		name = pod.metadata.name
+		ok, msg = False, 'timed out'
+		try:
+			while time.time() - start < self.timeout:
+				time.sleep(2)
+				pod = self.v1.read_namespaced_pod(name, self.namespace)
+				if pod.status.phase in ['Succeeded', 'Failed']:
+					# The image is on the node either way
+					ok, msg = True, ''
+					break
+				statuses = pod.status.container_statuses or []
+				waiting = [s.state.waiting for s in statuses if s.state.waiting]
+				errors = [w for w in waiting if w.reason in PULL_ERRORS]
+				if errors:
+					msg = errors[0].reason + ': ' + (errors[0].message or '')
+					break
+		except Exception as e:
+			msg = str(e)
+		finally:
+			try:
+				self.v1.delete_namespaced_pod(name, self.namespace,
+					client.V1DeleteOptions())
+			except Exception:
+				pass
+		return node, image, ok, time.time() - start, msg
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import argparse
+import math
 import subprocess
 import sys
+import time
 import yaml
 
 def count_pods(namespace, prefix=b'jupyter-'):
@@ -19,37 +22,365 @@ def count_pods(namespace, prefix=b'jupyter-'):
 	p.close()
 	return count
 
-def get_hub_pod(namespace, prefix=b'hub-deployment'):
-	'''Return the name of the hub pod.'''
-	cmd = ['kubectl', '--context='+KUBECTL_CONTEXT,
-		'--namespace='+namespace, 'get', 'pods',
-		'-o=custom-columns=NAME:.metadata.name']
-	p = subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout
-	line = p.readline()
-	while line:
-		if line.startswith(prefix): return line.strip()
-		line = p.readline()
-		continue
-	p.close()
-	return ''
-
-def get_singleuser_image(namespace, hub_pod):
-	'''Return the name:tag of the hub's singleuser image.'''
-	cmd = ['kubectl', '--context='+KUBECTL_CONTEXT,
-		'--namespace='+namespace, 'get', 'pod', '-o=yaml',
-		hub_pod]
+def get_node_count(cluster):
+	'''Return the number of nodes in the cluster.'''
+	cmd = ['gcloud', 'container', 'clusters', 'describe', cluster]
 	p = subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout
 	buf = p.read()
 	p.close()
 
-	description = yaml.load(buf)
-	image = ''
-	for env in description['spec']['containers'][0]['env']:
-		if env['name'] == 'SINGLEUSER_IMAGE':
-			image = env['value']
-			break
+	try:
+		description = yaml.load(buf)
+	except Exception as e:
+		print(str(e))
+		sys.exit(1)
+
+	return description['currentNodeCount']
+
+def count_pool_nodes(node_pool):
+	'''Count the nodes of one node pool.'''
+	from capacity import POOL_LABEL
+	cmd = ['kubectl', '--context='+KUBECTL_CONTEXT, 'get', 'nodes',
+		'--selector={}={}'.format(POOL_LABEL, node_pool), '-o=name']
+	p = subprocess.run(cmd, stdout=subprocess.PIPE)
+	return len(p.stdout.split())
+
+def nodes_to_add(cur_pods, node_count):
+	'''Return how many nodes to add given the current pod and node counts.'''
+	# How many pods does that accommodate?
+	max_pods = node_count * USERS_PER_NODE
+	if cur_pods < POD_THRESHOLD * max_pods:
+		return 0
+	return BUMP_INCREMENT
+
+def is_singleuser(pod):
+	'''Whether a kubernetes pod object is a singleuser pod we scale for.'''
+	return pod.metadata.namespace in NAMESPACES and \
+		pod.metadata.name.startswith('jupyter-')
+
+def kube_api():
+	'''Return a kubernetes CoreV1Api client for KUBECTL_CONTEXT.'''
+	from kubernetes import client, config
+	config.load_kube_config(context=KUBECTL_CONTEXT)
+	return client.CoreV1Api()
+
+def list_cluster(v1):
+	'''Return all nodes and all running or pending pods.'''
+	nodes = v1.list_node().items
+	pods = [p for p in v1.list_pod_for_all_namespaces().items
+		if p.status.phase not in ['Succeeded', 'Failed']]
+	return nodes, pods
+
+def expected_pods(counts):
+	'''Return how many singleuser pods to provision for, given the current
+	   COUNTS per namespace. With a history this is the forecast peak
+	   within the lead time, and with a calendar no namespace is counted
+	   below the users of its warm sections.'''
+	cur_pods = sum(counts.values())
+	expected = cur_pods
+	if history is not None:
+		expected = history.observe(cur_pods)
+	if calendar is not None:
+		floor = calendar.floor()
+		expected = max(expected, sum([max(counts.get(ns, 0), floor.get(ns, 0))
+			for ns in NAMESPACES]))
+	return expected
+
+def prewarm():
+	'''Pull the singleuser images of namespaces with a section about to
+	   start. The controller keeps every image on every node anyway, so
+	   this is only needed when running once.'''
+	if calendar is None: return
+	namespaces = calendar.to_prepull()
+	if namespaces: populate(namespaces)
+
+def existing_pools(cluster, refresh=False):
+	'''Return the names of the cluster's node pools, listed on first use
+	   and again if REFRESH. If a refresh fails the last list is kept.'''
+	global node_pools
+	if node_pools is None or refresh:
+		cmd = ['gcloud', 'container', 'node-pools', 'list',
+			'--cluster='+cluster, '--format=value(name)']
+		p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		if p.returncode != 0 and node_pools is not None:
+			print('could not list node pools of {}: {}'.format(cluster,
+				p.stderr.decode(errors='replace').strip()))
+			return node_pools
+		p.check_returncode()
+		before = node_pools
+		node_pools = p.stdout.decode().split()
+		for name in NODE_POOLS:
+			if name in node_pools: continue
+			if before is None or name in before:
+				print('node pool {} does not exist in {}; not managing it'.format(
+					name, cluster))
+	return node_pools
+
+def managed_pools(nodes, pods):
+	'''Return a capacity.pool_capacity for each of NODE_POOLS that exists.'''
+	from capacity import pool_capacity, parse_quantity
+	pools = {}
+	for name, pool in NODE_POOLS.items():
+		if name not in existing_pools(CLUSTER): continue
+		shape = tuple([parse_quantity(x) for x in pool['shape']])
+		pools[name] = pool_capacity(name, nodes, pods, shape)
+	return pools
+
+def capacity_target(nodes, pods, targets=None, expected=0, users=None):
+	'''Return the current size of each of NODE_POOLS and the size it should
+	   have, computed from pod requests and node allocatable rather than
+	   USERS_PER_NODE. New nodes go to the pool which fits the pending and
+	   expected pods at the lowest hourly cost. TARGETS are the sizes last
+	   asked for, so that nodes which are still booting are not requested
+	   twice. EXPECTED is the forecast number of singleuser pods and USERS
+	   the singleuser pods which count towards the reserve, by default
+	   all of them.'''
+	from capacity import place, pod_requests, pinned_pool
+
+	if targets is None: targets = {}
+	pools = managed_pools(nodes, pods)
+	current = dict([(name, len(pool.nodes)) for name, pool in pools.items()])
+	singleuser = [p for p in pods if is_singleuser(p)]
+	if users is None: users = singleuser
+	shapes = [pool.shape for pool in pools.values() if pool.shape]
+	if singleuser:
+		largest = max([pod_requests(p) for p in singleuser],
+			key=lambda r: (r[1], r[0]))
+	elif expected and shapes:
+		# Nothing to learn the pod shape from yet, e.g. before a first lab
+		largest = tuple([x / USERS_PER_NODE for x in max(shapes)])
+	else:
+		return current, dict(current)
+
+	requests = [pod_requests(p) + (pinned_pool(p),)
+		for p in singleuser if not p.spec.node_name]
+	requests += [largest + (None,)] * spare(users, expected)
+	booting = dict([(name, max(0, targets.get(name, 0) - current[name]))
+		for name in pools])
+	new = place(pools, requests,
+		dict([(name, pool['price']) for name, pool in NODE_POOLS.items()]),
+		booting)
+	sizes = dict([(name, current[name] + booting[name] + new[name])
+		for name in pools])
+	return current, sizes
+
+def spare(users, expected=0):
+	'''How many more singleuser pods there should be room for, so that the
+	   pools are at most POD_THRESHOLD full, now and at EXPECTED pods.'''
+	wanted = max(len(users), expected)
+	return max(0, math.ceil(wanted / POD_THRESHOLD) - len(users))
+
+def consolidate_pools(v1, nodes, pods, expected=0, users=None):
+	'''Delete nodes we cordoned once they are empty, and cordon more nodes
+	   if the rest of NODE_POOLS can absorb their users. Return how many
+	   nodes were deleted from each pool.'''
+	import consolidate
+	from capacity import pool_capacity, node_pool
+
+	pool_nodes = [n for n in nodes if node_pool(n) in NODE_POOLS]
+	deleted = {}
+	for name in consolidate.empty_nodes(pool_nodes, pods):
+		pool = node_pool([n for n in pool_nodes if n.metadata.name == name][0])
+		deleted.setdefault(pool, []).append(name)
+	if deleted:
+		return dict([(pool, len(names)) for pool, names in deleted.items()
+			if consolidate.delete_nodes(v1, CLUSTER, pool, names)])
+
+	pool = pool_capacity(list(NODE_POOLS), nodes, pods)
+	if users is None: users = [p for p in pods if is_singleuser(p)]
+	# With no users to learn the pod shape from, e.g. overnight, count
+	# slots of USERS_PER_NODE per node
+	slot = None
+	if pool.shape:
+		slot = tuple([x / USERS_PER_NODE for x in pool.shape])
+	for name in consolidate.removable_nodes(pool, pods, is_singleuser,
+			spare(users, expected), MIN_NODES, slot):
+		consolidate.cordon(v1, name)
+	return {}
+
+def active_users(pods):
+	'''Return PODS without the ones we culled, and the singleuser pods
+	   which count as users. Without activity tracking every singleuser
+	   pod is a user; with it, stale servers are not, and are culled
+	   first if asked to.'''
+	singleuser = [p for p in pods if is_singleuser(p)]
+	if tracker is None: return pods, singleuser
+
+	from activity import ACTIVE, IDLE, STALE
+	tracker.refresh()
+	if cull:
+		culled = set([id(p) for p in tracker.cull(singleuser)])
+		pods = [p for p in pods if id(p) not in culled]
+		singleuser = [p for p in singleuser if id(p) not in culled]
+
+	states = dict([(s, []) for s in [ACTIVE, IDLE, STALE]])
+	for p in singleuser:
+		states[tracker.state(p)].append(p)
+	print('{} active, {} idle, {} stale'.format(len(states[ACTIVE]),
+		len(states[IDLE]), len(states[STALE])))
+	return pods, states[ACTIVE] + states[IDLE]
+
+def capacity_step(v1, nodes, pods, targets=None, shrink=False):
+	'''Grow NODE_POOLS if they lack room or, if SHRINK, consolidate them
+	   when nothing is booting. Return the sizes the pools were last asked
+	   for.'''
+	import consolidate
+
+	pods, users = active_users(pods)
+	counts = {}
+	for p in users:
+		counts[p.metadata.namespace] = counts.get(p.metadata.namespace, 0) + 1
+	expected = expected_pods(counts)
+	# Forget sizes asked for long ago which the pool never reached, e.g.
+	# when the zone is out of machines, so they stop hiding real needs
+	targets = dict(targets or {})
+	for name, size in list(targets.items()):
+		if time.time() - asked_at.get(name, 0) > TARGET_TTL:
+			del targets[name]
+	current, sizes = capacity_target(nodes, pods, targets, expected, users)
+	targets = dict([(name, max(current[name], targets.get(name, 0)))
+		for name in current])
+	grow = [name for name in sizes if sizes[name] > targets[name]]
+	if grow:
+		# Take back nodes we are draining before paying for new ones
+		draining = [n.metadata.name for n in nodes
+			if consolidate.is_draining(n)]
+		for name in draining:
+			consolidate.uncordon(v1, name)
+		if draining: return targets
 
-	return image
+		for name in grow:
+			if resize(CLUSTER, name, sizes[name]):
+				targets[name] = sizes[name]
+				asked_at[name] = time.time()
+		return targets
+
+	if shrink and targets == current:
+		deleted = consolidate_pools(v1, nodes, pods, expected, users)
+		for name, count in deleted.items():
+			targets[name] = current[name] - count
+			asked_at[name] = time.time()
+
+	print(sum(current.values()))
+	return targets
+
+def resize(cluster, node_pool, size):
+	'''Resize the node pool. Return whether gcloud succeeded.'''
+	cmd = ['gcloud', '--quiet', 'container', 'clusters', 'resize', cluster,
+		'--node-pool='+node_pool, '--size', str(size)]
+	print(' '.join(cmd))
+	p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if p.returncode != 0:
+		print('resize of {} failed: {}'.format(node_pool,
+			p.stderr.decode(errors='replace').strip()))
+	return p.returncode == 0
+
+def populate(namespaces, size=0, pools=None):
+	'''Pull the namespaces' singleuser images onto the ready nodes which
+	   lack them. With SIZE, first wait a while for POOLS to have that many
+	   ready nodes, so that nodes from a resize are included.'''
+	from capacity import node_pool
+	from prepull import prepuller, singleuser_images, is_ready
+
+	if pools is None: pools = [NODE_POOL]
+	v1 = kube_api()
+	images = singleuser_images(list_cluster(v1)[1], namespaces)
+	deadline = time.time() + 600
+	while True:
+		nodes = v1.list_node().items
+		ready = [n for n in nodes if node_pool(n) in pools and is_ready(n)]
+		if len(ready) >= size or time.time() > deadline: break
+		time.sleep(10)
+
+	puller = prepuller(v1)
+	puller.ensure(nodes, images)
+	puller.wait()
+
+def scale_once(use_capacity, shrink):
+	'''Count pods with kubectl and resize once if needed.'''
+	prewarm()
+
+	if use_capacity:
+		from capacity import node_pool
+		v1 = kube_api()
+		nodes, pods = list_cluster(v1)
+		current = len([n for n in nodes if node_pool(n) in NODE_POOLS])
+		size = sum(capacity_step(v1, nodes, pods, shrink=shrink).values())
+		if size > current:
+			populate(NAMESPACES, size, list(NODE_POOLS))
+		return
+
+	node_count = get_node_count(CLUSTER)
+
+	# How many pods are active?
+	counts = {}
+	for ns in NAMESPACES:
+		counts[ns] = count_pods(ns)
+	cur_pods = sum(counts.values())
+
+	increment = nodes_to_add(expected_pods(counts), node_count)
+	if not increment:
+		print(cur_pods)
+		sys.exit(0)
+
+	# Size NODE_POOL from its own nodes, not the cluster's, and wait for
+	# the new ones so they get images too
+	size = count_pool_nodes(NODE_POOL) + increment
+	if resize(CLUSTER, NODE_POOL, size):
+		populate(NAMESPACES, size)
+
+def scale_forever(settle, resync, use_capacity, shrink):
+	'''Hold a pod watch and re-evaluate whenever the pod count changes.
+	   Evaluations are at most one per SETTLE seconds so a burst of logins
+	   results in one decision rather than one per pod.'''
+	from pod_watch import pod_watch
+	from prepull import prepuller, singleuser_images
+
+	pods = pod_watch(KUBECTL_CONTEXT, NAMESPACES)
+	pods.start()
+	puller = prepuller(pods.v1)
+	if not use_capacity:
+		node_count = get_node_count(CLUSTER)
+	last_resync = time.time()
+	targets = {}
+
+	while True:
+		# Wake up at least every minute for sections about to start
+		pods.changed.wait(timeout=min(resync, 60))
+		pods.changed.clear()
+
+		# Node events wake us too, so new nodes get images once Ready
+		all_pods, nodes = pods.snapshot()
+		puller.ensure(nodes, singleuser_images(all_pods, NAMESPACES))
+
+		# Pick up resizes and node pools made by anyone else
+		if time.time() - last_resync > resync:
+			if use_capacity:
+				existing_pools(CLUSTER, refresh=True)
+			else:
+				node_count = get_node_count(CLUSTER)
+			last_resync = time.time()
+
+		if use_capacity:
+			try:
+				targets = capacity_step(pods.v1, nodes, all_pods,
+					targets=targets, shrink=shrink)
+			except Exception as e:
+				# Try again on the next event rather than stop the controller
+				print('capacity step failed: {}'.format(e))
+			time.sleep(settle)
+			continue
+
+		counts = dict([(ns, pods.count(ns)) for ns in NAMESPACES])
+		cur_pods = sum(counts.values())
+		increment = nodes_to_add(expected_pods(counts), node_count)
+		if increment:
+			if resize(CLUSTER, NODE_POOL, node_count + increment):
+				node_count += increment
+		else:
+			print(cur_pods)
+
+		time.sleep(settle)
 
 ## MAIN
 NAMESPACES = ['datahub', 'prob140', 'stat28']
@@ -61,48 +392,84 @@ BUMP_INCREMENT = 2
 NODE_POOL = 'highmem-pool'
 USERS_PER_NODE = 24
 
-# How many nodes do we have?
-cmd = ['gcloud', 'container', 'clusters', 'describe', CLUSTER]
-p = subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout
-buf = p.read()
-p.close()
-
-try:
-	description = yaml.load(buf)
-except Exception as e:
-	print(str(e))
-	sys.exit(1)
-
-node_count = description['currentNodeCount']
-
-# How many pods does that accommodate?
-max_pods = node_count * USERS_PER_NODE
-
-# How many pods are active?
-cur_pods = 0
-for ns in NAMESPACES:
-	cur_pods += count_pods(ns)
-
-if cur_pods < POD_THRESHOLD * max_pods:
-	print(cur_pods)
-	sys.exit(0)
-
-new_node_count = node_count + BUMP_INCREMENT
-cmd = ['gcloud', '--quiet', 'container', 'clusters', 'resize', CLUSTER,
-	'--node-pool='+NODE_POOL, '--size', str(new_node_count)]
-print(' '.join(cmd))
-p = subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout
-buf = p.read()
-p.close()
-
-# Populate latest singleuser image on all nodes
-for ns in NAMESPACES:
-	hub_pod = get_hub_pod(ns)
-	image = get_singleuser_image(ns, hub_pod)
-	if not image: continue
-
-	cmd = ['./populate.bash', CLUSTER, image]
-	print(' '.join(cmd))
-	p = subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout
-	buf = p.read()
-	p.close()
+# Node pools managed with --capacity, with the hourly price of a node and
+# the allocatable (cpu, memory) of a new node in case a pool is empty. New
+# nodes go to the cheapest pool that fits; pools missing from the cluster
+# are left alone.
+NODE_POOLS = {
+	'highmem-pool': {'price': 0.2368, 'shape': ('3920m', '23Gi')},
+}
+MIN_NODES = 2
+# Seconds after which a size we asked for but never saw is forgotten
+TARGET_TTL = 900
+
+node_pools = None
+asked_at = {}
+
+# Hub APIs to read last activity from with --activity. The token is read
+# from JUPYTERHUB_API_TOKEN_<NAMESPACE>, e.g. JUPYTERHUB_API_TOKEN_DATAHUB.
+HUB_API = 'https://{}.berkeley.edu/hub/api'
+IDLE_SECONDS = 30 * 60
+STALE_SECONDS = 12 * 3600
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-w', '--watch', action='store_true',
+	help='Run as a controller driven by a pod watch instead of once')
+parser.add_argument('-c', '--capacity', action='store_true',
+	help='Size NODE_POOLS from pod requests and node allocatable')
+parser.add_argument('-s', '--shrink', action='store_true',
+	help='With --capacity, cordon under-used nodes and remove them once empty')
+parser.add_argument('--history',
+	help='CSV file of pod counts to record to and forecast from')
+parser.add_argument('--lead', type=int, default=900,
+	help='Seconds ahead of forecast load that nodes should be ready')
+parser.add_argument('--schedules',
+	help='Directory of per-namespace section schedules, e.g. datahub.yaml')
+parser.add_argument('--prewarm', type=int, default=20,
+	help='Minutes before a section starts to warm nodes and images')
+parser.add_argument('-a', '--activity', action='store_true',
+	help='With --capacity, do not count stale servers as users')
+parser.add_argument('--hub-db',
+	help='Read activity from hub sqlite copies, e.g. jupyterhub-{}.sqlite')
+parser.add_argument('--cull', action='store_true',
+	help='With --activity, stop stale servers through the hub API')
+parser.add_argument('--settle', type=float, default=5,
+	help='Minimum seconds between two scaling decisions in watch mode')
+parser.add_argument('--resync', type=float, default=300,
+	help='Seconds between node count and node pool refreshes in watch mode')
+args = parser.parse_args()
+if args.activity and not args.capacity:
+	parser.error('--activity only applies with --capacity')
+if args.cull and not args.activity:
+	parser.error('--cull only applies with --activity')
+if args.cull and args.hub_db:
+	parser.error('--cull stops servers through the hub API, not --hub-db')
+
+history = None
+if args.history:
+	from forecast import pod_history
+	history = pod_history(args.history, args.lead)
+
+tracker = None
+cull = args.cull
+if args.activity:
+	import os
+	from activity import activity, hub_api, hub_db
+	hubs = {}
+	for ns in NAMESPACES:
+		if args.hub_db:
+			hubs[ns] = hub_db(args.hub_db.format(ns))
+		else:
+			token = os.environ.get('JUPYTERHUB_API_TOKEN_' + ns.upper(), '')
+			hubs[ns] = hub_api(HUB_API.format(ns), token)
+	tracker = activity(hubs, IDLE_SECONDS, STALE_SECONDS)
+
+calendar = None
+if args.schedules:
+	from schedule import course_schedule
+	calendar = course_schedule(args.schedules, NAMESPACES, args.prewarm)
+
+if args.watch:
+	scale_forever(args.settle, args.resync, args.capacity, args.shrink)
+else:
+	scale_once(args.capacity, args.shrink)
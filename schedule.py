@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+'''Course timetables, so that nodes and images are warm before a section.
+
+Each namespace has a YAML file, e.g. schedules/datahub.yaml, listing its
+sections:
+
+	- name: data8 lab 101
+	  days: [mon, wed]
+	  start: '10:00'
+	  duration: 120      # minutes
+	  users: 40
+	- name: stat28 midterm
+	  date: 2017-03-15
+	  start: '18:30'
+	  duration: 90
+	  users: 60
+
+Times are in the local time zone of the host running the scaler.
+'''
+
+import datetime
+import os
+import yaml
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def load(path):
+	'''Return the sections of a schedule file, or none if it is missing.'''
+	if not os.path.exists(path): return []
+	sections = []
+	for entry in yaml.safe_load(open(path)) or []:
+		hour, minute = [int(x) for x in str(entry['start']).split(':')]
+		date = entry.get('date')
+		if isinstance(date, str):
+			date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+		sections.append({
+			'name': entry.get('name', entry['start']),
+			'days': [DAYS.index(d.lower()[:3]) for d in entry.get('days', [])],
+			'date': date,
+			'start': datetime.time(hour, minute),
+			'duration': datetime.timedelta(minutes=int(entry['duration'])),
+			'users': int(entry['users']),
+		})
+	return sections
+
+class course_schedule:
+	'''The sections of every namespace, and which of them need warm nodes.
+	   A section is warm from PREWARM minutes before it starts until it
+	   ends.'''
+
+	def __init__(self, directory, namespaces, prewarm=20):
+		self.prewarm = datetime.timedelta(minutes=prewarm)
+		self.sections = {}
+		for ns in namespaces:
+			self.sections[ns] = load(os.path.join(directory, ns + '.yaml'))
+		self.prepulled = set()
+
+	def _starts(self, section, now):
+		'''Return the start times of SECTION yesterday, today and tomorrow.'''
+		for offset in [-1, 0, 1]:
+			day = now.date() + datetime.timedelta(days=offset)
+			if section['date'] is not None:
+				if section['date'] != day: continue
+			elif day.weekday() not in section['days']:
+				continue
+			yield datetime.datetime.combine(day, section['start'])
+
+	def warm(self, now=None):
+		'''Return (namespace, section, start) of each warm section, where
+		   section is the section's dict from the schedule.'''
+		if now is None: now = datetime.datetime.now()
+		warm = []
+		for ns, sections in self.sections.items():
+			for section in sections:
+				for start in self._starts(section, now):
+					if start - self.prewarm <= now < start + section['duration']:
+						warm.append((ns, section, start))
+		return warm
+
+	def floor(self, now=None):
+		'''Return the number of users to provision for, per namespace.'''
+		floor = {}
+		for ns, section, start in self.warm(now):
+			floor[ns] = floor.get(ns, 0) + section['users']
+		return floor
+
+	def to_prepull(self, now=None):
+		'''Return the namespaces with a section about to start that was not
+		   returned before, whose singleuser image should be pulled now.'''
+		if now is None: now = datetime.datetime.now()
+		namespaces = set()
+		for ns, section, start in self.warm(now):
+			if now >= start: continue
+			key = (ns, section['name'], start)
+			if key in self.prepulled: continue
+			self.prepulled.add(key)
+			namespaces.add(ns)
+		return sorted(namespaces)
@@ -0,0 +1,20 @@
+import os
+import sys
+import time
+
+import pytest
+
+# The scripts import their neighbours as top-level modules
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'backup'))
+sys.path.insert(0, os.path.join(HERE, '..', 'archive'))
+
+@pytest.fixture
+def utc(monkeypatch):
+	'''Run in UTC, for code which buckets by local calendar day.'''
+	monkeypatch.setenv('TZ', 'UTC')
+	time.tzset()
+	yield
+	monkeypatch.undo()
+	time.tzset()
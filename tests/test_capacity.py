@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import pytest
+
+from capacity import parse_quantity, fits, pack, place, pool_capacity, POOL_LABEL
+
+GI = 2**30
+HIGHMEM = (4.0, 24 * GI)
+STANDARD = (4.0, 12 * GI)
+PRICES = {'highmem-pool': 0.24, 'standard-pool': 0.15}
+
+@pytest.mark.parametrize('quantity,value', [
+	('500m', 0.5), ('2Gi', 2 * GI), ('1M', 1e6), ('3', 3.0), (None, 0.0),
+])
+def test_parse_quantity(quantity, value):
+	assert parse_quantity(quantity) == value
+
+def test_fits_is_limited_by_the_scarcer_resource():
+	assert fits((4.0, 8 * GI), (0.5, 2 * GI)) == 4
+	assert fits((4.0, 8 * GI), (0, 0)) == float('inf')
+	assert fits((0.2, 8 * GI), (0.5, 1 * GI)) == 0
+
+def test_pack_fills_free_space_before_opening_bins():
+	bins = [[1.0, 3 * GI]]
+	opened, unplaceable = pack(bins, [(1.0, 2 * GI)] * 3 + [(8.0, GI)], HIGHMEM)
+	assert (opened, unplaceable) == (1, [(8.0, GI)])
+	assert bins[0] == [0.0, GI]
+
+def capacity(name, free=(), shape=None):
+	'''A pool_capacity with nodes of FREE (cpu, memory) each.'''
+	nodes = [SimpleNamespace(metadata=SimpleNamespace(name='{}-{}'.format(name, i),
+			labels={POOL_LABEL: name}),
+		spec=SimpleNamespace(unschedulable=False),
+		status=SimpleNamespace(allocatable={'cpu': str(f[0]), 'memory': str(f[1])}))
+		for i, f in enumerate(free)]
+	return pool_capacity(name, nodes, [], shape)
+
+def test_small_pods_go_to_the_cheapest_pool():
+	pools = {'highmem-pool': capacity('highmem-pool', shape=HIGHMEM),
+		'standard-pool': capacity('standard-pool', shape=STANDARD)}
+	new = place(pools, [(1.0, GI, None)] * 6, PRICES)
+	assert new == {'highmem-pool': 0, 'standard-pool': 2}
+
+def test_pods_too_big_for_the_cheap_pool_go_to_the_one_they_fit():
+	pools = {'highmem-pool': capacity('highmem-pool', shape=HIGHMEM),
+		'standard-pool': capacity('standard-pool', shape=STANDARD)}
+	new = place(pools, [(1.0, 16 * GI, None)] * 3, PRICES)
+	assert new == {'highmem-pool': 3, 'standard-pool': 0}
+
+def test_fewer_expensive_nodes_can_beat_many_cheap_ones():
+	pools = {'highmem-pool': capacity('highmem-pool', shape=HIGHMEM),
+		'standard-pool': capacity('standard-pool', shape=STANDARD)}
+	# Two highmem nodes hold what takes four standard ones
+	new = place(pools, [(0.5, 6 * GI, None)] * 8, PRICES)
+	assert new == {'highmem-pool': 2, 'standard-pool': 0}
+
+def test_free_and_booting_nodes_are_used_first():
+	pools = {'highmem-pool': capacity('highmem-pool', [HIGHMEM]),
+		'standard-pool': capacity('standard-pool', shape=STANDARD)}
+	requests = [(1.0, 3 * GI, None)] * 8
+	assert place(pools, requests, PRICES) == {'highmem-pool': 0, 'standard-pool': 1}
+	assert place(pools, requests, PRICES, {'standard-pool': 1}) == \
+		{'highmem-pool': 0, 'standard-pool': 0}
+
+def test_pinned_pods_grow_their_own_pool_only():
+	pools = {'highmem-pool': capacity('highmem-pool', shape=HIGHMEM),
+		'standard-pool': capacity('standard-pool', [STANDARD])}
+	requests = [(1.0, GI, 'highmem-pool')] * 2 + [(1.0, GI, 'gpu-pool')]
+	# The free standard node does not help, and an unmanaged pool is left alone
+	assert place(pools, requests, PRICES) == {'highmem-pool': 1, 'standard-pool': 0}
+
+def test_pods_that_fit_nowhere_open_nothing():
+	pools = {'standard-pool': capacity('standard-pool', shape=STANDARD)}
+	assert place(pools, [(1.0, 64 * GI, None)], PRICES) == {'standard-pool': 0}
@@ -0,0 +1,90 @@
+from types import SimpleNamespace as obj
+
+import pytest
+
+from capacity import pool_capacity, POOL_LABEL, parse_quantity
+from consolidate import removable_nodes, empty_nodes, ANNOTATION
+
+SHAPE = ('3920m', '23Gi')
+SLOT = tuple([parse_quantity(x) / 24 for x in SHAPE])
+
+def node(name, annotation=None):
+	return obj(metadata=obj(name=name, labels={POOL_LABEL: 'highmem-pool'},
+			annotations={ANNOTATION: annotation} if annotation else {}),
+		spec=obj(unschedulable=bool(annotation)),
+		status=obj(allocatable={'cpu': SHAPE[0], 'memory': SHAPE[1]}))
+
+def pod(node_name, name='jupyter-someone', namespace='datahub', owner=None):
+	requests = {'cpu': '500m', 'memory': '1Gi'}
+	return obj(metadata=obj(name=name, namespace=namespace,
+			owner_references=[obj(kind=owner)] if owner else []),
+		spec=obj(node_name=node_name,
+			containers=[obj(resources=obj(requests=requests))]))
+
+def is_singleuser(p):
+	return p.metadata.name.startswith('jupyter-')
+
+def nodes(n):
+	return [node('node-{}'.format(i)) for i in range(n)]
+
+CASES = [
+	# nodes, pods, reserve, floor, slot, number of nodes to cordon
+	# Overnight: nobody is on the pool, so all but the floor go
+	(nodes(10), [], 0, 2, SLOT, 8),
+	(nodes(10), [], 0, 2, None, 0),
+	(nodes(10), [pod('node-0')], 0, 2, SLOT, 8),
+	# Room for the reserve is kept: 24 slots a node
+	(nodes(3), [], 40, 0, SLOT, 1),
+	(nodes(3), [], 100, 0, SLOT, 0),
+	# A hub keeps its node
+	(nodes(2), [pod('node-1', name='hub-deployment', owner='ReplicaSet')],
+		0, 0, SLOT, 1),
+]
+
+@pytest.mark.parametrize('pool_nodes,pods,reserve,floor,slot,count', CASES)
+def test_removable_nodes(pool_nodes, pods, reserve, floor, slot, count):
+	pool = pool_capacity('highmem-pool', pool_nodes, pods)
+	chosen = removable_nodes(pool, pods, is_singleuser, reserve, floor, slot)
+	assert len(chosen) == count
+	blocked = set([p.spec.node_name for p in pods])
+	assert not blocked & set(chosen)
+
+def test_empty_nodes():
+	pool_nodes = [node('a', 'draining'), node('b', 'draining'), node('c'),
+		node('d', 'deleting')]
+	pods = [pod('a'), pod('b', name='fluentd', owner='DaemonSet'),
+		pod('c')]
+	assert empty_nodes(pool_nodes, pods) == ['b']
+
+class fake_v1:
+	def __init__(self):
+		self.patches = []
+
+	def patch_node(self, name, body):
+		self.patches.append((name, body))
+
+def fake_gcloud(fail):
+	'''A subprocess.run whose delete-instances exits 1 if FAIL.'''
+	import subprocess
+	def run(cmd, stdout=None, stderr=None):
+		if 'describe' in cmd:
+			out = b'https://x/zones/us-central1-a/instanceGroupManagers/gke-prod-highmem\n'
+			return subprocess.CompletedProcess(cmd, 0, out, b'')
+		return subprocess.CompletedProcess(cmd, 1 if fail else 0, b'',
+			b'quota' if fail else b'')
+	return run
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_delete_nodes(monkeypatch, fail):
+	import consolidate
+	monkeypatch.setattr(consolidate.subprocess, 'run', fake_gcloud(fail))
+	v1 = fake_v1()
+	assert consolidate.delete_nodes(v1, 'prod', 'highmem-pool', ['a', 'b']) != fail
+	states = [(name, body['metadata']['annotations'][ANNOTATION])
+		for name, body in v1.patches]
+	if fail:
+		# Back to schedulable, and no longer ours
+		assert states == [('a', None), ('b', None)]
+		assert not any([body['spec']['unschedulable'] for _, body in v1.patches])
+	else:
+		assert states == [('a', 'deleting'), ('b', 'deleting')]
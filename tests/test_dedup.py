@@ -0,0 +1,116 @@
+import io
+import os
+import shutil
+import tarfile
+
+import pytest
+
+from dedup import blob_store, pack, rebuild, course_digests, file_digest
+
+pytestmark = pytest.mark.skipif(not shutil.which('tar') or not shutil.which('gzip'),
+	reason='needs tar and gzip')
+
+SIZE = 64
+
+class fake_bucket:
+	def __init__(self, names=()):
+		self.names = list(names)
+
+	def list_blobs(self, prefix):
+		return [type('blob', (), {'name': prefix + n + '.gz'}) for n in self.names]
+
+class recording_store(blob_store):
+	'''A blob_store keeping blob content in memory instead of uploading it.'''
+
+	def __init__(self, stored=(), course=()):
+		bucket = fake_bucket(stored)
+		blob_store.__init__(self, lambda: bucket, None, 'bucket', 'berkeley.edu', course)
+		self.uploaded = {}
+
+	def _upload(self, digest, path):
+		with open(path, 'rb') as f:
+			self.uploaded[digest] = f.read()
+
+class sink:
+	def __init__(self):
+		self.data = io.BytesIO()
+
+	def write(self, data):
+		self.data.write(data)
+
+	def close(self):
+		pass
+
+def home(root, user, files):
+	'''Write FILES, a dict of relative paths to content, into ROOT/USER.'''
+	for path, content in files.items():
+		full = os.path.join(root, user, path)
+		os.makedirs(os.path.dirname(full), exist_ok=True)
+		with open(full, 'wb') as f:
+			f.write(content)
+
+def archive(root, user, store):
+	out = sink()
+	manifest = pack(root, user, store, out, ('datahub', user), min_size=SIZE, sudo=False)
+	out.data.seek(0)
+	with tarfile.open(fileobj=out.data, mode='r:gz') as tar:
+		names = sorted(m.name for m in tar if m.isfile())
+	out.data.seek(0)
+	return manifest, names, out.data
+
+COURSE = b'course notebook ' * 16
+DATASET = b'shared dataset ' * 16
+PRIVATE = b'my own work ' * 16
+
+@pytest.fixture
+def root(tmp_path):
+	root = str(tmp_path / 'disks')
+	home(root, 'alice', {'lab01/lab01.ipynb': COURSE, 'data.csv': DATASET,
+		'project.ipynb': PRIVATE, 'small.txt': b'hi'})
+	home(root, 'bob', {'lab01/lab01.ipynb': COURSE, 'copy/data.csv': DATASET})
+	home(str(tmp_path / 'materials'), 'labs', {'lab01.ipynb': COURSE})
+	return root
+
+def test_only_shared_content_becomes_blobs(root, tmp_path):
+	store = recording_store(course=course_digests([str(tmp_path / 'materials')], SIZE))
+	manifest, names, _ = archive(root, 'alice', store)
+	# The course file is known; the dataset is only alice's so far
+	assert [f['path'] for f in manifest['files']] == ['alice/lab01/lab01.ipynb']
+	assert names == ['alice/data.csv', 'alice/project.ipynb', 'alice/small.txt']
+	assert list(store.uploaded.values()) == [COURSE]
+
+	manifest, names, _ = archive(root, 'bob', store)
+	# Bob has the dataset too, so now it is shared
+	assert sorted(f['path'] for f in manifest['files']) == \
+		['bob/copy/data.csv', 'bob/lab01/lab01.ipynb']
+	assert names == []
+	assert sorted(store.uploaded.values()) == sorted([COURSE, DATASET])
+	assert PRIVATE not in store.uploaded.values()
+
+def test_content_already_in_the_bucket_is_shared(root):
+	store = recording_store(stored=[file_digest(os.path.join(root, 'alice', 'project.ipynb'))])
+	manifest, names, _ = archive(root, 'alice', store)
+	assert [f['path'] for f in manifest['files']] == ['alice/project.ipynb']
+	# Nothing is uploaded twice
+	assert store.uploaded == {}
+
+def test_the_same_user_twice_is_not_sharing(root):
+	store = recording_store()
+	archive(root, 'alice', store)
+	manifest, _, _ = archive(root, 'alice', store)
+	assert manifest['files'] == []
+	assert store.uploaded == {}
+
+def test_rebuild_puts_unique_and_shared_files_back(root, tmp_path):
+	store = recording_store(course=course_digests([str(tmp_path / 'materials')], SIZE))
+	manifest, _, tarball = archive(root, 'alice', store)
+	path = str(tmp_path / 'rest.tar.gz')
+	with open(path, 'wb') as f:
+		f.write(tarball.read())
+	out = io.BytesIO()
+	rebuild(manifest, path, lambda digest: io.BytesIO(store.uploaded[digest]), out)
+	out.seek(0)
+	with tarfile.open(fileobj=out, mode='r:gz') as tar:
+		files = dict((m.name, tar.extractfile(m).read()) for m in tar if m.isfile())
+	assert files == {'alice/lab01/lab01.ipynb': COURSE, 'alice/data.csv': DATASET,
+		'alice/project.ipynb': PRIVATE, 'alice/small.txt': b'hi'}
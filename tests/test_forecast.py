@@ -0,0 +1,72 @@
+import json
+
+from forecast import load, quantile, seasonal_forecast, pod_history, \
+	backtest, WEEK, DAY
+
+# A Monday 10:00 UTC
+MONDAY = 1494237600.
+
+def test_quantile_picks_from_the_top():
+	values = list(range(10))
+	assert quantile(values, 0.9) == 9
+	assert quantile(values, 0.5) == 5
+	assert quantile(values, 1.0) == 9
+	assert quantile([3], 0.9) == 3
+
+def test_slots_fall_back_from_weekly_to_daily():
+	model = seasonal_forecast(slot=900, q=0.9, min_samples=2)
+	model.fit([(MONDAY - WEEK, 40), (MONDAY - 2 * WEEK, 50)])
+	assert model.expected(MONDAY) == 50
+	# Tuesday has no weekly samples, but Monday's count for the time of day
+	assert model.expected(MONDAY + DAY) == 50
+	# Nothing is known fifteen minutes later
+	assert model.expected(MONDAY + 900) is None
+
+def test_a_slot_needs_min_samples():
+	model = seasonal_forecast(min_samples=3)
+	model.fit([(MONDAY - WEEK, 40), (MONDAY - 2 * WEEK, 50)])
+	assert model.expected(MONDAY) is None
+
+def test_quiet_weeks_do_not_hide_the_peak():
+	model = seasonal_forecast(q=0.75)
+	model.fit([(MONDAY - n * WEEK, pods) for n, pods in
+		enumerate([0, 2, 3, 60], 1)])
+	assert model.expected(MONDAY) == 60
+
+def test_predict_takes_the_peak_over_the_lead_and_at_least_current():
+	model = seasonal_forecast(slot=900)
+	for week in [1, 2]:
+		model.add(MONDAY - week * WEEK, 10)
+		model.add(MONDAY - week * WEEK + 1800, 80)
+	assert model.predict(MONDAY, 900, 5) == 10
+	assert model.predict(MONDAY, 1800, 5) == 80
+	assert model.predict(MONDAY, 900, 30) == 30
+
+def test_load_reads_csv_and_datadog_json(tmp_path):
+	csv = tmp_path / 'history.csv'
+	csv.write_text('200,4\ngarbage\n100,3\n300,x\n')
+	assert load(str(csv)) == [(100., 3.), (200., 4.)]
+	pointlist = tmp_path / 'history.json'
+	pointlist.write_text(json.dumps([[1494237600000, 7], [1494237660000, None]]))
+	assert load(str(pointlist)) == [(MONDAY, 7.)]
+	assert load(str(tmp_path / 'missing.csv')) == []
+
+def test_history_records_at_most_once_per_interval(tmp_path):
+	path = str(tmp_path / 'history.csv')
+	history = pod_history(path, lead=900, interval=60)
+	history.observe(10, now=MONDAY)
+	history.observe(11, now=MONDAY + 30)
+	history.observe(12, now=MONDAY + 60)
+	assert load(path) == [(MONDAY, 10.), (MONDAY + 60, 12.)]
+	# A new process learns from what was recorded
+	again = pod_history(path, lead=900, min_samples=1)
+	assert again.observe(0, now=MONDAY + WEEK) == 12
+
+def test_backtest_beats_reacting_to_a_weekly_ramp():
+	history = []
+	for week in range(4):
+		start = MONDAY + week * WEEK
+		history += [(start, 0), (start + 900, 100), (start + 1800, 0)]
+	stats = backtest(history, 900, 24, 0.9, 900, 0.9)
+	assert stats['samples'] == len(history) - 1
+	assert stats['under'] < stats['reactive_under']
@@ -0,0 +1,139 @@
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+
+import pytest
+
+import gcs_stream
+from gcs_stream import resumable_upload, stream_tar, UploadError
+
+class response(dict):
+	def __init__(self, status, **headers):
+		dict.__init__(self, headers)
+		self.status = status
+
+class fake_gcs:
+	'''A resumable upload endpoint. It stores at most ACCEPT bytes of each
+	   chunk, and answers the chunks it is sent with FAILURES in turn,
+	   keeping the first half of a chunk it fails.'''
+
+	redirect_codes = set([300, 301, 302, 303, 307, 308])
+
+	def __init__(self, accept=None, failures=()):
+		self.accept = accept
+		self.failures = list(failures)
+		self.data = bytearray()
+		self.puts = []
+
+	def request(self, uri, method, body=None, headers=None):
+		if method == 'POST':
+			return response(200, location='https://upload/session'), b''
+		first, last, total = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)',
+			headers['Content-Range']).groups()
+		self.puts.append(headers['Content-Range'])
+		if body:
+			# A client resumes exactly where the server's data ends
+			assert int(first) == len(self.data)
+			assert int(last) - int(first) + 1 == len(body)
+			if self.failures:
+				status = self.failures.pop(0)
+				self.data += body[:len(body) // 2]
+				if status is None: raise ConnectionResetError('reset by peer')
+				return response(status), b'backend error'
+			self.data += body[:self.accept] if self.accept else body
+		if total != '*' and len(self.data) == int(total):
+			return response(200), json.dumps({'size': total}).encode()
+		if not self.data:
+			return response(308), b''
+		return response(308, range='bytes=0-{}'.format(len(self.data) - 1)), b''
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+	monkeypatch.setattr(gcs_stream.random, 'uniform', lambda a, b: 0)
+
+def upload(server, data, chunk_size=4, writes=3):
+	u = resumable_upload(server, 'bucket', 'object', 'application/gzip', chunk_size)
+	step = max(1, len(data) // writes)
+	for start in range(0, len(data), step):
+		u.write(data[start:start + step])
+	return u.close()
+
+DATA = bytes(range(23))
+
+def test_308_is_not_followed_as_a_redirect():
+	server = fake_gcs()
+	resumable_upload(server, 'bucket', 'object', 'application/gzip')
+	assert 308 not in server.redirect_codes
+
+def test_chunks_then_final_size():
+	server = fake_gcs()
+	assert upload(server, DATA) == {'size': '23'}
+	assert bytes(server.data) == DATA
+	assert server.puts[0] == 'bytes 0-3/*'
+	assert server.puts[-1] == 'bytes 20-22/23'
+
+def test_partial_range_resends_only_the_rest():
+	server = fake_gcs(accept=3)
+	assert upload(server, DATA) == {'size': '23'}
+	assert bytes(server.data) == DATA
+	# Each chunk of 4 arrives as 3 bytes and then 1
+	assert server.puts[:2] == ['bytes 0-3/*', 'bytes 3-3/*']
+
+@pytest.mark.parametrize('failure', [503, None])
+def test_transient_failure_asks_what_arrived(failure):
+	server = fake_gcs(failures=[failure])
+	assert upload(server, DATA) == {'size': '23'}
+	assert bytes(server.data) == DATA
+	# Half of the failed chunk arrived, so the query says 0-1 and the
+	# retry starts at 2
+	assert server.puts[:3] == ['bytes 0-3/*', 'bytes */*', 'bytes 2-3/*']
+
+def test_permanent_failure_raises():
+	server = fake_gcs(failures=[403])
+	with pytest.raises(UploadError):
+		upload(server, DATA)
+
+def test_empty_object():
+	server = fake_gcs()
+	u = resumable_upload(server, 'bucket', 'object', 'application/gzip', 4)
+	assert u.close() == {'size': '0'}
+	assert server.puts == ['bytes */0']
+
+class sink:
+	def __init__(self):
+		self.data = io.BytesIO()
+		self.closed = False
+
+	def write(self, data):
+		self.data.write(data)
+
+	def close(self):
+		self.closed = True
+
+@pytest.fixture
+def home(tmp_path):
+	os.makedirs(str(tmp_path / 'home' / 'lost+found'))
+	(tmp_path / 'home' / 'notebook.ipynb').write_text('{}')
+	(tmp_path / 'home' / 'data.csv').write_text('a,b\n1,2\n')
+	return str(tmp_path)
+
+@pytest.mark.skipif(not shutil.which('tar') or not shutil.which('gzip'),
+	reason='needs tar and gzip')
+def test_stream_tar(home):
+	out = sink()
+	size = stream_tar(home, 'home', out, sudo=False, read_size=16)
+	assert out.closed and size == len(out.data.getvalue())
+	out.data.seek(0)
+	with tarfile.open(fileobj=out.data, mode='r:gz') as tar:
+		assert sorted(tar.getnames()) == ['home', 'home/data.csv', 'home/notebook.ipynb']
+
+@pytest.mark.skipif(not shutil.which('tar') or not shutil.which('gzip'),
+	reason='needs tar and gzip')
+def test_stream_tar_leaves_sink_open_on_failure(home):
+	out = sink()
+	with pytest.raises(Exception):
+		stream_tar(home, 'missing', out, sudo=False)
+	assert not out.closed
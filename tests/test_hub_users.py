@@ -0,0 +1,75 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from hub_users import hub_users, pod_from_claim
+
+def write_db(path, users):
+	'''Write a hub database with USERS, a dict of names to spawner state.'''
+	if os.path.exists(path): os.remove(path)
+	conn = sqlite3.connect(path)
+	conn.execute('create table users (name text, state text)')
+	conn.executemany('insert into users values (?, ?)',
+		[(name, state if state is None or isinstance(state, str) else json.dumps(state))
+			for name, state in users.items()])
+	conn.commit()
+	conn.close()
+
+@pytest.fixture
+def tmpl(tmp_path):
+	write_db(str(tmp_path / 'jupyterhub-datahub.sqlite'), {
+		'alice': {'pod_name': 'jupyter-alice-001'},
+		'bob': {'pod_name': 'jupyter-bob'},
+		'never-started': None,
+		'broken': 'not json',
+		'no-pod': {'other': 1},
+	})
+	return str(tmp_path / 'jupyterhub-{}.sqlite')
+
+def test_pod_from_claim_replaces_the_prefix_only():
+	assert pod_from_claim('claim-alice-001') == 'jupyter-alice-001'
+	assert pod_from_claim('claim-claimant') == 'jupyter-claimant'
+
+def test_resolve_splits_users_and_orphans(tmpl):
+	claims = [('datahub', 'claim-alice-001', 'pd-1'), ('datahub', 'claim-carol', 'pd-2'),
+		('stat28', 'claim-dave', 'pd-3'), ('datahub', 'claim-bob', 'pd-4')]
+	resolved, orphans = hub_users(tmpl).resolve(claims)
+	assert resolved == [('datahub', 'claim-alice-001', 'pd-1', 'alice'),
+		('datahub', 'claim-bob', 'pd-4', 'bob')]
+	assert [o[:3] for o in orphans] == [('datahub', 'claim-carol', 'pd-2'),
+		('stat28', 'claim-dave', 'pd-3')]
+	assert 'orphaned' in orphans[0][3]
+	assert 'Could not read hub database' in orphans[1][3]
+
+def test_users_include_those_without_state(tmpl):
+	assert sorted(hub_users(tmpl).users('datahub')) == \
+		['alice', 'bob', 'broken', 'never-started', 'no-pod']
+
+def test_database_is_read_once_while_unchanged(tmpl, monkeypatch):
+	users = hub_users(tmpl)
+	assert users.user_from_claim('datahub', 'claim-bob') == 'bob'
+	def no_connect(*args, **kwargs):
+		raise AssertionError('database read again')
+	monkeypatch.setattr(sqlite3, 'connect', no_connect)
+	assert users.user_from_claim('datahub', 'claim-alice-001') == 'alice'
+	assert users.user_from_claim('datahub', 'claim-nobody') is None
+
+def test_a_new_copy_of_the_database_is_read_again(tmpl):
+	users = hub_users(tmpl)
+	assert users.user_from_claim('datahub', 'claim-carol') is None
+	write_db(tmpl.format('datahub'), {'carol': {'pod_name': 'jupyter-carol'}})
+	assert users.user_from_claim('datahub', 'claim-carol') == 'carol'
+	assert users.user_from_claim('datahub', 'claim-bob') is None
+
+def test_a_missing_database_fails_until_it_appears(tmpl):
+	users = hub_users(tmpl)
+	with pytest.raises(sqlite3.Error):
+		users.users('stat28')
+	# The failure is remembered rather than tried for every claim
+	with pytest.raises(sqlite3.Error):
+		users.users('stat28')
+	assert not os.path.exists(tmpl.format('stat28'))
+	write_db(tmpl.format('stat28'), {'dave': {'pod_name': 'jupyter-dave'}})
+	assert users.users('stat28') == ['dave']
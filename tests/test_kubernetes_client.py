@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('kubernetes')
+
+import kubernetes_client
+from kubernetes_client import k8s_control
+
+class paged_v1:
+	'''Serves claims and volumes in pages of PAGE_SIZE, keeping every call.'''
+
+	def __init__(self, claims, volumes):
+		self.claims = claims
+		self.volumes = volumes
+		self.calls = []
+
+	def _page(self, name, items, limit, _continue=None, **kwargs):
+		self.calls.append((name, _continue, kwargs))
+		start = int(_continue or 0)
+		end = start + limit
+		token = str(end) if end < len(items) else None
+		return SimpleNamespace(items=items[start:end],
+			metadata=SimpleNamespace(_continue=token))
+
+	def list_namespaced_persistent_volume_claim(self, namespace, **kwargs):
+		return self._page('namespaced', [c for c in self.claims
+			if c.metadata.namespace == namespace], **kwargs)
+
+	def list_persistent_volume_claim_for_all_namespaces(self, **kwargs):
+		return self._page('claims', self.claims, **kwargs)
+
+	def list_persistent_volume(self, **kwargs):
+		return self._page('volumes', self.volumes, **kwargs)
+
+def claim(ns, name, volume):
+	return SimpleNamespace(metadata=SimpleNamespace(namespace=ns, name=name),
+		spec=SimpleNamespace(volume_name=volume))
+
+def volume(name, pd=None):
+	disk = SimpleNamespace(pd_name=pd) if pd else None
+	return SimpleNamespace(metadata=SimpleNamespace(name=name),
+		spec=SimpleNamespace(gce_persistent_disk=disk))
+
+@pytest.fixture
+def k8s(monkeypatch):
+	monkeypatch.setattr(kubernetes_client, 'PAGE_SIZE', 2)
+	claims = [claim('datahub', 'claim-{}'.format(i), 'pv-{}'.format(i)) for i in range(5)]
+	claims += [claim('prob140', 'claim-a', 'pv-a'), claim('datahub', 'pending', None)]
+	volumes = [volume('pv-{}'.format(i), 'pd-{}'.format(i)) for i in range(5)]
+	volumes += [volume('pv-a', 'pd-a'), volume('pv-nfs'), volume('pv-unbound', 'pd-x')]
+	control = k8s_control.__new__(k8s_control)
+	control.v1 = paged_v1(claims, volumes)
+	return control
+
+def test_follows_continue_tokens_to_the_last_page(k8s):
+	mappings = k8s.get_volume_mappings(['datahub'])
+	assert sorted(mappings) == [('datahub', 'claim-{}'.format(i), 'pv-{}'.format(i),
+		'pd-{}'.format(i)) for i in range(5)]
+	namespaced = [c for c in k8s.v1.calls if c[0] == 'namespaced']
+	assert [token for _, token, _ in namespaced] == [None, '2', '4']
+	volumes = [c for c in k8s.v1.calls if c[0] == 'volumes']
+	assert [token for _, token, _ in volumes] == [None, '2', '4', '6']
+
+def test_several_namespaces_list_all_claims_once(k8s):
+	mappings = k8s.get_volume_mappings(['datahub', 'prob140'])
+	assert len(mappings) == 6
+	assert ('prob140', 'claim-a', 'pv-a', 'pd-a') in mappings
+	assert not [c for c in k8s.v1.calls if c[0] == 'namespaced']
+
+def test_unset_selectors_are_not_sent(k8s):
+	k8s.get_volume_mappings()
+	assert all(kwargs == {} for name, _, kwargs in k8s.v1.calls if name != 'namespaced')
+	k8s.v1.calls = []
+	k8s.get_volume_mappings(label_selector='app=jupyterhub')
+	claims = [kwargs for name, _, kwargs in k8s.v1.calls if name == 'claims']
+	assert claims and all(kwargs == {'label_selector': 'app=jupyterhub'} for kwargs in claims)
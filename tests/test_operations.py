@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+from operations import operation_tracker, OperationError, operation_zone
+
+class fake_compute:
+	'''Operations become DONE after being fetched POLLS times. Fetches of
+	   names in FLAKY fail once.'''
+
+	def __init__(self, polls=2, flaky=(), errors=None):
+		self.polls = polls
+		self.flaky = set(flaky)
+		self.errors = errors or {}
+		self.fetched = {}
+		self.batches = []
+		self.lock = threading.Lock()
+
+	def zoneOperations(self):
+		return self
+
+	def globalOperations(self):
+		return self
+
+	def get(self, project, operation, zone=None):
+		return (zone, operation)
+
+	def new_batch_http_request(self, callback):
+		compute = self
+		class batch:
+			def __init__(self):
+				self.requests = []
+
+			def add(self, request, request_id):
+				self.requests.append((request_id, request))
+
+			def execute(self, http=None):
+				with compute.lock:
+					compute.batches.append([r for r, _ in self.requests])
+				for request_id, (zone, name) in self.requests:
+					callback(request_id, *compute.fetch(zone, name))
+		return batch()
+
+	def fetch(self, zone, name):
+		with self.lock:
+			if name in self.flaky:
+				self.flaky.discard(name)
+				return None, IOError('connection reset')
+			n = self.fetched[name] = self.fetched.get(name, 0) + 1
+		operation = {'name': name, 'status': 'DONE' if n >= self.polls else 'RUNNING'}
+		if zone: operation['zone'] = 'projects/p/zones/' + zone
+		if operation['status'] == 'DONE' and name in self.errors:
+			operation['error'] = {'errors': self.errors[name]}
+		return operation, None
+
+class budget:
+	def __init__(self, burst):
+		self.burst = burst
+		self.taken = []
+
+	def take(self, n=1):
+		self.taken.append(n)
+
+class client:
+	def __init__(self, burst=None):
+		self.budgets = {'compute': budget(burst)} if burst else {}
+
+	def http(self):
+		return None
+
+def tracker(compute, **kwargs):
+	kwargs.setdefault('min_interval', 0.01)
+	kwargs.setdefault('max_interval', 0.05)
+	return operation_tracker(kwargs.pop('client', client()), compute, 'p', **kwargs)
+
+def running(name, zone='us-central1-a'):
+	operation = {'name': name, 'status': 'RUNNING'}
+	if zone: operation['zone'] = 'https://x/projects/p/zones/' + zone
+	return operation
+
+def wait_all(t, operations, **kwargs):
+	results, errors = {}, {}
+	def wait(operation):
+		try:
+			results[operation['name']] = t.wait(operation, **kwargs)
+		except Exception as e:
+			errors[operation['name']] = e
+	threads = [threading.Thread(target=wait, args=(o,)) for o in operations]
+	for thread in threads: thread.start()
+	for thread in threads: thread.join(10)
+	return results, errors
+
+def test_zone_of_zone_and_global_operations():
+	assert operation_zone(running('a')) == 'us-central1-a'
+	assert operation_zone(running('a', zone=None)) is None
+
+def test_done_operations_are_not_polled():
+	compute = fake_compute()
+	t = tracker(compute)
+	assert t.wait({'name': 'a', 'status': 'DONE'})['name'] == 'a'
+	assert t.thread is None and compute.batches == []
+
+def test_waiters_share_batches():
+	compute = fake_compute(polls=3)
+	t = tracker(compute, batch_size=4)
+	operations = [running('op-{}'.format(i), zone=None if i % 2 else 'z')
+		for i in range(10)]
+	results, errors = wait_all(t, operations)
+	assert errors == {} and len(results) == 10
+	assert all(r['status'] == 'DONE' for r in results.values())
+	# Every operation was fetched until done, never more than once a poll
+	assert set(compute.fetched.values()) == set([3])
+	assert max(len(b) for b in compute.batches) <= 4
+	assert t.stats['operations'] == 10
+
+def test_batches_fit_the_budget():
+	c = client(burst=3)
+	compute = fake_compute(polls=1)
+	t = tracker(compute, client=c, batch_size=100)
+	assert t.batch_size == 3
+	wait_all(t, [running('op-{}'.format(i)) for i in range(7)])
+	assert sum(c.budgets['compute'].taken) == sum(len(b) for b in compute.batches)
+	assert max(c.budgets['compute'].taken) <= 3
+
+def test_failed_fetches_are_tried_again():
+	compute = fake_compute(polls=1, flaky=['b'])
+	t = tracker(compute)
+	results, errors = wait_all(t, [running('a'), running('b')])
+	assert sorted(results) == ['a', 'b']
+	assert t.stats['errors'] == 1
+
+def test_operation_errors_raise_unless_ignored():
+	compute = fake_compute(polls=1, errors={
+		'bad': [{'code': 'QUOTA_EXCEEDED', 'message': 'no'}],
+		'exists': [{'code': 'RESOURCE_ALREADY_EXISTS', 'message': 'fine'}]})
+	t = tracker(compute)
+	results, errors = wait_all(t, [running('bad'), running('exists')],
+		ignore=('RESOURCE_ALREADY_EXISTS',))
+	assert list(results) == ['exists']
+	assert isinstance(errors['bad'], OperationError)
+	assert errors['bad'].errors[0]['code'] == 'QUOTA_EXCEEDED'
+
+def test_timeout_stops_waiting_and_polling():
+	compute = fake_compute(polls=10**6)
+	t = tracker(compute, timeout=0.1)
+	with pytest.raises(TimeoutError):
+		t.wait(running('slow'))
+	assert t.pending == {}
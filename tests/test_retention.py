@@ -0,0 +1,87 @@
+import datetime
+
+import pytest
+
+from retention import expired_snapshots, parse_policy, snapshot_name, \
+	is_backup_snapshot, MAX_NAME_LEN
+
+pytestmark = pytest.mark.usefixtures('utc')
+
+def at(day, hour=12):
+	return datetime.datetime.strptime(day, '%Y-%m-%d').replace(hour=hour,
+		tzinfo=datetime.timezone.utc)
+
+def backup(day, hour=12, disk='pd-1', **fields):
+	'''A labelled, ready backup of DISK taken on DAY, named after both.'''
+	snapshot = {'name': '{}-{}-{:02d}'.format(disk, day, hour),
+		'sourceDiskId': disk, 'status': 'READY', 'labels': {'created-by': 'backup-disks'},
+		'creationTimestamp': at(day, hour).strftime('%Y-%m-%dT%H:%M:%SZ')}
+	snapshot.update(fields)
+	return snapshot
+
+def expire(policy, snapshots, now):
+	return sorted([s['name'] for s in expired_snapshots(snapshots,
+		parse_policy(policy), at(now, 18))])
+
+def test_daily_keeps_the_last_n_days_counting_today():
+	days = ['2017-05-{:02d}'.format(d) for d in range(10, 5, -1)]
+	assert expire('daily=3', [backup(d) for d in days], '2017-05-10') == \
+		['pd-1-2017-05-06-12', 'pd-1-2017-05-07-12']
+
+def test_one_snapshot_per_day_survives():
+	snapshots = [backup('2017-05-09', h) for h in [6, 12, 23]] + [backup('2017-05-10')]
+	assert expire('daily=2', snapshots, '2017-05-10') == \
+		['pd-1-2017-05-09-06', 'pd-1-2017-05-09-12']
+
+def test_weekly_buckets_turn_over_between_saturday_and_sunday():
+	# 2017-05-06 is a Saturday and 2017-05-07 a Sunday, so the newest
+	# snapshot stands for the week of the 7th and the 6th for the one before
+	snapshots = [backup('2017-05-10'), backup('2017-05-07'),
+		backup('2017-05-06'), backup('2017-05-05')]
+	assert expire('weekly=2', snapshots, '2017-05-10') == \
+		['pd-1-2017-05-05-12', 'pd-1-2017-05-07-12']
+
+def test_term_boundary():
+	# Summer starts on May 20: two terms back from June is spring
+	snapshots = [backup('2017-06-01'), backup('2017-05-21'),
+		backup('2017-05-19'), backup('2017-01-05'), backup('2016-12-20')]
+	assert expire('term=2', snapshots, '2017-06-01') == \
+		['pd-1-2016-12-20-12', 'pd-1-2017-01-05-12', 'pd-1-2017-05-21-12']
+
+def test_tiers_keep_what_any_of_them_keeps():
+	snapshots = [backup('2017-05-10'), backup('2017-05-09'),
+		backup('2017-05-02'), backup('2017-05-01'), backup('2017-04-25')]
+	assert expire('daily=2', snapshots, '2017-05-10') == \
+		['pd-1-2017-04-25-12', 'pd-1-2017-05-01-12', 'pd-1-2017-05-02-12']
+	assert expire('daily=2,weekly=3', snapshots, '2017-05-10') == \
+		['pd-1-2017-05-01-12']
+
+def test_newest_snapshot_of_each_disk_is_kept_however_old():
+	snapshots = [backup('2016-01-01', disk='old'), backup('2016-01-01', 6, disk='old'),
+		backup('2017-05-10', disk='new'), backup('2017-05-09', disk='new')]
+	assert expire('daily=1', snapshots, '2017-05-10') == \
+		['new-2017-05-09-12', 'old-2016-01-01-06']
+
+def test_snapshots_not_ours_or_not_ready_are_never_deleted():
+	foreign = backup('2017-05-01', name='manual', labels={}, sourceDisk='zones/z/disks/pd-1')
+	legacy = backup('2017-05-02', name='pd-1', labels={}, sourceDisk='zones/z/disks/pd-1')
+	creating = backup('2017-05-03', status='CREATING')
+	undated = backup('2017-05-04', creationTimestamp=None)
+	snapshots = [backup('2017-05-10'), foreign, legacy, creating, undated]
+	assert not is_backup_snapshot(foreign)
+	# Unlabelled snapshots named after their disk are from before labels
+	assert is_backup_snapshot(legacy)
+	assert expire('daily=1', snapshots, '2017-05-10') == ['pd-1']
+
+def test_snapshot_names_fit_and_stay_distinct():
+	when = datetime.datetime(2017, 5, 10, 18, 30, 1)
+	prefix = 'gke-prod-' + 'x' * 60
+	a, b = snapshot_name(prefix + '-a', when), snapshot_name(prefix + '-b', when)
+	assert a != b
+	assert max(len(a), len(b)) <= MAX_NAME_LEN
+	assert snapshot_name('pd-1', when) == 'pd-1-20170510-183001'
+
+@pytest.mark.parametrize('policy', ['daily', 'hourly=3', 'daily=x', 'daily=7,'])
+def test_parse_policy_rejects(policy):
+	with pytest.raises(ValueError):
+		parse_policy(policy)
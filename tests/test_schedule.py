@@ -0,0 +1,72 @@
+import datetime
+
+import pytest
+
+from schedule import course_schedule
+
+DATAHUB = '''
+- name: lab 101
+  days: [mon, Wednesday]
+  start: '10:00'
+  duration: 120
+  users: 40
+- name: lab 102
+  days: [mon]
+  start: '11:00'
+  duration: 60
+  users: 30
+- name: late lab
+  days: [tue]
+  start: '23:30'
+  duration: 90
+  users: 10
+'''
+
+STAT28 = '''
+- name: midterm
+  date: 2017-03-15
+  start: '18:30'
+  duration: 90
+  users: 60
+'''
+
+@pytest.fixture
+def calendar(tmp_path):
+	(tmp_path / 'datahub.yaml').write_text(DATAHUB)
+	(tmp_path / 'stat28.yaml').write_text(STAT28)
+	return course_schedule(str(tmp_path), ['datahub', 'stat28', 'prob140'],
+		prewarm=20)
+
+def at(text):
+	return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M')
+
+# 2017-03-13 is a Monday
+@pytest.mark.parametrize('now,floor', [
+	('2017-03-13 09:39', {}),
+	('2017-03-13 09:40', {'datahub': 40}),
+	('2017-03-13 10:45', {'datahub': 70}),
+	('2017-03-13 11:59', {'datahub': 70}),
+	('2017-03-13 12:00', {}),
+	('2017-03-15 10:30', {'datahub': 40}),
+	('2017-03-15 18:10', {'stat28': 60}),
+	('2017-03-15 20:00', {}),
+	('2017-03-22 18:30', {}),
+	# A section running past midnight is still warm the next day
+	('2017-03-15 00:30', {'datahub': 10}),
+	('2017-03-15 01:00', {}),
+])
+def test_floor(calendar, now, floor):
+	assert calendar.floor(at(now)) == floor
+
+def test_warm_returns_sections(calendar):
+	(ns, section, start), = calendar.warm(at('2017-03-15 18:15'))
+	assert (ns, section['name'], start) == ('stat28', 'midterm', at('2017-03-15 18:30'))
+
+def test_to_prepull_once_per_start_and_only_before_it(calendar):
+	assert calendar.to_prepull(at('2017-03-13 09:45')) == ['datahub']
+	assert calendar.to_prepull(at('2017-03-13 09:50')) == []
+	# Lab 102 starts while lab 101 runs
+	assert calendar.to_prepull(at('2017-03-13 10:45')) == ['datahub']
+	assert calendar.to_prepull(at('2017-03-13 11:30')) == []
+	# Next Monday is a new start
+	assert calendar.to_prepull(at('2017-03-20 09:45')) == ['datahub']